@@ -0,0 +1,45 @@
+"""indexes for foreign keys and sorting
+
+Revision ID: 3d1c7a9e5b20
+Revises: 61bb3b92b296
+Create Date: 2026-10-18 10:12:41.208315
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '3d1c7a9e5b20'
+down_revision = '61bb3b92b296'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = (
+    ('ix_comment_recommendation_id_id', 'comment', ['recommendation_id', 'id']),
+    ('ix_comment_recommendation_id_published', 'comment',
+     ['recommendation_id', 'published', 'id']),
+    ('ix_comment_user_id', 'comment', ['user_id']),
+    ('ix_reaction_recommendation_id_id', 'reaction', ['recommendation_id', 'id']),
+    ('ix_reaction_recommendation_id_is_positive', 'reaction',
+     ['recommendation_id', 'is_positive', 'id']),
+    ('ix_recommendation_fiction_type_id_id', 'recommendation', ['fiction_type_id', 'id']),
+    ('ix_recommendation_user_id', 'recommendation', ['user_id']),
+    ('ix_tagged_recommendations_tag_id', 'tagged_recommendations', ['tag_id']),
+)
+
+
+def upgrade() -> None:
+    # Indexes are built CONCURRENTLY on PostgreSQL, so that tables stay
+    # writable while migration runs, which is not possible inside transaction
+    with op.get_context().autocommit_block():
+        for name, table, columns in INDEXES:
+            op.create_index(name, table, columns, postgresql_concurrently=True)
+
+
+def downgrade() -> None:
+    with op.get_context().autocommit_block():
+        for name, table, columns in reversed(INDEXES):
+            op.drop_index(name, table_name=table, postgresql_concurrently=True)
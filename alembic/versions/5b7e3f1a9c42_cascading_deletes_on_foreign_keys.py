@@ -0,0 +1,45 @@
+"""cascading deletes on foreign keys
+
+Revision ID: 5b7e3f1a9c42
+Revises: 9a4e2f6c8d13
+Create Date: 2026-10-18 13:21:08.339120
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '5b7e3f1a9c42'
+down_revision = '9a4e2f6c8d13'
+branch_labels = None
+depends_on = None
+
+
+# (table, column, referred table), constraints have default PostgreSQL names
+FOREIGN_KEYS = (
+    ('recommendation', 'user_id', 'user'),
+    ('recommendation', 'fiction_type_id', 'fiction_type'),
+    ('comment', 'user_id', 'user'),
+    ('comment', 'recommendation_id', 'recommendation'),
+    ('reaction', 'user_id', 'user'),
+    ('reaction', 'recommendation_id', 'recommendation'),
+    ('tagged_recommendations', 'recommendation_id', 'recommendation'),
+)
+
+
+def recreate_foreign_keys(ondelete: str | None):
+    for table, column, referred_table in FOREIGN_KEYS:
+        name = f'{table}_{column}_fkey'
+        op.drop_constraint(name, table, type_='foreignkey')
+        op.create_foreign_key(name, table, referred_table, [column], ['id'],
+                              ondelete=ondelete)
+
+
+def upgrade() -> None:
+    recreate_foreign_keys(ondelete='CASCADE')
+
+
+def downgrade() -> None:
+    recreate_foreign_keys(ondelete=None)
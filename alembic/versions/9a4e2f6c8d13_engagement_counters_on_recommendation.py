@@ -0,0 +1,59 @@
+"""engagement counters on recommendation
+
+Revision ID: 9a4e2f6c8d13
+Revises: 3d1c7a9e5b20
+Create Date: 2026-10-18 11:03:27.514902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import sqlmodel
+
+
+# revision identifiers, used by Alembic.
+revision = '9a4e2f6c8d13'
+down_revision = '3d1c7a9e5b20'
+branch_labels = None
+depends_on = None
+
+
+recommendation = sa.table('recommendation',
+                          sa.column('id', sa.Integer()),
+                          sa.column('positive_reactions', sa.Integer()),
+                          sa.column('negative_reactions', sa.Integer()),
+                          sa.column('comment_count', sa.Integer()))
+reaction = sa.table('reaction',
+                    sa.column('id', sa.Integer()),
+                    sa.column('recommendation_id', sa.Integer()),
+                    sa.column('is_positive', sa.Boolean()))
+comment = sa.table('comment',
+                   sa.column('id', sa.Integer()),
+                   sa.column('recommendation_id', sa.Integer()))
+
+
+def upgrade() -> None:
+    op.add_column('recommendation', sa.Column('positive_reactions', sa.Integer(),
+                                              server_default='0', nullable=False))
+    op.add_column('recommendation', sa.Column('negative_reactions', sa.Integer(),
+                                              server_default='0', nullable=False))
+    op.add_column('recommendation', sa.Column('comment_count', sa.Integer(),
+                                              server_default='0', nullable=False))
+    # Backfill counters from existing reactions and comments
+    op.execute(
+        recommendation.update().values(
+            positive_reactions=sa.select(sa.func.count(reaction.c.id)).
+            where(reaction.c.recommendation_id == recommendation.c.id,
+                  reaction.c.is_positive == sa.true()).scalar_subquery(),
+            negative_reactions=sa.select(sa.func.count(reaction.c.id)).
+            where(reaction.c.recommendation_id == recommendation.c.id,
+                  reaction.c.is_positive == sa.false()).scalar_subquery(),
+            comment_count=sa.select(sa.func.count(comment.c.id)).
+            where(comment.c.recommendation_id == recommendation.c.id).scalar_subquery()
+        )
+    )
+
+
+def downgrade() -> None:
+    op.drop_column('recommendation', 'comment_count')
+    op.drop_column('recommendation', 'negative_reactions')
+    op.drop_column('recommendation', 'positive_reactions')
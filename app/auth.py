@@ -1,5 +1,10 @@
+import asyncio
+import hashlib
+import hmac
+import secrets
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
-from typing import Annotated
+from typing import Annotated, Callable
 
 from decouple import config
 from fastapi import Depends, HTTPException, status
@@ -7,27 +12,40 @@ from fastapi.security import OAuth2PasswordBearer
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from pydantic import BaseModel
-from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 
+from .cache import users_by_id
 from .database import get_session
-from .crud import get_user_with_username
+from .crud import get_user_with_username, attach_cached
+from .models import User, RefreshToken
 
 
 SECRET_KEY = config("SECRET_KEY")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRES_HOURS = 5
+REFRESH_TOKEN_EXPIRES_DAYS = config("REFRESH_TOKEN_EXPIRES_DAYS", default=30, cast=int)
+# Hashes with other cost factor are rehashed on the next login
+BCRYPT_ROUNDS = config("BCRYPT_ROUNDS", default=12, cast=int)
+PASSWORD_HASHING_WORKERS = config("PASSWORD_HASHING_WORKERS", default=2, cast=int)
+PASSWORD_HASHING_QUEUE_SIZE = config("PASSWORD_HASHING_QUEUE_SIZE",
+                                     default=16, cast=int)
 
 
 class Token(BaseModel):
     access_token: str
     token_type: str
+    refresh_token: str | None = None
 
 
 class TokenData(BaseModel):
     username: str | None = None
+    user_id: int | None = None
 
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto",
+                           bcrypt__default_rounds=BCRYPT_ROUNDS,
+                           bcrypt__min_rounds=BCRYPT_ROUNDS,
+                           bcrypt__max_rounds=BCRYPT_ROUNDS)
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl='auth/token')
 
@@ -40,13 +58,54 @@ def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
 
 
-def authenticate_user(*, session: Session,
-                      username: str, password: str):
-    user = get_user_with_username(session=session, username=username)
+class PasswordHashingPool:
+    # bcrypt takes hundreds of milliseconds of CPU, so it runs in a few threads
+    # (bcrypt releases GIL) instead of the event loop. Calls waiting for a thread
+    # are limited, requests above the limit get 503 instead of piling up
+
+    def __init__(self, workers: int, queue_size: int):
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix="password-hashing")
+        self.max_pending = workers + queue_size
+        self.pending = 0
+
+    async def run(self, function: Callable, *args):
+        if self.pending >= self.max_pending:
+            raise HTTPException(
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                detail="Too many password checks in progress, try again later",
+                headers={"Retry-After": "1"}
+            )
+        self.pending += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self.executor,
+                                                                    function, *args)
+        finally:
+            self.pending -= 1
+
+
+password_hashing_pool = PasswordHashingPool(PASSWORD_HASHING_WORKERS,
+                                            PASSWORD_HASHING_QUEUE_SIZE)
+
+
+async def hash_password(password: str) -> str:
+    return await password_hashing_pool.run(get_password_hash, password)
+
+
+async def authenticate_user(*, session: AsyncSession,
+                            username: str, password: str):
+    user = await get_user_with_username(session=session, username=username)
     if not user:
         return False
-    if not verify_password(password, user.hashed_password):
+    verified, new_hashed_password = await password_hashing_pool.run(
+        pwd_context.verify_and_update, password, user.hashed_password)
+    if not verified:
         return False
+    if new_hashed_password:
+        # Hash was made with other cost factor
+        user.hashed_password = new_hashed_password
+        session.add(user)
+        await session.commit()
     return user
 
 
@@ -61,23 +120,91 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
     return encoded_jwt
 
 
-def get_current_user(token: Annotated[str, Depends(oauth2_scheme)],
-                     session: Annotated[Session, Depends(get_session)]):
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Could not validate credentials",
-        headers={"WWW-Authenticate": "Bearer"}
+def create_user_access_token(*, username: str, user_id: int) -> str:
+    return create_access_token(
+        data={"sub": username, "user_id": user_id},
+        expires_delta=timedelta(hours=ACCESS_TOKEN_EXPIRES_HOURS)
     )
+
+
+def sign_refresh_token_secret(secret: str) -> str:
+    return hmac.new(SECRET_KEY.encode(), secret.encode(), hashlib.sha256).hexdigest()
+
+
+def get_refresh_token_hash(refresh_token: str) -> str | None:
+    # Refresh token is "<secret>.<HMAC of secret>", forged tokens are rejected
+    # by the signature without a query. Database keeps only hash of the secret.
+    # Bytes are compared, compare_digest raises TypeError for non-ASCII str
+    secret, _, signature = refresh_token.rpartition(".")
+    if not secret or not hmac.compare_digest(signature.encode(),
+                                             sign_refresh_token_secret(secret).encode()):
+        return None
+    return hashlib.sha256(secret.encode()).hexdigest()
+
+
+async def issue_refresh_token(session: AsyncSession, user_id: int) -> str:
+    secret = secrets.token_urlsafe(32)
+    refresh_token = f"{secret}.{sign_refresh_token_secret(secret)}"
+    session.add(RefreshToken(
+        token_hash=get_refresh_token_hash(refresh_token),
+        user_id=user_id,
+        expires=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRES_DAYS)
+    ))
+    await session.commit()
+    return refresh_token
+
+
+credentials_exception = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Could not validate credentials",
+    headers={"WWW-Authenticate": "Bearer"}
+)
+
+
+def decode_access_token(token: str) -> TokenData:
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         if username is None:
             raise credentials_exception
-        token_data = TokenData(username=username)
-    except JWTError:
+        return TokenData(username=username, user_id=payload.get("user_id"))
+    except (JWTError, ValueError):
         raise credentials_exception
-    user = get_user_with_username(session=session,
-                                  username=token_data.username)
+
+
+async def get_user_by_token(session: AsyncSession, token_data: TokenData) -> User | None:
+    # Users are cached by id, because a username freed by rename can be taken by
+    # another user, and cached user is used only if it still has the token's username.
+    # Entries are dropped when user is updated(in this process) or when ttl expires.
+    # Password hash is not cached. Tokens without user id are always resolved by query
+    if token_data.user_id is not None:
+        cached_user = users_by_id.get(token_data.user_id)
+        if cached_user is not None and cached_user["username"] == token_data.username:
+            return await attach_cached(session, User(**cached_user))
+    user = await get_user_with_username(session=session, username=token_data.username)
+    if user is None or token_data.user_id is not None and user.id != token_data.user_id:
+        return None
+    users_by_id.set(user.id, user.dict(exclude={"hashed_password"}))
+    return user
+
+
+async def get_current_user(token: Annotated[str, Depends(oauth2_scheme)],
+                           session: Annotated[AsyncSession, Depends(get_session)]):
+    token_data = decode_access_token(token)
+    user = await get_user_by_token(session=session, token_data=token_data)
     if user is None:
         raise credentials_exception
     return user
+
+
+async def get_current_user_id(token: Annotated[str, Depends(oauth2_scheme)],
+                              session: Annotated[AsyncSession, Depends(get_session)]) -> int:
+    # Ownership checks need only id of the user, which is carried by the token,
+    # so the user is not loaded. Tokens issued without user id are resolved as before
+    token_data = decode_access_token(token)
+    if token_data.user_id is not None:
+        return token_data.user_id
+    user = await get_user_by_token(session=session, token_data=token_data)
+    if user is None:
+        raise credentials_exception
+    return user.id
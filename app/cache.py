@@ -0,0 +1,80 @@
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable
+
+from decouple import config
+
+
+LOOKUP_CACHE_MAXSIZE = config("LOOKUP_CACHE_MAXSIZE", default=1024, cast=int)
+LOOKUP_CACHE_TTL_SECONDS = config("LOOKUP_CACHE_TTL_SECONDS",
+                                  default=300, cast=float)
+# Users are changed more often than fiction types and tags,
+# so other processes should see the change sooner
+USER_CACHE_TTL_SECONDS = config("USER_CACHE_TTL_SECONDS", default=60, cast=float)
+
+
+class TTLCache:
+    # Process-local LRU cache, entries expire after ttl seconds.
+    # Not shared between workers, so only values that are safe to be
+    # slightly stale should be kept here
+
+    def __init__(self, maxsize: int, ttl: float,
+                 timer: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: Hashable, default: Any = None) -> Any:
+        entry = self._entries.get(key)
+        if entry is None or entry[0] <= self.timer():
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key: Hashable, value: Any):
+        self._entries[key] = (self.timer() + self.ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key: Hashable):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses,
+                "size": len(self._entries), "maxsize": self.maxsize}
+
+
+# name -> (id, slug)
+fiction_types_by_name = TTLCache(LOOKUP_CACHE_MAXSIZE, LOOKUP_CACHE_TTL_SECONDS)
+# id -> (name, slug)
+fiction_types_by_id = TTLCache(LOOKUP_CACHE_MAXSIZE, LOOKUP_CACHE_TTL_SECONDS)
+# slug -> id
+fiction_type_ids_by_slug = TTLCache(LOOKUP_CACHE_MAXSIZE, LOOKUP_CACHE_TTL_SECONDS)
+# name -> id
+tag_ids_by_name = TTLCache(LOOKUP_CACHE_MAXSIZE, LOOKUP_CACHE_TTL_SECONDS)
+# id -> columns of user without password hash
+users_by_id = TTLCache(LOOKUP_CACHE_MAXSIZE, USER_CACHE_TTL_SECONDS)
+
+lookup_caches = {
+    "fiction_types_by_name": fiction_types_by_name,
+    "fiction_types_by_id": fiction_types_by_id,
+    "fiction_type_ids_by_slug": fiction_type_ids_by_slug,
+    "tag_ids_by_name": tag_ids_by_name,
+    "users_by_id": users_by_id,
+}
@@ -0,0 +1,128 @@
+import gzip
+
+from decouple import config
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+# Response bodies are compressed with the best encoding the client accepts.
+# gzip is always available, br and zstd only if packages brotli
+# and zstandard are installed. Smaller bodies are sent as they are
+COMPRESS_RESPONSES = config("COMPRESS_RESPONSES", default=True, cast=bool)
+COMPRESSION_MINIMUM_SIZE = config("COMPRESSION_MINIMUM_SIZE", default=500, cast=int)
+COMPRESSION_GZIP_LEVEL = config("COMPRESSION_GZIP_LEVEL", default=6, cast=int)
+COMPRESSION_BROTLI_QUALITY = config("COMPRESSION_BROTLI_QUALITY", default=4, cast=int)
+COMPRESSION_ZSTD_LEVEL = config("COMPRESSION_ZSTD_LEVEL", default=3, cast=int)
+COMPRESSIBLE_CONTENT_TYPES = ("application/json", "application/x-ndjson", "text/")
+
+# Encodings in order of preference, when client accepts several with the same q
+ENCODERS = {}
+try:
+    import brotli
+    ENCODERS["br"] = lambda body: brotli.compress(body, quality=COMPRESSION_BROTLI_QUALITY)
+except ImportError:
+    pass
+try:
+    import zstandard
+    ENCODERS["zstd"] = zstandard.ZstdCompressor(level=COMPRESSION_ZSTD_LEVEL).compress
+except ImportError:
+    pass
+# mtime is fixed, so the same body is always compressed to the same bytes
+ENCODERS["gzip"] = lambda body: gzip.compress(body, compresslevel=COMPRESSION_GZIP_LEVEL, mtime=0)
+
+
+def choose_encoding(accept_encoding: str) -> str | None:
+    # Encoding with the highest q in Accept-Encoding, "*" stands for any encoding
+    if not COMPRESS_RESPONSES or not accept_encoding:
+        return None
+    qualities = {}
+    for item in accept_encoding.split(","):
+        name, _, parameters = item.strip().partition(";")
+        q = 1.0
+        parameter, _, value = parameters.strip().partition("=")
+        if parameter.strip() == "q":
+            try:
+                q = float(value)
+            except ValueError:
+                q = 0.0
+        qualities[name.strip().lower()] = q
+    default = qualities.get("*", 0.0)
+    candidates = [(qualities.get(name, default), -index, name)
+                  for index, name in enumerate(ENCODERS)]
+    q, _, name = max(candidates)
+    return name if q > 0 else None
+
+
+def is_compressible(content_type: str | None) -> bool:
+    return content_type is not None and content_type.startswith(COMPRESSIBLE_CONTENT_TYPES)
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    return ENCODERS[encoding](body)
+
+
+def encoded_etag(etag: str, encoding: str) -> str:
+    # Every encoding is a separate representation, so it gets its own strong ETag
+    return f'{etag[:-1]}-{encoding}"' if etag.endswith('"') else etag
+
+
+def decoded_etag(etag: str) -> str:
+    for encoding in ENCODERS:
+        suffix = f'-{encoding}"'
+        if etag.endswith(suffix):
+            return etag[:-len(suffix)] + '"'
+    return etag
+
+
+class CompressionMiddleware:
+    # Buffers the first body message of a response and compresses it, if it is
+    # the whole body. Bodies of streamed responses and of responses that already have
+    # Content-Encoding(for example, taken from the response cache) are passed as they are
+
+    def __init__(self, app: ASGIApp, minimum_size: int = COMPRESSION_MINIMUM_SIZE):
+        self.app = app
+        self.minimum_size = minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        request_headers = Headers(scope=scope)
+        encoding = choose_encoding(request_headers.get("accept-encoding", ""))
+        if_none_match = request_headers.get("if-none-match", "")
+        start_message = None
+
+        async def send_compressed(message: Message):
+            nonlocal start_message
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if start_message is None:
+                await send(message)
+                return
+            headers = MutableHeaders(raw=start_message["headers"])
+            body = message.get("body", b"")
+            if start_message["status"] == 304:
+                # ETag of 304 is the one client has, encoded or not
+                etag = headers.get("etag")
+                if encoding and etag and encoded_etag(etag, encoding) in if_none_match:
+                    headers["etag"] = encoded_etag(etag, encoding)
+            elif is_compressible(headers.get("content-type")):
+                # Vary is set here for every compressible response, also for
+                # responses compressed by the response cache
+                vary = {value.strip().lower() for value in headers.get("vary", "").split(",")}
+                if "accept-encoding" not in vary:
+                    headers.add_vary_header("Accept-Encoding")
+                if encoding and "content-encoding" not in headers and \
+                        not message.get("more_body") and len(body) >= self.minimum_size:
+                    body = compress(body, encoding)
+                    headers["content-encoding"] = encoding
+                    headers["content-length"] = str(len(body))
+                    if "etag" in headers:
+                        headers["etag"] = encoded_etag(headers["etag"], encoding)
+                    message = {**message, "body": body}
+            await send(start_message)
+            start_message = None
+            await send(message)
+
+        await self.app(scope, receive, send_compressed)
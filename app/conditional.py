@@ -0,0 +1,41 @@
+import hashlib
+import json
+from datetime import datetime, timezone
+from email.utils import format_datetime
+
+from fastapi import Request, Response, status
+
+from .compression import decoded_etag
+
+
+def make_etag(request: Request, *values) -> str:
+    # Strong ETag: hash of path and query of the request(they select the representation)
+    # and of values, that change whenever the representation changes
+    query = sorted(request.query_params.multi_items())
+    payload = json.dumps([request.url.path, query, *values],
+                         default=str, separators=(',', ':'))
+    return f'"{hashlib.sha256(payload.encode()).hexdigest()[:32]}"'
+
+
+def validator_headers(etag: str, last_modified: datetime | None = None) -> dict:
+    headers = {"ETag": etag}
+    if last_modified is not None:
+        # Dates are stored in UTC without timezone
+        headers["Last-Modified"] = format_datetime(
+            last_modified.replace(tzinfo=timezone.utc), usegmt=True)
+    return headers
+
+
+def etag_matches(request: Request, etag: str) -> bool:
+    # If-None-Match uses weak comparison, so W/ prefix is ignored,
+    # ETags of compressed responses match ETag of their content
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    return etag in {decoded_etag(tag.strip().removeprefix("W/")) for tag in header.split(",")}
+
+
+def not_modified_response(headers: dict) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
@@ -1,105 +1,569 @@
-from sqlmodel import Session, select, and_
-from sqlalchemy import asc, desc
-from sqlalchemy.orm import joinedload
-from .models import User, Recommendation, FictionType, Comment, Reaction
+from datetime import datetime
+from typing import AsyncIterator
+from decouple import config
+from sqlmodel import select, and_
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy import asc, delete, desc, literal_column, true, tuple_, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import aliased, joinedload, load_only, selectinload, make_transient_to_detached
+from sqlalchemy.orm.attributes import set_committed_value
+from .cache import fiction_types_by_id
+from .models import User, Recommendation, FictionType, Comment, Reaction, Tag, RefreshToken,\
+    RecommendationTagLink
 
 
-def get_user_with_username(session: Session, username: str) -> User:
-    return session.exec(select(User).where(User.username == username)).first()
+# Dialect specific INSERT constructs, that support ON CONFLICT clause
+INSERT_BY_DIALECT = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert,
+}
 
+# How recommendation lists load their tags and fiction types:
+# "selectin" - tags are loaded by second query with IN over ids of the page,
+# fiction types are taken from cache, so every row is fetched once;
+# "joined" - tags and fiction types are joined to the page, database returns
+# one row per tag and the page query is wrapped into subquery because of LIMIT
+LIST_LOADING_STRATEGIES = ("selectin", "joined")
+RECOMMENDATION_LIST_LOADING = config("RECOMMENDATION_LIST_LOADING",
+                                     default="selectin")
+if RECOMMENDATION_LIST_LOADING not in LIST_LOADING_STRATEGIES:
+    raise ValueError(
+        f"RECOMMENDATION_LIST_LOADING must be one of {LIST_LOADING_STRATEGIES}")
 
-def get_user_with_email(session: Session, email: str) -> User:
-    return session.exec(select(User).where(User.email == email)).first()
+# Fields of RecommendationRead, that are loaded through relationships
+RECOMMENDATION_RELATIONSHIP_FIELDS = ("fiction_type", "tags")
 
+# Rows fetched from server side cursor at once by streamed lists
+STREAM_YIELD_PER = config("STREAM_YIELD_PER", default=500, cast=int)
 
-def get_recommendation_by_id_with_tags_and_fiction_type(session: Session, recommendation_id: int) -> Recommendation | None:
-    return session.exec(select(Recommendation).options(joinedload(Recommendation.fiction_type),
-                                                       joinedload(Recommendation.tags)).
-                        where(Recommendation.id == recommendation_id)).unique().first()
 
+async def attach_cached(session: AsyncSession, instance):
+    # Turns instance built from cached values into persistent one without
+    # a query, attributes are trusted to be the same as in database
+    make_transient_to_detached(instance)
+    return await session.merge(instance, load=False)
 
-def get_recommendation_by_id(session: Session, recommendation_id: int) -> Recommendation | None:
-    return session.get(Recommendation, recommendation_id)
 
+async def update_user_row(session: AsyncSession, model, row_id: int, user_id: int,
+                          values: dict, *conditions):
+    # UPDATE ... WHERE id = :id AND user_id = :user_id RETURNING, so ownership
+    # is checked by the write itself. Returns updated row or None, if no row matched
+    # (row does not exist, belongs to other user or other conditions failed).
+    # Databases without RETURNING read updated row with one more query
+    statement = update(model).\
+        where(model.id == row_id, model.user_id == user_id, *conditions).\
+        values(values)
+    if session.bind.dialect.full_returning:
+        statement = select(model).from_statement(statement.returning(model)).\
+            execution_options(populate_existing=True)
+        return (await session.execute(statement)).scalars().first()
+    result = await session.execute(statement.execution_options(synchronize_session=False))
+    if result.rowcount == 0:
+        return None
+    return (await session.exec(select(model).where(model.id == row_id).
+                               execution_options(populate_existing=True))).first()
 
-def get_fiction_type_by_slug(session: Session, fiction_type_slug: str) -> FictionType:
-    return session.exec(select(FictionType).where(FictionType.slug == fiction_type_slug)).first()
 
+async def delete_user_row(session: AsyncSession, model, row_id: int, user_id: int,
+                          *conditions, returning: tuple = ()):
+    # DELETE ... WHERE id = :id AND user_id = :user_id RETURNING, so the common
+    # case(row exists and belongs to the user) takes one statement. Returns row
+    # with id and returning columns of deleted row or None, if no row matched.
+    # Databases without RETURNING read these columns before deleting
+    where = (model.id == row_id, model.user_id == user_id, *conditions)
+    columns = (model.id, *returning)
+    if session.bind.dialect.full_returning:
+        return (await session.execute(delete(model).where(*where).
+                                      returning(*columns))).first()
+    row = (await session.execute(select(*columns).where(*where))).first()
+    if row is not None:
+        await session.execute(delete(model).where(model.id == row_id).
+                              execution_options(synchronize_session=False))
+    return row
 
-def get_all_recommendations(session: Session,
-                            offset: int | None = None,
-                            limit: int | None = None):
-    return session.exec(select(Recommendation).offset(offset=offset).limit(limit=limit).
-                        options(
-        joinedload(Recommendation.fiction_type),
-        joinedload(Recommendation.tags)).order_by(asc(Recommendation.id))).unique().all()
 
+def violated_constraint(error: IntegrityError) -> str | None:
+    # Only the name of the constraint is read, the message also contains
+    # submitted values(DETAIL of PostgreSQL), which could look like other fields.
+    # asyncpg error is the cause of DBAPI error, psycopg2 error has diag.
+    # SQLite names only columns of unique constraints and nothing of foreign keys
+    for source in (error.orig.__cause__, getattr(error.orig, "diag", None)):
+        constraint_name = getattr(source, "constraint_name", None)
+        if constraint_name:
+            return constraint_name
+    message = str(error.orig)
+    prefix = "UNIQUE constraint failed: "
+    if message.startswith(prefix):
+        return message[len(prefix):]
+    return None
 
-def get_recommendations_by_fiction_type(session: Session,
-                                        fiction_type: FictionType,
-                                        offset: int | None = None,
-                                        limit: int | None = None):
-    return session.exec(select(Recommendation).offset(offset=offset).limit(limit=limit).
-                        options(
-        joinedload(Recommendation.fiction_type),
-        joinedload(Recommendation.tags)).where(Recommendation.fiction_type_id == fiction_type.id).
+
+async def get_user_with_username(session: AsyncSession, username: str) -> User:
+    return (await session.exec(select(User).where(User.username == username))).first()
+
+
+async def get_user_with_email(session: AsyncSession, email: str) -> User:
+    return (await session.exec(select(User).where(User.email == email))).first()
+
+
+def load_only_fields(fields: tuple[str, ...]):
+    # Columns not needed by the sparse fieldset are deferred,
+    # so they are neither read by the database nor sent over the wire
+    columns = [getattr(Recommendation, name) for name in fields
+               if name not in RECOMMENDATION_RELATIONSHIP_FIELDS]
+    if "fiction_type" in fields:
+        columns.append(Recommendation.fiction_type_id)
+    return load_only(*columns)
+
+
+async def get_refresh_token_with_username(session: AsyncSession,
+                                         token_hash: str) -> tuple[RefreshToken, str] | None:
+    return (await session.exec(select(RefreshToken, User.username).
+                               join(User, User.id == RefreshToken.user_id).
+                               where(RefreshToken.token_hash == token_hash))).first()
+
+
+async def revoke_refresh_token(session: AsyncSession, token_hash: str) -> bool:
+    # Only one of concurrent requests with the same token revokes it,
+    # returns False if token was already revoked or does not exist
+    result = await session.execute(update(RefreshToken).
+                                   where(RefreshToken.token_hash == token_hash,
+                                         RefreshToken.revoked == False).
+                                   values(revoked=True).
+                                   execution_options(synchronize_session=False))
+    return result.rowcount == 1
+
+
+async def revoke_user_refresh_tokens(session: AsyncSession, user_id: int):
+    await session.execute(update(RefreshToken).
+                          where(RefreshToken.user_id == user_id,
+                                RefreshToken.revoked == False).
+                          values(revoked=True).
+                          execution_options(synchronize_session=False))
+
+
+async def get_recommendation_by_id_with_tags_and_fiction_type(session: AsyncSession, recommendation_id: int,
+                                                              fields: tuple[str, ...] | None = None) -> Recommendation | None:
+    statement = select(Recommendation).where(
+        Recommendation.id == recommendation_id)
+    if fields is not None:
+        statement = statement.options(load_only_fields(fields))
+    if fields is None or "fiction_type" in fields:
+        statement = statement.options(joinedload(Recommendation.fiction_type))
+    if fields is None or "tags" in fields:
+        statement = statement.options(joinedload(Recommendation.tags))
+    return (await session.exec(statement)).unique().first()
+
+
+async def get_recommendation_by_id(session: AsyncSession, recommendation_id: int) -> Recommendation | None:
+    return await session.get(Recommendation, recommendation_id)
+
+
+async def recommendation_exists(session: AsyncSession, recommendation_id: int) -> bool:
+    return (await session.exec(select(Recommendation.id).
+                               where(Recommendation.id == recommendation_id))).first() is not None
+
+
+async def violates_recommendation_foreign_key(session: AsyncSession, error: IntegrityError,
+                                              model, recommendation_id: int) -> bool:
+    # Whether write of the model failed, because its recommendation does not exist.
+    # Databases not naming the violated constraint are asked for the recommendation,
+    # so session must be rolled back before
+    constraint_name = violated_constraint(error)
+    if constraint_name is not None:
+        return constraint_name == f"{model.__tablename__}_recommendation_id_fkey"
+    return not await recommendation_exists(session, recommendation_id)
+
+
+async def get_fiction_type_by_slug(session: AsyncSession, fiction_type_slug: str) -> FictionType:
+    return (await session.exec(select(FictionType).where(FictionType.slug == fiction_type_slug))).first()
+
+
+async def get_tags_by_names(session: AsyncSession, names: list[str]) -> list[Tag]:
+    return (await session.exec(select(Tag).where(Tag.name.in_(names)))).all()
+
+
+async def insert_tags_ignoring_duplicates(session: AsyncSession, names: list[str]) -> list[Tag]:
+    # Names that already exist are skipped(ON CONFLICT DO NOTHING), so concurrent
+    # requests creating the same tag do not fail on unique constraint.
+    # Returns tags created by this statement if database supports RETURNING,
+    # otherwise empty list
+    dialect = session.bind.dialect
+    statement = INSERT_BY_DIALECT[dialect.name](Tag).\
+        values([{"name": name} for name in names]).on_conflict_do_nothing()
+    if not dialect.full_returning:
+        await session.execute(statement)
+        return []
+    statement = select(Tag).from_statement(statement.returning(Tag))
+    return (await session.execute(statement)).scalars().all()
+
+
+async def get_tags_of_recommendation(session: AsyncSession, recommendation_id: int) -> list[Tag]:
+    return (await session.exec(select(Tag).
+                               join(RecommendationTagLink,
+                                    RecommendationTagLink.tag_id == Tag.id).
+                               where(RecommendationTagLink.recommendation_id == recommendation_id))).all()
+
+
+async def replace_recommendation_tags(session: AsyncSession, recommendation_id: int,
+                                      tags: list[Tag]):
+    # Only ids of linked tags are read, then links of removed tags are deleted and
+    # links of added tags are inserted, each with one bulk statement(if any).
+    # Links inserted by concurrent request are skipped(ON CONFLICT DO NOTHING)
+    current_ids = set((await session.execute(
+        select(RecommendationTagLink.tag_id).
+        where(RecommendationTagLink.recommendation_id == recommendation_id))).scalars())
+    new_ids = {tag.id for tag in tags}
+    removed_ids = current_ids - new_ids
+    added_ids = [tag.id for tag in tags if tag.id not in current_ids]
+    if removed_ids:
+        await session.execute(delete(RecommendationTagLink).
+                              where(RecommendationTagLink.recommendation_id == recommendation_id,
+                                    RecommendationTagLink.tag_id.in_(removed_ids)).
+                              execution_options(synchronize_session=False))
+    if added_ids:
+        await session.execute(INSERT_BY_DIALECT[session.bind.dialect.name](RecommendationTagLink).
+                              values([{"recommendation_id": recommendation_id, "tag_id": tag_id}
+                                      for tag_id in added_ids]).
+                              on_conflict_do_nothing())
+
+
+async def load_fiction_types(session: AsyncSession, recommendations: list[Recommendation]):
+    fiction_types = {}
+    missing_ids = set()
+    for fiction_type_id in {r.fiction_type_id for r in recommendations}:
+        cached_fiction_type = fiction_types_by_id.get(fiction_type_id)
+        if cached_fiction_type is None:
+            missing_ids.add(fiction_type_id)
+            continue
+        name, slug = cached_fiction_type
+        fiction_types[fiction_type_id] = await attach_cached(
+            session, FictionType(id=fiction_type_id, name=name, slug=slug))
+    if missing_ids:
+        for fiction_type in (await session.exec(select(FictionType).
+                                                where(FictionType.id.in_(missing_ids)))).all():
+            fiction_types_by_id.set(fiction_type.id,
+                                    (fiction_type.name, fiction_type.slug))
+            fiction_types[fiction_type.id] = fiction_type
+    for recommendation in recommendations:
+        set_committed_value(recommendation, "fiction_type",
+                            fiction_types[recommendation.fiction_type_id])
+
+
+async def get_recommendation_list(session: AsyncSession, statement,
+                                  loading: str | None = None,
+                                  fields: tuple[str, ...] | None = None) -> list[Recommendation]:
+    loading = loading or RECOMMENDATION_LIST_LOADING
+    load_fiction_type = fields is None or "fiction_type" in fields
+    load_tags = fields is None or "tags" in fields
+    if fields is not None:
+        statement = statement.options(load_only_fields(fields))
+    if loading == "joined":
+        if load_fiction_type:
+            statement = statement.options(
+                joinedload(Recommendation.fiction_type))
+        if load_tags:
+            statement = statement.options(joinedload(Recommendation.tags))
+        return (await session.exec(statement)).unique().all()
+    if load_tags:
+        statement = statement.options(selectinload(Recommendation.tags))
+    recommendations = (await session.exec(statement)).all()
+    if load_fiction_type:
+        await load_fiction_types(session, recommendations)
+    return recommendations
+
+
+def recommendation_page_statement(offset: int | None = None,
+                                  limit: int | None = None,
+                                  after_id: int | None = None,
+                                  fiction_type_id: int | None = None):
+    statement = select(Recommendation).offset(offset=offset).limit(limit=limit).\
         order_by(asc(Recommendation.id))
-    ).unique().all()
-
-
-def get_comment_by_id_and_recommendation_id(session: Session,
-                                            recommendation_id: int,
-                                            comment_id: int) -> Comment | None:
-    return session.exec(select(Comment).
-                        where(and_(Comment.recommendation_id == recommendation_id,
-                                   Comment.id == comment_id))).first()
-
-
-def get_all_comments_for_recommendation(session: Session,
-                                        recommendation_id: int,
-                                        by_published_date_descending: bool | None,
-                                        offset: int | None,
-                                        limit: int | None):
-    if by_published_date_descending is None:
-        return session.exec(select(Comment).offset(None).offset(offset=offset).limit(limit=limit).
-                            where(Comment.recommendation_id == recommendation_id).
-                            order_by(asc(Comment.id))).all()
-    if by_published_date_descending == False:
-        return session.exec(select(Comment).offset(offset=offset).limit(limit=limit).
-                            where(Comment.recommendation_id == recommendation_id).
-                            order_by(asc(Comment.published))).all()
-    else:
-        return session.exec(select(Comment).offset(offset=offset).limit(limit=limit).
-                            where(Comment.recommendation_id == recommendation_id).
-                            order_by(desc(Comment.published))).all()
-
-
-def get_reaction_by_recommendation_id_and_user_id(session: Session,
-                                                  recommendation_id: int,
-                                                  user_id: int) -> Reaction | None:
-    return session.exec(select(Reaction).
-                        where(and_(Reaction.recommendation_id == recommendation_id,
-                                   Reaction.user_id == user_id))).first()
-
-
-def get_all_reactions_for_recommendation(session: Session,
+    if fiction_type_id is not None:
+        statement = statement.where(Recommendation.fiction_type_id == fiction_type_id)
+    if after_id is not None:
+        statement = statement.where(Recommendation.id > after_id)
+    return statement
+
+
+async def get_all_recommendations(session: AsyncSession,
+                                  offset: int | None = None,
+                                  limit: int | None = None,
+                                  after_id: int | None = None,
+                                  loading: str | None = None,
+                                  fields: tuple[str, ...] | None = None):
+    statement = recommendation_page_statement(offset=offset, limit=limit, after_id=after_id)
+    return await get_recommendation_list(session, statement,
+                                         loading=loading, fields=fields)
+
+
+async def get_recommendations_by_fiction_type(session: AsyncSession,
+                                              fiction_type_id: int,
+                                              offset: int | None = None,
+                                              limit: int | None = None,
+                                              after_id: int | None = None,
+                                              loading: str | None = None,
+                                              fields: tuple[str, ...] | None = None):
+    statement = recommendation_page_statement(offset=offset, limit=limit, after_id=after_id,
+                                              fiction_type_id=fiction_type_id)
+    return await get_recommendation_list(session, statement,
+                                         loading=loading, fields=fields)
+
+
+async def stream_partitions(session: AsyncSession, statement,
+                            yield_per: int | None = None) -> AsyncIterator[list]:
+    # Rows are fetched through server side cursor by yield_per rows at once.
+    # Objects of a partition are expunged from the session when the next one
+    # is requested, so memory of a stream does not grow with number of rows
+    # (related objects, such as tags, are shared by rows and stay in the session)
+    statement = statement.execution_options(yield_per=yield_per or STREAM_YIELD_PER)
+    result = await session.stream(statement)
+    try:
+        async for partition in result.scalars().partitions():
+            yield partition
+            for instance in partition:
+                session.expunge(instance)
+    finally:
+        await result.close()
+
+
+async def stream_recommendations(session: AsyncSession,
+                                 offset: int | None = None,
+                                 limit: int | None = None,
+                                 after_id: int | None = None,
+                                 fiction_type_id: int | None = None,
+                                 fields: tuple[str, ...] | None = None,
+                                 yield_per: int | None = None) -> AsyncIterator[list[Recommendation]]:
+    # Tags of every partition are loaded by selectin query,
+    # joined loading of collections can not be combined with yield_per
+    statement = recommendation_page_statement(offset=offset, limit=limit, after_id=after_id,
+                                              fiction_type_id=fiction_type_id)
+    if fields is not None:
+        statement = statement.options(load_only_fields(fields))
+    if fields is None or "tags" in fields:
+        statement = statement.options(selectinload(Recommendation.tags))
+    async for recommendations in stream_partitions(session, statement, yield_per):
+        if fields is None or "fiction_type" in fields:
+            await load_fiction_types(session, recommendations)
+        yield recommendations
+
+
+async def update_recommendation_counters(session: AsyncSession,
                                          recommendation_id: int,
-                                         is_positive: bool | None,
-                                         offset: int | None,
-                                         limit: int | None):
+                                         positive_reactions: int = 0,
+                                         negative_reactions: int = 0,
+                                         comment_count: int = 0):
+    # Counters are changed by the database(column = column + delta), so that
+    # concurrent requests do not overwrite each other's changes
+    deltas = {"positive_reactions": positive_reactions,
+              "negative_reactions": negative_reactions,
+              "comment_count": comment_count}
+    values = {getattr(Recommendation, name): getattr(Recommendation, name) + delta
+              for name, delta in deltas.items() if delta}
+    if not values:
+        return
+    await session.execute(update(Recommendation).
+                          where(Recommendation.id == recommendation_id).
+                          values(values).
+                          execution_options(synchronize_session=False))
+
+
+async def get_recommendation_summaries(session: AsyncSession,
+                                       recommendation_ids: list[int]):
+    # One query over denormalized counters, instead of counting
+    # reactions and comments of every recommendation
+    return (await session.exec(select(Recommendation.id,
+                                      Recommendation.positive_reactions,
+                                      Recommendation.negative_reactions,
+                                      Recommendation.comment_count).
+                               where(Recommendation.id.in_(recommendation_ids)))).all()
+
+
+async def get_recommendation_child(session: AsyncSession, model, recommendation_id: int,
+                                   *conditions, fields: tuple[str, ...] | None = None
+                                   ) -> tuple[bool, Comment | Reaction | None]:
+    # Recommendation is LEFT JOINed with its child, so one statement tells
+    # whether the recommendation exists and returns the child, if it is found.
+    # If fields are given, only these columns of the child are loaded.
+    # Returns (recommendation exists, child or None)
+    statement = select(Recommendation.id, model).\
+        outerjoin(model, and_(model.recommendation_id == Recommendation.id, *conditions)).\
+        where(Recommendation.id == recommendation_id)
+    if fields is not None:
+        statement = statement.options(load_only(*(getattr(model, name) for name in fields)))
+    row = (await session.execute(statement)).first()
+    if row is None:
+        return False, None
+    return True, row[1]
+
+
+async def get_recommendation_children_page(session: AsyncSession, model, recommendation_id: int,
+                                           statement, ordering,
+                                           fields: tuple[str, ...] | None = None) -> tuple[bool, list]:
+    # Page of children is LEFT JOINed to the recommendation, so the recommendation
+    # gives one row with NULL child even if the page is empty.
+    # ordering(entity) returns ORDER BY clauses, they are applied again
+    # to the outer query, because subquery does not keep order of its rows.
+    # If fields are given, only these columns of children are loaded(they have
+    # to include columns of ordering). Returns (recommendation exists, children)
+    if fields is not None:
+        statement = statement.with_only_columns(*(getattr(model, name) for name in fields))
+    page = aliased(model, statement.subquery())
+    statement = select(Recommendation.id, page).\
+        outerjoin(page, true()).\
+        where(Recommendation.id == recommendation_id).\
+        order_by(*ordering(page))
+    if fields is not None:
+        statement = statement.options(load_only(*(getattr(page, name) for name in fields)))
+    rows = (await session.execute(statement)).all()
+    return bool(rows), [child for _, child in rows if child is not None]
+
+
+async def get_comment_and_check_recommendation(session: AsyncSession,
+                                               recommendation_id: int,
+                                               comment_id: int,
+                                               fields: tuple[str, ...] | None = None
+                                               ) -> tuple[bool, Comment | None]:
+    return await get_recommendation_child(session, Comment, recommendation_id,
+                                          Comment.id == comment_id, fields=fields)
+
+
+def comment_ordering(by_published_date_descending: bool | None):
+    def ordering(comment) -> list:
+        if by_published_date_descending is None:
+            return [asc(comment.id)]
+        direction = desc if by_published_date_descending else asc
+        return [direction(comment.published), direction(comment.id)]
+    return ordering
+
+
+def comment_page_statement(recommendation_id: int,
+                           by_published_date_descending: bool | None,
+                           offset: int | None,
+                           limit: int | None,
+                           after_id: int | None = None,
+                           after_published: datetime | None = None):
+    # Keyset pagination: rows after cursor are found through the index on sort key,
+    # instead of scanning and dropping all rows of previous pages as OFFSET does
+    ordering = comment_ordering(by_published_date_descending)
+    statement = select(Comment).offset(offset=offset).limit(limit=limit).\
+        where(Comment.recommendation_id == recommendation_id).\
+        order_by(*ordering(Comment))
+    if after_id is not None:
+        if by_published_date_descending is None:
+            statement = statement.where(Comment.id > after_id)
+        elif by_published_date_descending == False:
+            statement = statement.where(tuple_(Comment.published, Comment.id) >
+                                        tuple_(after_published, after_id))
+        else:
+            statement = statement.where(tuple_(Comment.published, Comment.id) <
+                                        tuple_(after_published, after_id))
+    return statement
+
+
+async def get_all_comments_for_recommendation(session: AsyncSession,
+                                              recommendation_id: int,
+                                              by_published_date_descending: bool | None,
+                                              offset: int | None,
+                                              limit: int | None,
+                                              after_id: int | None = None,
+                                              after_published: datetime | None = None,
+                                              fields: tuple[str, ...] | None = None
+                                              ) -> tuple[bool, list[Comment]]:
+    statement = comment_page_statement(recommendation_id, by_published_date_descending,
+                                       offset, limit, after_id, after_published)
+    return await get_recommendation_children_page(
+        session, Comment, recommendation_id, statement,
+        comment_ordering(by_published_date_descending), fields=fields)
+
+
+async def get_user_reaction_and_check_recommendation(session: AsyncSession,
+                                                     recommendation_id: int,
+                                                     user_id: int) -> tuple[bool, Reaction | None]:
+    return await get_recommendation_child(session, Reaction, recommendation_id,
+                                          Reaction.user_id == user_id)
+
+
+def reaction_ordering(reaction) -> list:
+    return [asc(reaction.id)]
+
+
+def reaction_page_statement(recommendation_id: int,
+                            is_positive: bool | None,
+                            offset: int | None,
+                            limit: int | None,
+                            after_id: int | None = None):
+    statement = select(Reaction).offset(offset=offset).limit(limit=limit).\
+        where(Reaction.recommendation_id == recommendation_id).\
+        order_by(*reaction_ordering(Reaction))
     if is_positive is not None:
-        return session.exec(select(Reaction).offset(offset=offset).limit(limit=limit).
-                            where(and_(Reaction.is_positive == is_positive,
-                                       Reaction.recommendation_id == recommendation_id)).
-                            order_by(asc(Reaction.id))).all()
-    return session.exec(select(Reaction).offset(offset=offset).limit(limit=limit).
-                        where(Reaction.recommendation_id == recommendation_id).
-                        order_by(asc(Reaction.id))).all()
-
-
-def get_reaction_by_id_and_recommendation_id(session: Session,
-                                             recommendation_id: int,
-                                             reaction_id: int) -> Reaction | None:
-    return session.exec(select(Reaction).
-                        where(and_(Reaction.recommendation_id == recommendation_id,
-                                   Reaction.id == reaction_id))).first()
+        statement = statement.where(Reaction.is_positive == is_positive)
+    if after_id is not None:
+        statement = statement.where(Reaction.id > after_id)
+    return statement
+
+
+async def get_all_reactions_for_recommendation(session: AsyncSession,
+                                               recommendation_id: int,
+                                               is_positive: bool | None,
+                                               offset: int | None,
+                                               limit: int | None,
+                                               after_id: int | None = None) -> tuple[bool, list[Reaction]]:
+    statement = reaction_page_statement(recommendation_id, is_positive, offset, limit, after_id)
+    return await get_recommendation_children_page(session, Reaction, recommendation_id,
+                                                  statement, reaction_ordering)
+
+
+async def get_reaction_and_check_recommendation(session: AsyncSession,
+                                                recommendation_id: int,
+                                                reaction_id: int) -> tuple[bool, Reaction | None]:
+    return await get_recommendation_child(session, Reaction, recommendation_id,
+                                          Reaction.id == reaction_id)
+
+
+async def upsert_user_reaction(session: AsyncSession, recommendation_id: int, user_id: int,
+                               is_positive: bool) -> tuple[Reaction | None, bool]:
+    # INSERT ... ON CONFLICT(user_id, recommendation_id) DO UPDATE, the row is not
+    # written when reaction already has this value. Returns (reaction, created),
+    # reaction is None when nothing was written. IntegrityError is raised
+    # if recommendation does not exist
+    dialect = session.bind.dialect
+    statement = INSERT_BY_DIALECT[dialect.name](Reaction).\
+        values(user_id=user_id, recommendation_id=recommendation_id, is_positive=is_positive)
+    statement = statement.on_conflict_do_update(
+        index_elements=["user_id", "recommendation_id"],
+        set_={"is_positive": statement.excluded.is_positive},
+        where=Reaction.is_positive != statement.excluded.is_positive
+    )
+    if dialect.name == "postgresql":
+        # PostgreSQL: xmax of a row inserted(not updated) by this statement is 0
+        row = (await session.execute(statement.returning(
+            Reaction.id, literal_column("xmax = 0").label("created")))).first()
+        if row is None:
+            return None, False
+        return Reaction(id=row.id, user_id=user_id, recommendation_id=recommendation_id,
+                        is_positive=is_positive), row.created
+    # Other databases read current reaction before the write
+    existing = (await session.exec(select(Reaction).
+                                   where(Reaction.user_id == user_id,
+                                         Reaction.recommendation_id == recommendation_id))).first()
+    result = await session.execute(statement)
+    if not result.rowcount:
+        return None, False
+    if existing is None:
+        return Reaction(id=result.inserted_primary_key[0], user_id=user_id,
+                        recommendation_id=recommendation_id, is_positive=is_positive), True
+    set_committed_value(existing, "is_positive", is_positive)
+    return existing, False
+
+
+async def delete_user_reaction(session: AsyncSession, recommendation_id: int, user_id: int,
+                               is_positive: bool) -> bool:
+    # Deletes reaction of the user only if it has this value
+    result = await session.execute(delete(Reaction).
+                                   where(Reaction.user_id == user_id,
+                                         Reaction.recommendation_id == recommendation_id,
+                                         Reaction.is_positive == is_positive).
+                                   execution_options(synchronize_session=False))
+    return result.rowcount > 0
@@ -1,13 +1,50 @@
-from sqlmodel import Session, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import create_async_engine
 from decouple import config
 
 
+# Sync drivers used in DATABASE_URL mapped to their asyncio counterparts
+ASYNC_DRIVERS = {
+    "postgresql": "postgresql+asyncpg",
+    "postgresql+psycopg2": "postgresql+asyncpg",
+    "sqlite": "sqlite+aiosqlite",
+    "sqlite+pysqlite": "sqlite+aiosqlite",
+}
+
+
+def get_async_database_url(database_url: str) -> str:
+    url = make_url(database_url)
+    drivername = ASYNC_DRIVERS.get(url.drivername, url.drivername)
+    return str(url.set(drivername=drivername))
+
+
+def enable_sqlite_foreign_keys(engine: Engine):
+    # SQLite checks foreign keys(and so cascades deletes)
+    # only when it is enabled for every connection
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA foreign_keys=ON")
+        cursor.close()
+
+
 DATABASE_URL = config("DATABASE_URL")
+ASYNC_DATABASE_URL = config("ASYNC_DATABASE_URL",
+                            default=get_async_database_url(DATABASE_URL))
 
 
-engine = create_engine(DATABASE_URL)
+async_engine = create_async_engine(ASYNC_DATABASE_URL)
+enable_sqlite_foreign_keys(async_engine.sync_engine)
 
 
-def get_session():
-    with Session(engine) as session:
+async def get_session():
+    # expire_on_commit=False, because attributes of committed objects
+    # are read after commit while serializing response and lazy loading
+    # them outside of the greenlet context is not possible with AsyncSession
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
         yield session
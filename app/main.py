@@ -1,8 +1,13 @@
 from fastapi import FastAPI
 
+from .cache import lookup_caches
+from .compression import CompressionMiddleware
+from .database import async_engine
+from .response_cache import response_cache
 from .routers import users, recommendations, comments, reactions
 
 app = FastAPI(debug=True)
+app.add_middleware(CompressionMiddleware)
 
 
 app.include_router(users.router)
@@ -11,6 +16,18 @@ app.include_router(comments.router)
 app.include_router(reactions.router)
 
 
+@app.on_event("shutdown")
+async def dispose_engine():
+    await async_engine.dispose()
+
+
 @app.get("/")
 async def root():
     return {"is_root": True}
+
+
+@app.get("/cache/stats")
+async def cache_stats():
+    # Hit ratios and sizes of response cache and lookup caches of this process
+    return {"responses": response_cache.stats(),
+            "lookups": {name: cache.stats() for name, cache in lookup_caches.items()}}
@@ -0,0 +1,74 @@
+import argparse
+import asyncio
+from datetime import datetime
+
+from sqlalchemy import delete, func, or_, select, update
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .database import async_engine
+from .models import Recommendation, Reaction, Comment, RefreshToken
+
+
+async def repair_recommendation_counters(session: AsyncSession) -> int:
+    # Recounts denormalized counters of recommendations from reaction and comment
+    # tables, only rows with wrong counters are updated. Returns number of repaired rows
+    positive_reactions = select(func.count(Reaction.id)).\
+        where(Reaction.recommendation_id == Recommendation.id,
+              Reaction.is_positive == True).scalar_subquery()
+    negative_reactions = select(func.count(Reaction.id)).\
+        where(Reaction.recommendation_id == Recommendation.id,
+              Reaction.is_positive == False).scalar_subquery()
+    comment_count = select(func.count(Comment.id)).\
+        where(Comment.recommendation_id == Recommendation.id).scalar_subquery()
+    result = await session.execute(
+        update(Recommendation).
+        where(or_(Recommendation.positive_reactions != positive_reactions,
+                  Recommendation.negative_reactions != negative_reactions,
+                  Recommendation.comment_count != comment_count)).
+        values(positive_reactions=positive_reactions,
+               negative_reactions=negative_reactions,
+               comment_count=comment_count).
+        execution_options(synchronize_session=False)
+    )
+    await session.commit()
+    return result.rowcount
+
+
+async def repair_counters():
+    async with AsyncSession(async_engine) as session:
+        repaired = await repair_recommendation_counters(session)
+    await async_engine.dispose()
+    print(f"Repaired counters of {repaired} recommendation(s)")
+
+
+async def delete_expired_refresh_tokens(session: AsyncSession) -> int:
+    # Expired tokens can not be used anymore, so they are no longer needed
+    # neither for rotation nor for detection of reused tokens
+    result = await session.execute(delete(RefreshToken).
+                                   where(RefreshToken.expires <= datetime.utcnow()))
+    await session.commit()
+    return result.rowcount
+
+
+async def delete_refresh_tokens():
+    async with AsyncSession(async_engine) as session:
+        deleted = await delete_expired_refresh_tokens(session)
+    await async_engine.dispose()
+    print(f"Deleted {deleted} expired refresh token(s)")
+
+
+COMMANDS = {
+    "repair-counters": repair_counters,
+    "delete-expired-refresh-tokens": delete_refresh_tokens,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m app.maintenance")
+    parser.add_argument("command", choices=COMMANDS)
+    args = parser.parse_args()
+    asyncio.run(COMMANDS[args.command]())
+
+
+if __name__ == "__main__":
+    main()
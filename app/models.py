@@ -1,21 +1,30 @@
 from datetime import datetime
 from sqlmodel import SQLModel, Field, Relationship
-from sqlalchemy import UniqueConstraint
+from sqlalchemy import Column, ForeignKey, Index, Integer, UniqueConstraint
 from .schemas import UserBase, RecommendationBase, FictionTypeBase, TagBase, CommentBase, ReactionBase
 
 
+# Children are deleted by the database(ON DELETE CASCADE) in the same statement
+# as their parent, passive_deletes stops ORM from loading and deleting them one by one
+CASCADE_DELETE = {"cascade": "delete", "passive_deletes": True}
+
+
+def cascading_foreign_key(column: str, **kwargs) -> Column:
+    return Column(Integer, ForeignKey(column, ondelete="CASCADE"), nullable=False, **kwargs)
+
+
 class User(UserBase, table=True):
     id: int | None = Field(primary_key=True, default=None)
     hashed_password: str
 
     recommendations: list["Recommendation"] = Relationship(
-        back_populates="user", sa_relationship_kwargs={"cascade": "delete"}
+        back_populates="user", sa_relationship_kwargs=CASCADE_DELETE
     )
     comments: list["Comment"] = Relationship(
-        back_populates="user", sa_relationship_kwargs={"cascade": "delete"}
+        back_populates="user", sa_relationship_kwargs=CASCADE_DELETE
     )
     reactions: list["Reaction"] = Relationship(
-        back_populates="user", sa_relationship_kwargs={"cascade": "delete"}
+        back_populates="user", sa_relationship_kwargs=CASCADE_DELETE
     )
 
 
@@ -24,39 +33,51 @@ class FictionType(FictionTypeBase, table=True):
     id: int | None = Field(primary_key=True, default=None)
 
     recommendations: list["Recommendation"] = Relationship(
-        back_populates="fiction_type", sa_relationship_kwargs={"cascade": "delete"}
+        back_populates="fiction_type", sa_relationship_kwargs=CASCADE_DELETE
     )
 
 
 class RecommendationTagLink(SQLModel, table=True):
     __tablename__ = 'tagged_recommendations'
     recommendation_id: int | None = Field(
-        default=None, foreign_key="recommendation.id", primary_key=True
+        default=None, sa_column=cascading_foreign_key("recommendation.id", primary_key=True)
     )
     tag_id: int | None = Field(
         default=None, foreign_key="tag.id", primary_key=True
     )
+    # Primary key starts with recommendation_id, so lookups by tag need own index
+    __table_args__ = (Index('ix_tagged_recommendations_tag_id', 'tag_id'),)
 
 
 class Recommendation(RecommendationBase, table=True):
     id: int | None = Field(primary_key=True, default=None)
     published: datetime = Field(default=datetime.utcnow())
     updated: datetime | None = Field(default=None)
-    user_id: int = Field(foreign_key="user.id")
+    user_id: int = Field(sa_column=cascading_foreign_key("user.id"))
     fiction_type_id: int = Field(
-        foreign_key="fiction_type.id")
+        sa_column=cascading_foreign_key("fiction_type.id"))
+    # Denormalized counters, changed in the same transaction as reactions and comments
+    positive_reactions: int = Field(
+        default=0, sa_column_kwargs={"server_default": "0"})
+    negative_reactions: int = Field(
+        default=0, sa_column_kwargs={"server_default": "0"})
+    comment_count: int = Field(
+        default=0, sa_column_kwargs={"server_default": "0"})
 
     user: User = Relationship(back_populates="recommendations")
     fiction_type: FictionType = Relationship(back_populates="recommendations")
     tags: list["Tag"] = Relationship(
-        back_populates="recommendations", link_model=RecommendationTagLink
+        back_populates="recommendations", link_model=RecommendationTagLink,
+        sa_relationship_kwargs={"passive_deletes": True}
     )
     comments: list["Comment"] = Relationship(
-        back_populates="recommendation", sa_relationship_kwargs={"cascade": "delete"}
+        back_populates="recommendation", sa_relationship_kwargs=CASCADE_DELETE
     )
     reactions: list["Reaction"] = Relationship(
-        back_populates="recommendation", sa_relationship_kwargs={"cascade": "delete"}
+        back_populates="recommendation", sa_relationship_kwargs=CASCADE_DELETE
     )
+    __table_args__ = (Index('ix_recommendation_fiction_type_id_id', 'fiction_type_id', 'id'),
+                      Index('ix_recommendation_user_id', 'user_id'))
 
 
 class Tag(TagBase, table=True):
@@ -71,19 +92,42 @@ class Comment(CommentBase, table=True):
     id: int | None = Field(primary_key=True, default=None)
     published: datetime = Field(default=datetime.utcnow())
     updated: datetime | None = Field(default=None)
-    user_id: int = Field(foreign_key="user.id")
-    recommendation_id: int = Field(foreign_key="recommendation.id")
+    user_id: int = Field(sa_column=cascading_foreign_key("user.id"))
+    recommendation_id: int = Field(
+        sa_column=cascading_foreign_key("recommendation.id"))
 
     user: User = Relationship(back_populates="comments")
     recommendation: Recommendation = Relationship(back_populates="comments")
+    __table_args__ = (Index('ix_comment_recommendation_id_id', 'recommendation_id', 'id'),
+                      Index('ix_comment_recommendation_id_published',
+                            'recommendation_id', 'published', 'id'),
+                      Index('ix_comment_user_id', 'user_id'))
 
 
 class Reaction(ReactionBase, table=True):
     id: int | None = Field(primary_key=True, default=None)
-    user_id: int = Field(foreign_key="user.id")
-    recommendation_id: int = Field(foreign_key="recommendation.id")
+    user_id: int = Field(sa_column=cascading_foreign_key("user.id"))
+    recommendation_id: int = Field(
+        sa_column=cascading_foreign_key("recommendation.id"))
 
     user: User = Relationship(back_populates="reactions")
     recommendation: Recommendation = Relationship(back_populates="reactions")
     __table_args__ = (UniqueConstraint('user_id', 'recommendation_id',
-                                       name='user_recommendation_uc'),)
+                                       name='user_recommendation_uc'),
+                      Index('ix_reaction_recommendation_id_id',
+                            'recommendation_id', 'id'),
+                      Index('ix_reaction_recommendation_id_is_positive',
+                            'recommendation_id', 'is_positive', 'id'))
+
+
+class RefreshToken(SQLModel, table=True):
+    __tablename__ = 'refresh_token'
+    id: int | None = Field(primary_key=True, default=None)
+    # SHA-256 of the token, token itself is known only to the client
+    token_hash: str = Field(max_length=64, unique=True, index=True)
+    user_id: int = Field(sa_column=cascading_foreign_key("user.id"))
+    expires: datetime
+    # Set when token is used(rotated) or revoked, token can be used only once
+    revoked: bool = Field(default=False)
+
+    __table_args__ = (Index('ix_refresh_token_user_id', 'user_id'),)
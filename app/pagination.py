@@ -0,0 +1,36 @@
+import base64
+import json
+from datetime import datetime
+
+from fastapi import HTTPException, Request, Response, status
+
+
+def encode_cursor(*, id: int, published: datetime | None = None) -> str:
+    values = {"id": id}
+    if published is not None:
+        values["published"] = published.isoformat()
+    payload = json.dumps(values, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(payload).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, with_published: bool = False) -> dict:
+    invalid_cursor_exception = HTTPException(
+        status_code=status.HTTP_400_BAD_REQUEST,
+        detail="Invalid cursor"
+    )
+    try:
+        payload = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        values = json.loads(payload)
+        decoded = {"id": int(values["id"])}
+        if with_published:
+            decoded["published"] = datetime.fromisoformat(values["published"])
+    except (ValueError, TypeError, KeyError):
+        raise invalid_cursor_exception
+    return decoded
+
+
+def set_next_page_link(request: Request, response: Response, cursor: str):
+    # offset is dropped, because cursor already points to the end of current page
+    next_url = request.url.remove_query_params('offset').\
+        include_query_params(after=cursor)
+    response.headers['Link'] = f'<{next_url}>; rel="next"'
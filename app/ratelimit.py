@@ -0,0 +1,139 @@
+import math
+import time
+from collections import OrderedDict
+from typing import Callable, Protocol
+
+from decouple import config
+from fastapi import HTTPException, status
+
+
+# Every login attempt runs bcrypt, so attempts are limited per username
+# and per client address before the password is checked
+LOGIN_RATE_LIMIT_BACKEND = config("LOGIN_RATE_LIMIT_BACKEND", default="memory")
+LOGIN_RATE_LIMIT_REDIS_URL = config("LOGIN_RATE_LIMIT_REDIS_URL",
+                                    default="redis://localhost:6379/0")
+LOGIN_ATTEMPTS_PER_USERNAME = config("LOGIN_ATTEMPTS_PER_USERNAME",
+                                     default=10, cast=int)
+LOGIN_ATTEMPTS_PER_ADDRESS = config("LOGIN_ATTEMPTS_PER_ADDRESS",
+                                    default=100, cast=int)
+RATE_LIMIT_BUCKETS_MAXSIZE = 100_000
+
+
+class RateLimitBackend(Protocol):
+    async def take(self, key: str, capacity: int, refill_per_second: float) -> float:
+        # Takes one token from bucket of the key. Returns 0 if token was taken,
+        # otherwise number of seconds until the bucket has a token again
+        ...
+
+
+class InMemoryRateLimitBackend:
+    # Buckets are kept in memory of the process, so every worker
+    # has its own limits. Least recently used buckets are dropped
+    # when there are too many of them, which only resets their limits
+
+    def __init__(self, maxsize: int = RATE_LIMIT_BUCKETS_MAXSIZE,
+                 timer: Callable[[], float] = time.monotonic):
+        self.maxsize = maxsize
+        self.timer = timer
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+
+    async def take(self, key: str, capacity: int, refill_per_second: float) -> float:
+        now = self.timer()
+        tokens, updated = self._buckets.get(key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * refill_per_second)
+        wait = 0
+        if tokens >= 1:
+            tokens -= 1
+        else:
+            wait = (1 - tokens) / refill_per_second
+        self._buckets[key] = (tokens, now)
+        self._buckets.move_to_end(key)
+        while len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class RedisRateLimitBackend:
+    # Buckets are shared by all workers, the whole check runs
+    # in Redis as one script, so concurrent attempts can not both take
+    # the last token. Requires package redis
+    SCRIPT = """
+    local capacity = tonumber(ARGV[1])
+    local refill_per_second = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+    local tokens = tonumber(bucket[1]) or capacity
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(capacity, tokens + (now - updated) * refill_per_second)
+    local wait = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+    else
+        wait = (1 - tokens) / refill_per_second
+    end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'updated', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(capacity / refill_per_second))
+    return tostring(wait)
+    """
+
+    def __init__(self, url: str):
+        try:
+            from redis import asyncio as redis
+        except ImportError:
+            raise RuntimeError(
+                "Package redis is required for LOGIN_RATE_LIMIT_BACKEND=redis")
+        self.client = redis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+
+    async def take(self, key: str, capacity: int, refill_per_second: float) -> float:
+        return float(await self.script(keys=[f"ratelimit:{key}"],
+                                       args=[capacity, refill_per_second, time.time()]))
+
+
+class TokenBucketLimiter:
+    # Allows bursts of capacity requests, then capacity requests per period
+
+    def __init__(self, backend: RateLimitBackend, name: str,
+                 capacity: int, period_seconds: float = 60):
+        self.backend = backend
+        self.name = name
+        self.capacity = capacity
+        self.refill_per_second = capacity / period_seconds
+
+    async def take(self, key: str) -> float:
+        return await self.backend.take(f"{self.name}:{key}", self.capacity,
+                                       self.refill_per_second)
+
+
+def create_rate_limit_backend(name: str) -> RateLimitBackend:
+    if name == "memory":
+        return InMemoryRateLimitBackend()
+    if name == "redis":
+        return RedisRateLimitBackend(LOGIN_RATE_LIMIT_REDIS_URL)
+    raise ValueError("LOGIN_RATE_LIMIT_BACKEND must be one of ('memory', 'redis')")
+
+
+login_rate_limit_backend = create_rate_limit_backend(LOGIN_RATE_LIMIT_BACKEND)
+login_attempts_by_username = TokenBucketLimiter(login_rate_limit_backend, "login-username",
+                                                LOGIN_ATTEMPTS_PER_USERNAME)
+login_attempts_by_address = TokenBucketLimiter(login_rate_limit_backend, "login-address",
+                                               LOGIN_ATTEMPTS_PER_ADDRESS)
+
+
+async def check_login_rate_limit(username: str, address: str | None):
+    # Address is checked first, so attempts rejected by it
+    # do not use up attempts of the username
+    wait = 0
+    if address is not None:
+        wait = await login_attempts_by_address.take(address)
+    if not wait:
+        wait = await login_attempts_by_username.take(username.lower())
+    if wait:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many login attempts, try again later",
+            headers={"Retry-After": str(math.ceil(wait))}
+        )
@@ -0,0 +1,309 @@
+import json
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Protocol
+from urllib.parse import urlencode
+
+from decouple import config
+from fastapi import Request, Response, status
+from fastapi.routing import APIRoute
+
+from .compression import COMPRESSION_MINIMUM_SIZE, choose_encoding, compress, encoded_etag, \
+    is_compressible
+from .conditional import etag_matches, not_modified_response
+from .serialization import accepts_ndjson
+
+
+# Public GET responses are cached as bytes in memory of each process(LRU bounded
+# by RESPONSE_CACHE_MAXBYTES) and optionally in a backend shared by all workers.
+# Entries belong to groups(for example, comments of one recommendation), write
+# handlers invalidate groups they change. Entries also expire after TTL, so
+# changes made outside the API are seen after it.
+# Generations of groups are kept in the shared backend, without it an invalidation
+# reaches only the process that made the write. So by default responses are cached
+# only with a shared backend, without it the cache is meant for a single worker
+RESPONSE_CACHE_TTL_SECONDS = config("RESPONSE_CACHE_TTL_SECONDS", default=60, cast=float)
+RESPONSE_CACHE_BACKEND = config("RESPONSE_CACHE_BACKEND", default="none")
+RESPONSE_CACHE_MAXBYTES = config(
+    "RESPONSE_CACHE_MAXBYTES",
+    default=0 if RESPONSE_CACHE_BACKEND == "none" else 16 * 1024 * 1024, cast=int)
+RESPONSE_CACHE_REDIS_URL = config("RESPONSE_CACHE_REDIS_URL",
+                                  default="redis://localhost:6379/1")
+# Headers of the response that are cached with its body
+CACHED_HEADERS = ("content-type", "etag", "last-modified", "link", "vary")
+
+
+class SharedCacheBackend(Protocol):
+    async def get(self, key: str) -> bytes | None:
+        ...
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        ...
+
+    async def incr(self, key: str) -> int:
+        # Increments counter of the key, which is never expired, returns new value
+        ...
+
+
+class InMemorySharedCacheBackend:
+    # Stand-in for a shared backend(tests, single process), values are kept
+    # in a dict of the process and are dropped only when they expire
+
+    def __init__(self, timer: Callable[[], float] = time.monotonic):
+        self.timer = timer
+        self._values: dict[str, tuple[float | None, bytes]] = {}
+
+    async def get(self, key: str) -> bytes | None:
+        expires, value = self._values.get(key, (None, None))
+        if expires is not None and expires <= self.timer():
+            del self._values[key]
+            return None
+        return value
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        self._values[key] = (self.timer() + ttl, value)
+
+    async def incr(self, key: str) -> int:
+        value = int(self._values.get(key, (None, b"0"))[1]) + 1
+        self._values[key] = (None, str(value).encode())
+        return value
+
+    def clear(self):
+        self._values.clear()
+
+
+class RedisSharedCacheBackend:
+    # Requires package redis
+    def __init__(self, url: str):
+        try:
+            from redis import asyncio as redis
+        except ImportError:
+            raise RuntimeError(
+                "Package redis is required for RESPONSE_CACHE_BACKEND=redis")
+        self.client = redis.from_url(url)
+
+    async def get(self, key: str) -> bytes | None:
+        return await self.client.get(f"responses:{key}")
+
+    async def set(self, key: str, value: bytes, ttl: float):
+        await self.client.set(f"responses:{key}", value, px=int(ttl * 1000))
+
+    async def incr(self, key: str) -> int:
+        return await self.client.incr(f"responses:{key}")
+
+
+class CachedResponse:
+    def __init__(self, body: bytes, headers: dict[str, str]):
+        self.body = body
+        self.headers = headers
+        # Body compressed with each encoding requested so far, kept only
+        # in memory of the process(shared backend holds uncompressed body)
+        self.encoded_bodies: dict[str, bytes] = {}
+
+    @property
+    def size(self) -> int:
+        return len(self.body) + sum(len(body) for body in self.encoded_bodies.values()) + \
+            sum(len(name) + len(value) for name, value in self.headers.items())
+
+    @classmethod
+    def from_response(cls, response: Response) -> "CachedResponse":
+        return cls(response.body, {name: response.headers[name] for name in CACHED_HEADERS
+                                   if name in response.headers})
+
+    def dumps(self) -> bytes:
+        return json.dumps(self.headers).encode() + b"\n" + self.body
+
+    @classmethod
+    def loads(cls, value: bytes) -> "CachedResponse":
+        headers, body = value.split(b"\n", 1)
+        return cls(body, json.loads(headers))
+
+    def to_response(self, request: Request) -> Response:
+        headers = dict(self.headers)
+        body = self.body
+        encoding = choose_encoding(request.headers.get("accept-encoding", ""))
+        # Vary: Accept-Encoding is added by CompressionMiddleware
+        if is_compressible(headers.get("content-type")):
+            if encoding and len(body) >= COMPRESSION_MINIMUM_SIZE:
+                if encoding not in self.encoded_bodies:
+                    self.encoded_bodies[encoding] = compress(body, encoding)
+                body = self.encoded_bodies[encoding]
+                headers["content-encoding"] = encoding
+                if "etag" in headers:
+                    headers["etag"] = encoded_etag(headers["etag"], encoding)
+        if "etag" in headers and etag_matches(request, self.headers["etag"]):
+            return not_modified_response({name: value for name, value in headers.items()
+                                          if name in ("etag", "last-modified")})
+        return Response(content=body, headers=headers)
+
+
+class ResponseCache:
+    def __init__(self, maxbytes: int = RESPONSE_CACHE_MAXBYTES,
+                 ttl: float = RESPONSE_CACHE_TTL_SECONDS,
+                 shared: SharedCacheBackend | None = None,
+                 timer: Callable[[], float] = time.monotonic):
+        self.maxbytes = maxbytes
+        self.ttl = ttl
+        self.shared = shared
+        self.timer = timer
+        self.bytes = 0
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, CachedResponse]] = OrderedDict()
+        # Generations of groups, used when there is no shared backend
+        self._generations: dict[str, int] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return self.maxbytes > 0 or self.shared is not None
+
+    async def generation(self, group: str) -> int:
+        if self.shared is None:
+            return self._generations.get(group, 0)
+        return int(await self.shared.get(f"generation:{group}") or 0)
+
+    async def key(self, request: Request, group: str) -> str:
+        # Invalidation increments generation of the group, so entries stored before
+        # it are not found anymore(even if they were stored by a request, which read
+        # the database before the write was committed) and are evicted later
+        # Query is encoded again, so values containing "&" or "=" do not
+        # give the key of other parameters
+        query = urlencode(sorted(request.query_params.multi_items()))
+        url = request.url.replace(query=query)
+        return f"{group}:{await self.generation(group)}:{url}"
+
+    async def get(self, key: str) -> CachedResponse | None:
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry[0] > self.timer():
+                self._entries.move_to_end(key)
+                self.local_hits += 1
+                return entry[1]
+            self._remove(key)
+        if self.shared is not None:
+            value = await self.shared.get(key)
+            if value is not None:
+                self.shared_hits += 1
+                cached = CachedResponse.loads(value)
+                self._store(key, cached)
+                return cached
+        self.misses += 1
+        return None
+
+    async def set(self, key: str, cached: CachedResponse):
+        self._store(key, cached)
+        if self.shared is not None:
+            await self.shared.set(key, cached.dumps(), self.ttl)
+
+    async def invalidate(self, *groups: str):
+        for group in groups:
+            if self.shared is None:
+                self._generations[group] = self._generations.get(group, 0) + 1
+            else:
+                await self.shared.incr(f"generation:{group}")
+
+    async def respond(self, request: Request, group: str,
+                      handler: Callable[[Request], Awaitable[Response]]) -> Response:
+        key = await self.key(request, group)
+        cached = await self.get(key)
+        if cached is not None:
+            size = cached.size
+            response = cached.to_response(request)
+            if cached.size != size and key in self._entries:
+                # Compressed body was added to the entry
+                self.bytes += cached.size - size
+                self._evict()
+            return response
+        response = await handler(request)
+        if response.status_code == status.HTTP_200_OK and hasattr(response, "body"):
+            await self.set(key, CachedResponse.from_response(response))
+        return response
+
+    def _store(self, key: str, cached: CachedResponse):
+        if cached.size > self.maxbytes:
+            return
+        self._remove(key)
+        self._entries[key] = (self.timer() + self.ttl, cached)
+        self.bytes += cached.size
+        self._evict()
+
+    def _evict(self):
+        while self.bytes > self.maxbytes:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[1].size
+
+    def clear(self):
+        self._entries.clear()
+        self._generations.clear()
+        self.bytes = 0
+        self.local_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        hits = self.local_hits + self.shared_hits
+        requests = hits + self.misses
+        return {"local_hits": self.local_hits, "shared_hits": self.shared_hits,
+                "misses": self.misses, "hit_ratio": hits / requests if requests else 0.0,
+                "bytes": self.bytes, "maxbytes": self.maxbytes,
+                "entries": len(self._entries)}
+
+
+def create_shared_cache_backend(name: str) -> SharedCacheBackend | None:
+    if name == "none":
+        return None
+    if name == "memory":
+        return InMemorySharedCacheBackend()
+    if name == "redis":
+        return RedisSharedCacheBackend(RESPONSE_CACHE_REDIS_URL)
+    raise ValueError("RESPONSE_CACHE_BACKEND must be one of ('none', 'memory', 'redis')")
+
+
+response_cache = ResponseCache(shared=create_shared_cache_backend(RESPONSE_CACHE_BACKEND))
+
+
+def recommendation_cache_groups(recommendation_id: int, *children: str) -> tuple[str, ...]:
+    # Lists and details of recommendations show counters of comments and reactions,
+    # so they are invalidated together with comments and reactions
+    return ("recommendations", f"recommendation:{recommendation_id}",
+            *(f"{child}:{recommendation_id}" for child in children))
+
+
+async def invalidate_responses(*groups: str):
+    # Called by write handlers after commit
+    await response_cache.invalidate(*groups)
+
+
+def cache_response(group: str):
+    # Marks GET endpoint, which response is the same for every caller.
+    # group is formatted with path parameters of the request
+    def decorator(endpoint):
+        endpoint.response_cache_group = group
+        return endpoint
+    return decorator
+
+
+class CachedRoute(APIRoute):
+    # Route class of routers with cached endpoints
+    def get_route_handler(self):
+        handler = super().get_route_handler()
+        group = getattr(self.endpoint, "response_cache_group", None)
+        if group is None:
+            return handler
+
+        async def cached_handler(request: Request) -> Response:
+            # Streamed responses have no body to cache
+            if not response_cache.enabled or accepts_ndjson(request):
+                return await handler(request)
+            # Ids in path are normalized, so that /recommendations/05 is invalidated too
+            # (isdecimal, because int() does not accept all digits, for example "²")
+            path_params = {name: int(value) if value.isdecimal() else value
+                           for name, value in request.path_params.items()}
+            return await response_cache.respond(request, group.format(**path_params), handler)
+
+        return cached_handler
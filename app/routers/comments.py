@@ -1,45 +1,107 @@
 from datetime import datetime
 from typing import Annotated
 
-from fastapi import APIRouter, Body, Path, HTTPException, status, Depends, Query
-from sqlmodel import Session
+from fastapi import APIRouter, Body, Path, HTTPException, status, Depends, Query, Request, Response
+from sqlalchemy.exc import IntegrityError
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from ..auth import get_current_user
-from ..crud import get_recommendation_by_id, get_comment_by_id_and_recommendation_id, \
-    get_all_comments_for_recommendation
+from ..auth import get_current_user_id
+from ..response_cache import CachedRoute, cache_response, invalidate_responses,\
+    recommendation_cache_groups
+from ..conditional import make_etag, validator_headers, etag_matches, not_modified_response
+from ..crud import get_comment_and_check_recommendation, \
+    get_all_comments_for_recommendation, update_recommendation_counters, update_user_row,\
+    delete_user_row, recommendation_exists, comment_page_statement, stream_partitions,\
+    violates_recommendation_foreign_key
+from ..serialization import FAST_JSON_RESPONSES, fast_json_response, serialize_comment,\
+    accepts_ndjson, ndjson_response
 from ..schemas import CommentRead, CommentCreate, CommentUpdate
-from ..models import Comment, User
+from ..models import Comment
 from ..database import get_session
+from ..pagination import encode_cursor, decode_cursor, set_next_page_link
 
 
 router = APIRouter(
-    tags=['comments']
+    tags=['comments'],
+    route_class=CachedRoute
 )
 
+# Content of a comment is changed only together with its updated date,
+# so validators of comments do not need to read the content
+COMMENT_VALIDATOR_FIELDS = ("id", "published", "updated")
+
+
+def comment_validators(request: Request, comments: list[Comment]) -> dict:
+    etag = make_etag(request, [(comment.id, comment.published, comment.updated)
+                               for comment in comments])
+    last_modified = max((comment.updated or comment.published for comment in comments),
+                        default=None)
+    return validator_headers(etag, last_modified)
+
 
 @router.get('/recommendations/{recommendation_id}/comments',
             response_model=list[CommentRead])
+@cache_response('comments:{recommendation_id}')
 async def get_comments(*,
                        recommendation_id: Annotated[int, Path()],
-                       session: Annotated[Session, Depends(get_session)],
+                       session: Annotated[AsyncSession, Depends(get_session)],
                        by_published_date_descending: Annotated[bool | None, Query(
                        )] = None,
                        offset: Annotated[int | None, Query(gt=0)] = None,
-                       limit: Annotated[int | None, Query(gt=0)] = None
+                       limit: Annotated[int | None, Query(gt=0)] = None,
+                       after: Annotated[str | None, Query()] = None,
+                       request: Request,
+                       response: Response
                        ):
-    recommendation = get_recommendation_by_id(session=session,
-                                              recommendation_id=recommendation_id)
-    if not recommendation:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Recommendation with id {recommendation_id} was not found"
+    # Comments ordered by published date are paginated by (published, id)
+    by_published_date = by_published_date_descending is not None
+    cursor = decode_cursor(after, with_published=by_published_date) \
+        if after else {}
+
+    if accepts_ndjson(request):
+        # Comments are streamed as they are fetched, without validators and link
+        # of the next page, which would require the whole result
+        if not await recommendation_exists(session, recommendation_id):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Recommendation with id {recommendation_id} was not found"
+            )
+        statement = comment_page_statement(
+            recommendation_id, by_published_date_descending, offset, limit,
+            after_id=cursor.get("id"), after_published=cursor.get("published"))
+        return ndjson_response(serialize_comment, stream_partitions(session, statement))
+
+    async def get_page(fields: tuple[str, ...] | None = None) -> list[Comment]:
+        found, comments = await get_all_comments_for_recommendation(
+            session=session, recommendation_id=recommendation_id,
+            by_published_date_descending=by_published_date_descending,
+            offset=offset, limit=limit, after_id=cursor.get("id"),
+            after_published=cursor.get("published"), fields=fields
         )
-    comments = get_all_comments_for_recommendation(
-        session=session, recommendation_id=recommendation_id,
-        by_published_date_descending=by_published_date_descending,
-        offset=offset, limit=limit
-    )
-    return comments
+        if not found:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Recommendation with id {recommendation_id} was not found"
+            )
+        return comments
+
+    if request.headers.get("if-none-match"):
+        # Client has a cached page: it is checked by ids and dates only
+        headers = comment_validators(request, await get_page(COMMENT_VALIDATOR_FIELDS))
+        if etag_matches(request, headers["ETag"]):
+            return not_modified_response(headers)
+    comments = await get_page()
+    if FAST_JSON_RESPONSES:
+        response = fast_json_response(serialize_comment, comments)
+    response.headers.update(comment_validators(request, comments))
+    response.headers["Vary"] = "Accept"
+    if limit and len(comments) == limit:
+        last_comment = comments[-1]
+        set_next_page_link(request, response, encode_cursor(
+            id=last_comment.id,
+            published=last_comment.published if by_published_date else None
+        ))
+    return response if FAST_JSON_RESPONSES else comments
 
 
 @router.post('/recommendations/{recommendation_id}/comments',
@@ -47,51 +109,70 @@ async def get_comments(*,
              status_code=status.HTTP_201_CREATED)
 async def post_comment(
     recommendation_id: Annotated[int, Path()],
-    current_user: Annotated[User, Depends(get_current_user)],
-    session: Annotated[Session, Depends(get_session)],
+    current_user_id: Annotated[int, Depends(get_current_user_id)],
+    session: Annotated[AsyncSession, Depends(get_session)],
     data: Annotated[CommentCreate, Body()]
 ):
-    recommendation = get_recommendation_by_id(
-        session=session, recommendation_id=recommendation_id
+    # Recommendation is not looked up: the INSERT fails on its foreign key,
+    # if the recommendation does not exist. All columns of the comment are set
+    # here or returned by the INSERT(id), so it is not refreshed after commit
+    new_comment = Comment(
+        content=data.content,
+        recommendation_id=recommendation_id,
+        user_id=current_user_id
     )
-    if not recommendation:
+    session.add(new_comment)
+    try:
+        await update_recommendation_counters(session=session,
+                                             recommendation_id=recommendation_id,
+                                             comment_count=1)
+        await session.commit()
+    except IntegrityError as error:
+        await session.rollback()
+        if not await violates_recommendation_foreign_key(session, error, Comment,
+                                                         recommendation_id):
+            raise
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Recommendation with id {recommendation_id} was not found"
         )
-    new_comment = Comment(
-        content=data.content,
-        recommendation_id=recommendation.id,
-        user_id=current_user.id
-    )
-    session.add(new_comment)
-    session.commit()
-    session.refresh(new_comment)
+    await invalidate_responses(*recommendation_cache_groups(recommendation_id, "comments"))
     return new_comment
 
 
 @router.get('/recommendations/{recommendation_id}/comments/{comment_id}',
             response_model=CommentRead)
+@cache_response('comments:{recommendation_id}')
 async def get_comment(recommendation_id: Annotated[int, Path()],
                       comment_id: Annotated[int, Path()],
-                      session: Annotated[Session, Depends(get_session)]):
-    recommendation = get_recommendation_by_id(session=session,
-                                              recommendation_id=recommendation_id)
-    if not recommendation:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Recommendation with id {recommendation_id } was not found"
-        )
-    comment = get_comment_by_id_and_recommendation_id(
-        session=session,
-        recommendation_id=recommendation_id,
-        comment_id=comment_id
-    )
-    if not comment:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Comment with id {comment_id} for recommendation with id {recommendation_id} was not found"
+                      session: Annotated[AsyncSession, Depends(get_session)],
+                      request: Request,
+                      response: Response):
+    async def get(fields: tuple[str, ...] | None = None) -> Comment:
+        found, comment = await get_comment_and_check_recommendation(
+            session=session,
+            recommendation_id=recommendation_id,
+            comment_id=comment_id,
+            fields=fields
         )
+        if not found:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Recommendation with id {recommendation_id} was not found"
+            )
+        if not comment:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Comment with id {comment_id} for recommendation with id {recommendation_id} was not found"
+            )
+        return comment
+
+    if request.headers.get("if-none-match"):
+        headers = comment_validators(request, [await get(COMMENT_VALIDATOR_FIELDS)])
+        if etag_matches(request, headers["ETag"]):
+            return not_modified_response(headers)
+    comment = await get()
+    response.headers.update(comment_validators(request, [comment]))
     return comment
 
 
@@ -99,39 +180,37 @@ async def get_comment(recommendation_id: Annotated[int, Path()],
             response_model=CommentRead)
 async def update_comment(recommendation_id: Annotated[int, Path()],
                          comment_id: Annotated[int, Path()],
-                         session: Annotated[Session, Depends(get_session)],
+                         session: Annotated[AsyncSession, Depends(get_session)],
                          data: Annotated[CommentUpdate, Body()],
-                         current_user: Annotated[User, Depends(get_current_user)]):
-    recommendation = get_recommendation_by_id(session=session,
-                                              recommendation_id=recommendation_id)
-    if not recommendation:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Recommendation with id {recommendation_id} was not found"
-        )
-    comment = get_comment_by_id_and_recommendation_id(
-        session=session,
-        recommendation_id=recommendation_id,
-        comment_id=comment_id
-    )
+                         current_user_id: Annotated[int, Depends(get_current_user_id)]):
+    values = {"updated": datetime.utcnow()}
+    if data.content:
+        values["content"] = data.content
+    comment = await update_user_row(session, Comment, comment_id, current_user_id,
+                                    values, Comment.recommendation_id == recommendation_id)
     if not comment:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Comment with id {comment_id} for recommendation with id {recommendation_id} was not found"
+        # Nothing was updated, one more query tells why
+        found, comment = await get_comment_and_check_recommendation(
+            session=session,
+            recommendation_id=recommendation_id,
+            comment_id=comment_id
         )
-    if comment.user_id != current_user.id:
+        if not found:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Recommendation with id {recommendation_id} was not found"
+            )
+        if not comment:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Comment with id {comment_id} for recommendation with id {recommendation_id} was not found"
+            )
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=f"User has no permission to update comment with id {comment_id}"
         )
-    data: dict = data.dict()
-    new_content = data.get('content')
-    if new_content:
-        comment.content = new_content
-    comment.updated = datetime.utcnow()
-    session.add(comment)
-    session.commit()
-    session.refresh(comment)
+    await session.commit()
+    await invalidate_responses(f"comments:{recommendation_id}")
     return comment
 
 
@@ -140,31 +219,35 @@ async def update_comment(recommendation_id: Annotated[int, Path()],
 async def delete_comment(
     recommendation_id: Annotated[int, Path()],
     comment_id: Annotated[int, Path()],
-    session: Annotated[Session, Depends(get_session)],
-    current_user: Annotated[User, Depends(get_current_user)]
+    session: Annotated[AsyncSession, Depends(get_session)],
+    current_user_id: Annotated[int, Depends(get_current_user_id)]
 ):
-    recommendation = get_recommendation_by_id(session=session,
-                                              recommendation_id=recommendation_id)
-    if not recommendation:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Recommendation with id {recommendation_id} was not found"
-        )
-    comment = get_comment_by_id_and_recommendation_id(
-        session=session,
-        recommendation_id=recommendation_id,
-        comment_id=comment_id
-    )
-    if not comment:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Comment with id {comment_id} for recommendation with id {recommendation_id} was not found"
+    deleted_comment = await delete_user_row(session, Comment, comment_id, current_user_id,
+                                            Comment.recommendation_id == recommendation_id)
+    if not deleted_comment:
+        # Nothing was deleted, one more query tells why
+        found, comment = await get_comment_and_check_recommendation(
+            session=session,
+            recommendation_id=recommendation_id,
+            comment_id=comment_id
         )
-    if comment.user_id != current_user.id:
+        if not found:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Recommendation with id {recommendation_id} was not found"
+            )
+        if not comment:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Comment with id {comment_id} for recommendation with id {recommendation_id} was not found"
+            )
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=f"User has no permission to delete comment with id {comment_id}"
         )
-    session.delete(comment)
-    session.commit()
+    await update_recommendation_counters(session=session,
+                                         recommendation_id=recommendation_id,
+                                         comment_count=-1)
+    await session.commit()
+    await invalidate_responses(*recommendation_cache_groups(recommendation_id, "comments"))
     return None
@@ -1,43 +1,100 @@
 from typing import Annotated
 from datetime import datetime
 
-from fastapi import APIRouter, Body, Depends, status, HTTPException, Path, Query
-from sqlmodel import Session, select
+from fastapi import APIRouter, Body, Depends, status, HTTPException, Path, Query, Request, Response
+from sqlalchemy.exc import IntegrityError
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from ..auth import get_current_user
+from ..auth import get_current_user_id
+from ..response_cache import CachedRoute, cache_response, invalidate_responses,\
+    recommendation_cache_groups
+from ..conditional import make_etag, validator_headers, etag_matches, not_modified_response
 from ..database import get_session
+from ..pagination import encode_cursor, decode_cursor, set_next_page_link
+from ..serialization import FAST_JSON_RESPONSES, fast_json_response, serialize_reaction,\
+    accepts_ndjson, ndjson_response
 from ..schemas import ReactionCreate, ReactionRead, ReactionUpdate
-from ..models import User, Reaction
-from ..crud import get_reaction_by_recommendation_id_and_user_id, get_recommendation_by_id,\
-    get_all_reactions_for_recommendation, get_reaction_by_id_and_recommendation_id
+from ..models import Reaction
+from ..crud import get_user_reaction_and_check_recommendation, get_all_reactions_for_recommendation,\
+    get_reaction_and_check_recommendation, update_recommendation_counters, update_user_row,\
+    delete_user_row, upsert_user_reaction, delete_user_reaction, recommendation_exists,\
+    reaction_page_statement, stream_partitions, violates_recommendation_foreign_key,\
+    violated_constraint
 
 
 router = APIRouter(
-    tags=['reactions']
+    tags=['reactions'],
+    route_class=CachedRoute
 )
 
 
+# Unique constraint of reaction(PostgreSQL reports its name)
+# and columns it covers(SQLite reports "table.column, ...")
+DUPLICATE_REACTION_CONSTRAINTS = (
+    "user_recommendation_uc",
+    "reaction.user_id, reaction.recommendation_id",
+)
+
+
+def reaction_validators(request: Request, reactions: list[Reaction]) -> dict:
+    # Reactions are a few small columns without dates, so validators are computed
+    # from fetched reactions and a match saves serialization of the response.
+    # User and recommendation of a reaction never change
+    return validator_headers(make_etag(request, [(reaction.id, reaction.is_positive)
+                                                 for reaction in reactions]))
+
+
+def reaction_counter_deltas(is_positive: bool, delta: int) -> dict:
+    if is_positive:
+        return {"positive_reactions": delta}
+    return {"negative_reactions": delta}
+
+
 @router.get('/recommendations/{recommendation_id}/reactions',
             response_model=list[ReactionRead])
+@cache_response('reactions:{recommendation_id}')
 async def get_reactions(*,
                         recommendation_id: Annotated[int, Path()],
                         is_positive: Annotated[bool | None, Query()] = None,
-                        session: Annotated[Session, Depends(get_session)],
+                        session: Annotated[AsyncSession, Depends(get_session)],
                         offset: Annotated[int | None, Query(gt=0)] = None,
-                        limit: Annotated[int | None, Query(gt=0)] = None
+                        limit: Annotated[int | None, Query(gt=0)] = None,
+                        after: Annotated[str | None, Query()] = None,
+                        request: Request,
+                        response: Response
                         ):
-    recommendation = get_recommendation_by_id(session=session,
-                                              recommendation_id=recommendation_id)
-    if not recommendation:
+    after_id = decode_cursor(after)["id"] if after else None
+    if accepts_ndjson(request):
+        # Reactions are streamed as they are fetched, without validators and link of the next page
+        if not await recommendation_exists(session, recommendation_id):
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Recommendation with id {recommendation_id} was not found"
+            )
+        statement = reaction_page_statement(recommendation_id, is_positive, offset, limit,
+                                            after_id)
+        return ndjson_response(serialize_reaction, stream_partitions(session, statement))
+    found, reactions = await get_all_reactions_for_recommendation(
+        session=session, recommendation_id=recommendation_id,
+        is_positive=is_positive, offset=offset, limit=limit,
+        after_id=after_id
+    )
+    if not found:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Recommendation with id {recommendation_id} was not found"
         )
-    reactions = get_all_reactions_for_recommendation(
-        session=session, recommendation_id=recommendation_id,
-        is_positive=is_positive, offset=offset, limit=limit
-    )
-    return reactions
+    headers = reaction_validators(request, reactions)
+    if etag_matches(request, headers["ETag"]):
+        return not_modified_response(headers)
+    if FAST_JSON_RESPONSES:
+        response = fast_json_response(serialize_reaction, reactions)
+    response.headers.update(headers)
+    response.headers["Vary"] = "Accept"
+    if limit and len(reactions) == limit:
+        set_next_page_link(request, response,
+                           encode_cursor(id=reactions[-1].id))
+    return response if FAST_JSON_RESPONSES else reactions
 
 
 @router.post('/recommendations/{recommendation_id}/reactions',
@@ -45,63 +102,141 @@ async def get_reactions(*,
              status_code=status.HTTP_201_CREATED)
 async def post_reaction(
     recommendation_id: Annotated[int, Path()],
-    current_user: Annotated[User, Depends(get_current_user)],
-    session: Annotated[Session, Depends(get_session)],
+    current_user_id: Annotated[int, Depends(get_current_user_id)],
+    session: Annotated[AsyncSession, Depends(get_session)],
     data: Annotated[ReactionCreate, Body()]
 ):
-    recommendation = get_recommendation_by_id(session=session,
-                                              recommendation_id=recommendation_id)
-    if not recommendation:
+    found, existing_reaction = await get_user_reaction_and_check_recommendation(
+        session=session,
+        recommendation_id=recommendation_id,
+        user_id=current_user_id
+    )
+    if not found:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Recommendation with id {recommendation_id} was not found"
         )
-    existing_reaction = get_reaction_by_recommendation_id_and_user_id(
-        session=session,
-        recommendation_id=recommendation.id,
-        user_id=current_user.id
+    duplicate_reaction_exception = HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail=f"User already has a reaction for recommendation with id {recommendation_id}, creating another one will create conflict"
     )
     if existing_reaction:
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail=f"User already has a reaction for recommendation with id {recommendation_id}, creating another one will create conflict"
-        )
+        raise duplicate_reaction_exception
 
+    # All columns of the reaction are set here or returned by the INSERT(id),
+    # so it is not refreshed after commit
     new_reaction = Reaction(
         is_positive=data.is_positive,
-        recommendation_id=recommendation.id,
-        user_id=current_user.id
+        recommendation_id=recommendation_id,
+        user_id=current_user_id
     )
     session.add(new_reaction)
-    session.commit()
-    session.refresh(new_reaction)
+    try:
+        await update_recommendation_counters(
+            session=session, recommendation_id=recommendation_id,
+            **reaction_counter_deltas(data.is_positive, 1)
+        )
+        await session.commit()
+    except IntegrityError as error:
+        # Concurrent request could have created the reaction
+        # or deleted the recommendation after the lookup
+        await session.rollback()
+        if violated_constraint(error) in DUPLICATE_REACTION_CONSTRAINTS:
+            raise duplicate_reaction_exception
+        if not await violates_recommendation_foreign_key(session, error, Reaction,
+                                                         recommendation_id):
+            raise
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Recommendation with id {recommendation_id} was not found"
+        )
+    await invalidate_responses(*recommendation_cache_groups(recommendation_id, "reactions"))
     return new_reaction
 
 
+# Declared before '/reactions/{reaction_id}', so that "me" is not taken for reaction id
+@router.put('/recommendations/{recommendation_id}/reactions/me',
+            response_model=ReactionRead,
+            responses={status.HTTP_201_CREATED: {"model": ReactionRead},
+                       status.HTTP_204_NO_CONTENT: {"description": "Reaction was toggled off"}})
+async def put_my_reaction(
+    recommendation_id: Annotated[int, Path()],
+    session: Annotated[AsyncSession, Depends(get_session)],
+    data: Annotated[ReactionUpdate, Body()],
+    current_user_id: Annotated[int, Depends(get_current_user_id)],
+    response: Response,
+    toggle: Annotated[bool, Query()] = False
+):
+    # Creates or changes reaction of the current user with one write and without
+    # looking up its id. With toggle=true the same reaction sent again is deleted
+    if toggle and await delete_user_reaction(session, recommendation_id, current_user_id,
+                                             data.is_positive):
+        await update_recommendation_counters(
+            session=session, recommendation_id=recommendation_id,
+            **reaction_counter_deltas(data.is_positive, -1)
+        )
+        await session.commit()
+        await invalidate_responses(*recommendation_cache_groups(recommendation_id, "reactions"))
+        return Response(status_code=status.HTTP_204_NO_CONTENT)
+    try:
+        reaction, created = await upsert_user_reaction(session, recommendation_id,
+                                                       current_user_id, data.is_positive)
+    except IntegrityError as error:
+        await session.rollback()
+        if not await violates_recommendation_foreign_key(session, error, Reaction,
+                                                         recommendation_id):
+            raise
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"Recommendation with id {recommendation_id} was not found"
+        )
+    if not reaction:
+        # Reaction already has this value
+        _, reaction = await get_user_reaction_and_check_recommendation(
+            session=session, recommendation_id=recommendation_id,
+            user_id=current_user_id
+        )
+        return reaction
+    deltas = reaction_counter_deltas(data.is_positive, 1)
+    if created:
+        response.status_code = status.HTTP_201_CREATED
+    else:
+        deltas.update(reaction_counter_deltas(not data.is_positive, -1))
+    await update_recommendation_counters(session=session, recommendation_id=recommendation_id,
+                                         **deltas)
+    await session.commit()
+    await invalidate_responses(*recommendation_cache_groups(recommendation_id, "reactions"))
+    return reaction
+
+
 @router.get('/recommendations/{recommendation_id}/reactions/{reaction_id}',
             response_model=ReactionRead)
+@cache_response('reactions:{recommendation_id}')
 async def get_reaction(
     recommendation_id: Annotated[int, Path()],
     reaction_id: Annotated[int, Path()],
-    session: Annotated[Session, Depends(get_session)]
+    session: Annotated[AsyncSession, Depends(get_session)],
+    request: Request,
+    response: Response
 ):
-    recommendation = get_recommendation_by_id(
-        session=session, recommendation_id=recommendation_id
+    found, reaction = await get_reaction_and_check_recommendation(
+        session=session, recommendation_id=recommendation_id,
+        reaction_id=reaction_id
     )
-    if not recommendation:
+    if not found:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Recommendation with id {recommendation_id} was not found"
         )
-    reaction = get_reaction_by_id_and_recommendation_id(
-        session=session, recommendation_id=recommendation_id,
-        reaction_id=reaction_id
-    )
     if not reaction:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Reaction with id {reaction_id} for recommendation with id {recommendation_id} was not found"
         )
+    headers = reaction_validators(request, [reaction])
+    if etag_matches(request, headers["ETag"]):
+        return not_modified_response(headers)
+    response.headers.update(headers)
     return reaction
 
 
@@ -110,39 +245,47 @@ async def get_reaction(
 async def update_reaction(
     recommendation_id: Annotated[int, Path()],
     reaction_id: Annotated[int, Path()],
-    session: Annotated[Session, Depends(get_session)],
+    session: Annotated[AsyncSession, Depends(get_session)],
     data: Annotated[ReactionUpdate, Body()],
-    current_user: Annotated[User, Depends(get_current_user)]
+    current_user_id: Annotated[int, Depends(get_current_user_id)]
 ):
-    recommendation = get_recommendation_by_id(
-        session=session,
-        recommendation_id=recommendation_id
+    # Row is updated only if reaction changes, so updated row means that
+    # counters of recommendation have to be moved from one reaction to another
+    new_is_positive = data.is_positive
+    reaction = await update_user_row(session, Reaction, reaction_id, current_user_id,
+                                     {"is_positive": new_is_positive},
+                                     Reaction.recommendation_id == recommendation_id,
+                                     Reaction.is_positive != new_is_positive)
+    if reaction:
+        await update_recommendation_counters(
+            session=session, recommendation_id=recommendation_id,
+            **reaction_counter_deltas(not new_is_positive, -1),
+            **reaction_counter_deltas(new_is_positive, 1)
+        )
+        await session.commit()
+        await invalidate_responses(*recommendation_cache_groups(recommendation_id, "reactions"))
+        return reaction
+    # Nothing was updated, one more query tells why
+    found, reaction = await get_reaction_and_check_recommendation(
+        session=session, recommendation_id=recommendation_id,
+        reaction_id=reaction_id
     )
-    if not recommendation:
+    if not found:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Recommendation with id {recommendation_id} was not found"
         )
-    reaction = get_reaction_by_id_and_recommendation_id(
-        session=session, recommendation_id=recommendation_id,
-        reaction_id=reaction_id
-    )
     if not reaction:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"Reaction with id {reaction_id} for recommendation with id {recommendation_id} was not found"
         )
-    if reaction.user_id != current_user.id:
+    if reaction.user_id != current_user_id:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=f"User has no permission to update reaction with id {reaction_id}"
         )
-    data: dict = data.dict()
-    new_is_positive = data.get("is_positive")
-    reaction.is_positive = new_is_positive
-    session.add(reaction)
-    session.commit()
-    session.refresh(reaction)
+    # Reaction already has this value
     return reaction
 
 
@@ -152,31 +295,36 @@ async def update_reaction(
 async def delete_reaction(
     recommendation_id: Annotated[int, Path()],
     reaction_id: Annotated[int, Path()],
-    session: Annotated[Session, Depends(get_session)],
-    current_user: Annotated[User, Depends(get_current_user)]
+    session: Annotated[AsyncSession, Depends(get_session)],
+    current_user_id: Annotated[int, Depends(get_current_user_id)]
 ):
-    recommendation = get_recommendation_by_id(
-        session=session, recommendation_id=recommendation_id
-    )
-    if not recommendation:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Recommendation with id {recommendation_id} was not found"
+    deleted_reaction = await delete_user_row(session, Reaction, reaction_id, current_user_id,
+                                             Reaction.recommendation_id == recommendation_id,
+                                             returning=(Reaction.is_positive,))
+    if not deleted_reaction:
+        # Nothing was deleted, one more query tells why
+        found, reaction = await get_reaction_and_check_recommendation(
+            session=session, recommendation_id=recommendation_id,
+            reaction_id=reaction_id
         )
-    reaction = get_reaction_by_id_and_recommendation_id(
-        session=session, recommendation_id=recommendation_id,
-        reaction_id=reaction_id
-    )
-    if not reaction:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Reaction with id {reaction_id} for recommendation with id {recommendation_id} was not found"
-        )
-    if reaction.user_id != current_user.id:
+        if not found:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Recommendation with id {recommendation_id} was not found"
+            )
+        if not reaction:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Reaction with id {reaction_id} for recommendation with id {recommendation_id} was not found"
+            )
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=f"User has no permission to delete reaction with id {reaction_id}"
         )
-    session.delete(reaction)
-    session.commit()
+    await update_recommendation_counters(
+        session=session, recommendation_id=recommendation_id,
+        **reaction_counter_deltas(deleted_reaction.is_positive, -1)
+    )
+    await session.commit()
+    await invalidate_responses(*recommendation_cache_groups(recommendation_id, "reactions"))
     return None
@@ -1,73 +1,221 @@
 from typing import Annotated
 from datetime import datetime
-from fastapi import APIRouter, Body, Depends, status, HTTPException, Path, Query
-from sqlmodel import Session, select
-from ..auth import get_current_user
+from fastapi import APIRouter, Body, Depends, status, HTTPException, Path, Query, Request, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+from ..auth import get_current_user_id
+from ..response_cache import CachedRoute, cache_response, invalidate_responses,\
+    recommendation_cache_groups
+from ..conditional import make_etag, validator_headers, etag_matches, not_modified_response
+from ..cache import fiction_types_by_name, fiction_type_ids_by_slug, tag_ids_by_name
 from ..database import get_session
-from ..schemas import RecommendationCreate, RecommendationRead, RecommendationUpdate
-from ..models import Tag, User, Recommendation, FictionType
+from ..pagination import encode_cursor, decode_cursor, set_next_page_link
+from ..serialization import FAST_JSON_RESPONSES, fast_json_response, recommendation_serializer,\
+    accepts_ndjson, ndjson_response, NDJSON_MEDIA_TYPE
+from ..schemas import RecommendationCreate, RecommendationRead, RecommendationUpdate,\
+    RecommendationSummary, recommendation_read_model
+from ..models import Tag, Recommendation, FictionType
 from ..crud import get_recommendation_by_id_with_tags_and_fiction_type, get_fiction_type_by_slug,\
-    get_all_recommendations, get_recommendations_by_fiction_type, get_recommendation_by_id
+    get_all_recommendations, get_recommendations_by_fiction_type, get_recommendation_by_id,\
+    get_tags_by_names, insert_tags_ignoring_duplicates, get_recommendation_summaries, attach_cached,\
+    update_user_row, delete_user_row, replace_recommendation_tags, get_tags_of_recommendation, load_fiction_types,\
+    stream_recommendations
 
 
 router = APIRouter(
-    tags=['recommendations']
+    tags=['recommendations'],
+    route_class=CachedRoute
 )
 
+MAX_SUMMARY_IDS = 300
 
-def save_tags(session: Session, tags: [str]) -> list[Tag]:
-    tag_objects = []
-    for tag in tags:
-        tag: str = tag.strip().replace(' ', '-').lower()
-        existing_tag = session.exec(
-            select(Tag).where(Tag.name == tag)).first()
-        if existing_tag:
-            tag_objects.append(existing_tag)
-        else:
-            new_tag = Tag(name=tag)
-            # There is no need to save new tags with session.add(), session.commit(),
-            # as because tags are related to recommendation, when saving recommendation, all
-            # tags will be automatically saved
-            tag_objects.append(new_tag)
+# Every change of RecommendationRead changes one of these columns: PATCH sets
+# updated(tags included), comments and reactions change counters
+RECOMMENDATION_VALIDATOR_FIELDS = ("id", "published", "updated", "positive_reactions",
+                                   "negative_reactions", "comment_count")
+
+
+def normalize_tag_names(tags: list[str]) -> list[str]:
+    # dict keeps order of tags and drops duplicates that appear after normalization
+    return list(dict.fromkeys(tag.strip().replace(' ', '-').lower() for tag in tags))
+
+
+def parse_fields(fields: str | None) -> tuple[str, ...] | None:
+    if not fields:
+        return None
+    names = {name.strip() for name in fields.split(',') if name.strip()}
+    unknown_names = names - RecommendationRead.__fields__.keys()
+    if unknown_names:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Unknown fields: {', '.join(sorted(unknown_names))}"
+        )
+    # id is always returned, it is needed for cursors and links.
+    # Fields follow order of RecommendationRead, so the same fieldset
+    # always gets the same response model
+    names.add('id')
+    return tuple(name for name in RecommendationRead.__fields__ if name in names)
+
+
+def sparse_response(content: Recommendation | list[Recommendation],
+                    fields: tuple[str, ...]) -> JSONResponse:
+    # Response model depends on query, so it can not be declared in decorator,
+    # only fields of the model are read from recommendations(others are not loaded)
+    model = recommendation_read_model(fields)
+    if isinstance(content, list):
+        data = [model.from_orm(recommendation) for recommendation in content]
+    else:
+        data = model.from_orm(content)
+    return JSONResponse(jsonable_encoder(data))
+
+
+def recommendation_validators(request: Request, recommendation: Recommendation) -> dict:
+    etag = make_etag(request, [getattr(recommendation, name)
+                               for name in RECOMMENDATION_VALIDATOR_FIELDS])
+    return validator_headers(etag, recommendation.updated or recommendation.published)
 
-    return tag_objects
 
+async def save_tags(session: AsyncSession, tags: list[str]) -> list[Tag]:
+    names = normalize_tag_names(tags)
+    tags_by_name = {}
+    for name in names:
+        tag_id = tag_ids_by_name.get(name)
+        if tag_id is not None:
+            tags_by_name[name] = await attach_cached(session, Tag(id=tag_id, name=name))
+    missing_names = [name for name in names if name not in tags_by_name]
+    if missing_names:
+        existing_tags = await get_tags_by_names(session=session, names=missing_names)
+        for tag in existing_tags:
+            tag_ids_by_name.set(tag.name, tag.id)
+            tags_by_name[tag.name] = tag
+        missing_names = [name for name in missing_names
+                         if name not in tags_by_name]
+    if missing_names:
+        for name in missing_names:
+            # New tags are cached on the next lookup, when their
+            # transaction is committed, here only stale entries are dropped
+            tag_ids_by_name.invalidate(name)
+        new_tags = await insert_tags_ignoring_duplicates(session=session,
+                                                         names=missing_names)
+        tags_by_name.update((tag.name, tag) for tag in new_tags)
+        # Tags inserted by concurrent request(or all new tags, if database
+        # does not support RETURNING) are read in one more query
+        missing_names = [name for name in missing_names
+                         if name not in tags_by_name]
+        if missing_names:
+            tags_by_name.update((tag.name, tag) for tag in
+                                await get_tags_by_names(session=session, names=missing_names))
+    return [tags_by_name[name] for name in names]
 
-def save_fiction_type(session: Session, fiction_type: str) -> FictionType:
+
+async def save_fiction_type(session: AsyncSession, fiction_type: str) -> FictionType:
     fiction_type = fiction_type.strip().lower()
-    existing_fiction_type_object = session.exec(select(FictionType).
-                                                where(FictionType.name == fiction_type)).first()
+    cached_fiction_type = fiction_types_by_name.get(fiction_type)
+    if cached_fiction_type is not None:
+        fiction_type_id, fiction_type_slug = cached_fiction_type
+        return await attach_cached(session, FictionType(id=fiction_type_id,
+                                                        name=fiction_type,
+                                                        slug=fiction_type_slug))
+    existing_fiction_type_object = (await session.exec(select(FictionType).
+                                                       where(FictionType.name == fiction_type))).first()
     if existing_fiction_type_object:
+        fiction_types_by_name.set(fiction_type, (existing_fiction_type_object.id,
+                                                 existing_fiction_type_object.slug))
         return existing_fiction_type_object
     else:
         fiction_type_slug = fiction_type.replace(' ', '-')
+        fiction_types_by_name.invalidate(fiction_type)
+        fiction_type_ids_by_slug.invalidate(fiction_type_slug)
         new_fiction_type_object = FictionType(name=fiction_type,
                                               slug=fiction_type_slug)
         return new_fiction_type_object
 
 
+async def get_fiction_type_id_by_slug(session: AsyncSession, fiction_type_slug: str) -> int | None:
+    fiction_type_id = fiction_type_ids_by_slug.get(fiction_type_slug)
+    if fiction_type_id is None:
+        fiction_type_object = await get_fiction_type_by_slug(session=session,
+                                                             fiction_type_slug=fiction_type_slug)
+        if not fiction_type_object:
+            return None
+        fiction_type_id = fiction_type_object.id
+        fiction_type_ids_by_slug.set(fiction_type_slug, fiction_type_id)
+    return fiction_type_id
+
+
 @router.get('/recommendations', response_model=list[RecommendationRead])
+@cache_response('recommendations')
 async def get_recommendations(*, fiction_type_slug: Annotated[str | None, Query()] = None,
                               offset: Annotated[int | None,
                                                 Query(gt=0)] = None,
                               limit: Annotated[int | None, Query(gt=0)] = None,
-                              session: Annotated[Session, Depends(get_session)]):
+                              after: Annotated[str | None, Query()] = None,
+                              fields: Annotated[str | None, Query()] = None,
+                              request: Request,
+                              response: Response,
+                              session: Annotated[AsyncSession, Depends(get_session)]):
+    after_id = decode_cursor(after)["id"] if after else None
+    fields = parse_fields(fields)
+    if accepts_ndjson(request):
+        # Recommendations are streamed as they are fetched, without link of the next page
+        fiction_type_id = None
+        if fiction_type_slug:
+            fiction_type_id = await get_fiction_type_id_by_slug(session=session,
+                                                                fiction_type_slug=fiction_type_slug)
+            if fiction_type_id is None:
+                return Response(media_type=NDJSON_MEDIA_TYPE, headers={"Vary": "Accept"})
+        return ndjson_response(recommendation_serializer(fields), stream_recommendations(
+            session=session, offset=offset, limit=limit, after_id=after_id,
+            fiction_type_id=fiction_type_id, fields=fields))
     if not fiction_type_slug:
-        recommendations = get_all_recommendations(session=session,
-                                                  offset=offset,
-                                                  limit=limit)
-        return recommendations
+        recommendations = await get_all_recommendations(session=session,
+                                                        offset=offset,
+                                                        limit=limit,
+                                                        after_id=after_id,
+                                                        fields=fields)
     else:
-        fiction_type_object = get_fiction_type_by_slug(session=session,
-                                                       fiction_type_slug=fiction_type_slug)
-        if not fiction_type_object:
+        fiction_type_id = await get_fiction_type_id_by_slug(session=session,
+                                                            fiction_type_slug=fiction_type_slug)
+        if fiction_type_id is None:
             return []
         else:
-            recommendations = get_recommendations_by_fiction_type(session=session,
-                                                                  fiction_type=fiction_type_object,
-                                                                  offset=offset,
-                                                                  limit=limit)
-            return recommendations
+            recommendations = await get_recommendations_by_fiction_type(session=session,
+                                                                        fiction_type_id=fiction_type_id,
+                                                                        offset=offset,
+                                                                        limit=limit,
+                                                                        after_id=after_id,
+                                                                        fields=fields)
+    if FAST_JSON_RESPONSES:
+        response = fast_json_response(recommendation_serializer(fields), recommendations)
+    elif fields:
+        response = sparse_response(recommendations, fields)
+    response.headers["Vary"] = "Accept"
+    if limit and len(recommendations) == limit:
+        set_next_page_link(request, response,
+                           encode_cursor(id=recommendations[-1].id))
+    return response if fields or FAST_JSON_RESPONSES else recommendations
+
+
+# Declared before '/recommendations/{recommendation_id}',
+# otherwise 'summary' would be matched as recommendation_id
+@router.get('/recommendations/summary', response_model=list[RecommendationSummary])
+async def get_recommendations_summary(ids: Annotated[list[int], Query()],
+                                      session: Annotated[AsyncSession, Depends(get_session)]):
+    recommendation_ids = list(dict.fromkeys(ids))
+    if len(recommendation_ids) > MAX_SUMMARY_IDS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"No more than {MAX_SUMMARY_IDS} ids can be requested"
+        )
+    summaries = {summary.id: summary for summary in
+                 await get_recommendation_summaries(session=session,
+                                                    recommendation_ids=recommendation_ids)}
+    # Summaries follow order of requested ids, nonexistent ids are skipped
+    return [summaries[recommendation_id] for recommendation_id in recommendation_ids
+            if recommendation_id in summaries]
 
 
 @router.post('/recommendations',
@@ -75,11 +223,11 @@ async def get_recommendations(*, fiction_type_slug: Annotated[str | None, Query(
              status_code=status.HTTP_201_CREATED)
 async def post_recommendation(
     data: Annotated[RecommendationCreate, Body(),],
-    session: Annotated[Session, Depends(get_session)],
-    current_user: Annotated[User, Depends(get_current_user)]
+    session: Annotated[AsyncSession, Depends(get_session)],
+    current_user_id: Annotated[int, Depends(get_current_user_id)]
 ):
-    tags = save_tags(session=session, tags=data.tags)
-    fiction_type = save_fiction_type(
+    tags = await save_tags(session=session, tags=data.tags)
+    fiction_type = await save_fiction_type(
         session=session, fiction_type=data.fiction_type)
     recommendation = Recommendation(
         title=data.title,
@@ -87,76 +235,118 @@ async def post_recommendation(
         opinion=data.opinion,
         fiction_type=fiction_type,
         tags=tags,
-        user=current_user
+        user_id=current_user_id
     )
     session.add(recommendation)
-    session.commit()
-    session.refresh(recommendation)
+    await session.commit()
+    await invalidate_responses("recommendations")
+    # No session.refresh() here: it would expire fiction_type and tags,
+    # which can not be lazy loaded later while serializing response
     return recommendation
 
 
 @router.get('/recommendations/{recommendation_id}',
             response_model=RecommendationRead)
+@cache_response('recommendation:{recommendation_id}')
 async def get_recommendation(recommendation_id: Annotated[int, Path()],
-                             session: Annotated[Session, Depends(get_session)]
+                             session: Annotated[AsyncSession,
+                                                Depends(get_session)],
+                             request: Request,
+                             response: Response,
+                             fields: Annotated[str | None, Query()] = None
                              ):
-    recommendation = get_recommendation_by_id_with_tags_and_fiction_type(session=session,
-                                                                         recommendation_id=recommendation_id)
-    if not recommendation:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f'Recommendation with id {recommendation_id} was not found'
-        )
-    return recommendation
+    fields = parse_fields(fields)
+
+    async def get(fields: tuple[str, ...] | None) -> Recommendation:
+        recommendation = await get_recommendation_by_id_with_tags_and_fiction_type(session=session,
+                                                                                   recommendation_id=recommendation_id,
+                                                                                   fields=fields)
+        if not recommendation:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f'Recommendation with id {recommendation_id} was not found'
+            )
+        return recommendation
+
+    if request.headers.get("if-none-match"):
+        # Client has a cached recommendation: it is checked without texts, tags and fiction type
+        headers = recommendation_validators(request, await get(RECOMMENDATION_VALIDATOR_FIELDS))
+        if etag_matches(request, headers["ETag"]):
+            return not_modified_response(headers)
+    # Sparse fieldsets load validator columns too
+    recommendation = await get(fields and tuple(dict.fromkeys(fields + RECOMMENDATION_VALIDATOR_FIELDS)))
+    headers = recommendation_validators(request, recommendation)
+    if fields:
+        response = sparse_response(recommendation, fields)
+    response.headers.update(headers)
+    return response if fields else recommendation
 
 
 @router.patch('/recommendations/{recommendation_id}',
               response_model=RecommendationRead)
 async def update_recommendation(recommendation_id: Annotated[int, Path()],
-                                session: Annotated[Session, Depends(get_session)],
-                                current_user: Annotated[User, Depends(get_current_user)],
+                                session: Annotated[AsyncSession, Depends(get_session)],
+                                current_user_id: Annotated[int, Depends(get_current_user_id)],
                                 data: Annotated[RecommendationUpdate, Body()]):
-    recommendation = get_recommendation_by_id(session=session,
-                                              recommendation_id=recommendation_id)
-    if not recommendation:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Recommendation with id {recommendation_id} was not found"
-        )
-    if recommendation.user_id != current_user.id:
-        raise HTTPException(
-            status_code=status.HTTP_403_FORBIDDEN,
-            detail=f"User has no permission to update recommendation with id {recommendation_id}"
-        )
     data: dict = data.dict(exclude_unset=True)
-    if not data:
-        raise HTTPException(
-            status_code=status.HTTP_400_BAD_REQUEST,
-            detail="No data provided"
-        )
     new_title = data.get("title")
     new_short_description = data.get("short_description")
     new_opinion = data.get("opinion")
     new_fiction_type = data.get("fiction_type")
     new_tags = data.get("tags")
+    values = {"updated": datetime.utcnow()}
     if new_title:
-        recommendation.title = new_title
+        values["title"] = new_title
     if new_short_description:
-        recommendation.short_description = new_short_description
+        values["short_description"] = new_short_description
     if new_opinion:
-        recommendation.opinion = new_opinion
+        values["opinion"] = new_opinion
     if new_fiction_type:
-        new_fiction_type = save_fiction_type(session=session,
-                                             fiction_type=new_fiction_type)
-        recommendation.fiction_type = new_fiction_type
+        new_fiction_type = await save_fiction_type(session=session,
+                                                   fiction_type=new_fiction_type)
+        if new_fiction_type.id is None:
+            session.add(new_fiction_type)
+            await session.flush()
+        values["fiction_type_id"] = new_fiction_type.id
+    recommendation = None
+    if data:
+        recommendation = await update_user_row(session, Recommendation, recommendation_id,
+                                               current_user_id, values)
+    if not recommendation:
+        # Nothing was updated, one more query tells why
+        await session.rollback()
+        recommendation = await get_recommendation_by_id(session=session,
+                                                        recommendation_id=recommendation_id)
+        if not recommendation:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Recommendation with id {recommendation_id} was not found"
+            )
+        if recommendation.user_id != current_user_id:
+            raise HTTPException(
+                status_code=status.HTTP_403_FORBIDDEN,
+                detail=f"User has no permission to update recommendation with id {recommendation_id}"
+            )
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="No data provided"
+        )
     if new_tags:
-        new_tags = save_tags(session=session,
-                             tags=new_tags)
-        recommendation.tags = new_tags
-    recommendation.updated = datetime.utcnow()
-    session.add(recommendation)
-    session.commit()
-    session.refresh(recommendation)
+        new_tags = await save_tags(session=session,
+                                   tags=new_tags)
+        await replace_recommendation_tags(session=session,
+                                          recommendation_id=recommendation_id,
+                                          tags=new_tags)
+    else:
+        new_tags = await get_tags_of_recommendation(session=session,
+                                                    recommendation_id=recommendation_id)
+    set_committed_value(recommendation, "tags", new_tags)
+    if new_fiction_type:
+        set_committed_value(recommendation, "fiction_type", new_fiction_type)
+    else:
+        await load_fiction_types(session, [recommendation])
+    await session.commit()
+    await invalidate_responses(*recommendation_cache_groups(recommendation_id))
     return recommendation
 
 
@@ -164,20 +354,24 @@ async def update_recommendation(recommendation_id: Annotated[int, Path()],
                status_code=status.HTTP_204_NO_CONTENT,
                response_model=None)
 async def delete_recommendation(recommendation_id: Annotated[int, Path()],
-                                session: Annotated[Session, Depends(get_session)],
-                                current_user: Annotated[User, Depends(get_current_user)]):
-    recommendation = get_recommendation_by_id(session=session,
-                                              recommendation_id=recommendation_id)
-    if not recommendation:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail=f"Recommendation with id {recommendation_id} was not found"
-        )
-    if recommendation.user_id != current_user.id:
+                                session: Annotated[AsyncSession, Depends(get_session)],
+                                current_user_id: Annotated[int, Depends(get_current_user_id)]):
+    # Comments, reactions and tag links are deleted by the database(ON DELETE CASCADE)
+    deleted_recommendation = await delete_user_row(session, Recommendation, recommendation_id,
+                                                   current_user_id)
+    if not deleted_recommendation:
+        # Nothing was deleted, one more query tells why
+        recommendation = await get_recommendation_by_id(session=session,
+                                                        recommendation_id=recommendation_id)
+        if not recommendation:
+            raise HTTPException(
+                status_code=status.HTTP_404_NOT_FOUND,
+                detail=f"Recommendation with id {recommendation_id} was not found"
+            )
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             detail=f"User has no permission to delete recommendation with id {recommendation_id}"
         )
-    session.delete(recommendation)
-    session.commit()
+    await session.commit()
+    await invalidate_responses(*recommendation_cache_groups(recommendation_id, "comments", "reactions"))
     return None
@@ -1,16 +1,20 @@
-from datetime import timedelta
+from datetime import datetime
 from typing import Annotated
 
-from fastapi import APIRouter, Depends, Body, HTTPException, status
+from fastapi import APIRouter, Depends, Body, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlmodel import Session, select
+from sqlalchemy.exc import IntegrityError
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from ..auth import create_access_token, get_current_user, authenticate_user, Token,\
-    ACCESS_TOKEN_EXPIRES_HOURS, get_password_hash
+from ..auth import create_user_access_token, get_current_user, authenticate_user, Token,\
+    hash_password, issue_refresh_token, get_refresh_token_hash
+from ..cache import users_by_id
 from ..database import get_session
-from ..schemas import UserCreate, UserRead, UserUpdate
+from ..ratelimit import check_login_rate_limit
+from ..schemas import UserCreate, UserRead, UserUpdate, RefreshTokenRequest
 from ..models import User
-from ..crud import get_user_with_username, get_user_with_email
+from ..crud import get_refresh_token_with_username, revoke_refresh_token, revoke_user_refresh_tokens,\
+    violated_constraint
 
 
 router = APIRouter(
@@ -19,54 +23,125 @@ router = APIRouter(
 )
 
 
+# Unique indexes of user(PostgreSQL reports the index) and columns they
+# cover(SQLite reports "table.column") mapped to fields of the user
+DUPLICATE_USER_FIELDS = {
+    "ix_user_username": "username",
+    "ix_user_email": "email",
+    "user.username": "username",
+    "user.email": "email",
+}
+
+
+def duplicate_user_exception(error: IntegrityError) -> HTTPException:
+    # Unique indexes of username and email are checked by the database
+    field = DUPLICATE_USER_FIELDS.get(violated_constraint(error))
+    if field is None:
+        raise error
+    return HTTPException(
+        status_code=status.HTTP_409_CONFLICT,
+        detail=f"Duplicate {field}"
+    )
+
+
 @router.post("/register",
              response_model=UserRead,
              status_code=status.HTTP_201_CREATED)
-async def register(*, session: Annotated[Session, Depends(get_session)],
+async def register(*, session: Annotated[AsyncSession, Depends(get_session)],
                    data: Annotated[UserCreate, Body()]):
-    if get_user_with_username(session=session, username=data.username):
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail="Duplicate username"
-        )
-    if get_user_with_email(session=session, email=data.email):
-        raise HTTPException(
-            status_code=status.HTTP_409_CONFLICT,
-            detail="Duplicate email"
-        )
-    hashed_password = get_password_hash(data.password)
+    hashed_password = await hash_password(data.password)
     new_user = User(
         username=data.username,
         email=data.email,
         hashed_password=hashed_password
     )
     session.add(new_user)
-    session.commit()
-    session.refresh(new_user)
+    # Duplicates are found by the INSERT itself, no SELECTs before it,
+    # and no refresh after: id is returned by the INSERT
+    try:
+        await session.commit()
+    except IntegrityError as error:
+        await session.rollback()
+        raise duplicate_user_exception(error)
     return new_user
 
 
 @router.post("/token", response_model=Token)
 async def login_for_access_token(
     form_data: Annotated[OAuth2PasswordRequestForm, Depends()],
-    session: Annotated[Session, Depends(get_session)]
+    session: Annotated[AsyncSession, Depends(get_session)],
+    request: Request
 ):
-    user = authenticate_user(session=session,
-                             username=form_data.username,
-                             password=form_data.password)
+    await check_login_rate_limit(username=form_data.username,
+                                 address=request.client.host if request.client else None)
+    user = await authenticate_user(session=session,
+                                   username=form_data.username,
+                                   password=form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"}
         )
-    access_token_expires = timedelta(hours=ACCESS_TOKEN_EXPIRES_HOURS)
-    access_token = create_access_token(
-        data={"sub": user.username},
-        expires_delta=access_token_expires
+    access_token = create_user_access_token(username=user.username,
+                                            user_id=user.id)
+    refresh_token = await issue_refresh_token(session=session, user_id=user.id)
+    return {"access_token": access_token,
+            "token_type": "bearer",
+            "refresh_token": refresh_token}
+
+
+@router.post("/refresh", response_model=Token)
+async def refresh_access_token(
+    data: Annotated[RefreshTokenRequest, Body()],
+    session: Annotated[AsyncSession, Depends(get_session)]
+):
+    # Access token is renewed without checking the password(no bcrypt),
+    # refresh token is rotated: the used one is revoked and a new one is issued
+    invalid_refresh_token_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid refresh token",
+        headers={"WWW-Authenticate": "Bearer"}
     )
+    token_hash = get_refresh_token_hash(data.refresh_token)
+    if token_hash is None:
+        raise invalid_refresh_token_exception
+    refresh_token_with_username = await get_refresh_token_with_username(session=session,
+                                                                        token_hash=token_hash)
+    if not refresh_token_with_username:
+        raise invalid_refresh_token_exception
+    refresh_token, username = refresh_token_with_username
+    if refresh_token.revoked:
+        # Used token is presented again, so it could have been stolen:
+        # all tokens of the user are revoked and the user has to log in
+        await revoke_user_refresh_tokens(session=session, user_id=refresh_token.user_id)
+        await session.commit()
+        raise invalid_refresh_token_exception
+    if refresh_token.expires <= datetime.utcnow() or \
+            not await revoke_refresh_token(session=session, token_hash=token_hash):
+        raise invalid_refresh_token_exception
+    new_refresh_token = await issue_refresh_token(session=session,
+                                                  user_id=refresh_token.user_id)
+    access_token = create_user_access_token(username=username,
+                                            user_id=refresh_token.user_id)
     return {"access_token": access_token,
-            "token_type": "bearer"}
+            "token_type": "bearer",
+            "refresh_token": new_refresh_token}
+
+
+@router.post("/revoke",
+             status_code=status.HTTP_204_NO_CONTENT,
+             response_model=None)
+async def revoke(
+    data: Annotated[RefreshTokenRequest, Body()],
+    session: Annotated[AsyncSession, Depends(get_session)]
+):
+    # Responds the same way for unknown tokens, so it can not be used to check them
+    token_hash = get_refresh_token_hash(data.refresh_token)
+    if token_hash is not None:
+        await revoke_refresh_token(session=session, token_hash=token_hash)
+        await session.commit()
+    return None
 
 
 @router.get("/users/me", response_model=UserRead)
@@ -79,7 +154,7 @@ async def get_users_me(
 @router.patch("/users/me", response_model=UserRead)
 async def update_user(
     current_user: Annotated[User, Depends(get_current_user)],
-    session: Annotated[Session, Depends(get_session)],
+    session: Annotated[AsyncSession, Depends(get_session)],
     data: Annotated[UserUpdate, Body()]
 ):
     data: dict = data.dict(exclude_unset=True)
@@ -91,28 +166,16 @@ async def update_user(
     else:
         new_username = data.get("username")
         if new_username:
-            user_with_username = get_user_with_username(
-                session=session, username=new_username
-            )
-            if user_with_username and (user_with_username.id != current_user.id):
-                raise HTTPException(
-                    status_code=status.HTTP_409_CONFLICT,
-                    detail="Duplicate username"
-                )
             current_user.username = new_username
         new_email = data.get("email")
         if new_email:
-            user_with_email = get_user_with_email(
-                session=session, email=new_email
-            )
-            if user_with_email and (user_with_email.id != current_user.id):
-                raise HTTPException(
-                    status_code=status.HTTP_409_CONFLICT,
-                    detail="Duplicate email"
-                )
             current_user.email = new_email
 
     session.add(current_user)
-    session.commit()
-    session.refresh(current_user)
+    try:
+        await session.commit()
+    except IntegrityError as error:
+        await session.rollback()
+        raise duplicate_user_exception(error)
+    users_by_id.invalidate(current_user.id)
     return current_user
@@ -1,7 +1,9 @@
 import re
+import typing
 from datetime import datetime
+from functools import lru_cache
 from sqlmodel import SQLModel, Field
-from pydantic import validator
+from pydantic import create_model, validator
 
 # User schemas
 
@@ -42,6 +44,10 @@ class UserUpdate(SQLModel):
         return value
 
 
+class RefreshTokenRequest(SQLModel):
+    refresh_token: str
+
+
 # FictionType schemas
 class FictionTypeBase(SQLModel):
     name: str = Field(min_length=4,
@@ -98,10 +104,30 @@ class RecommendationRead(RecommendationBase):
     user_id: int
     published: datetime
     updated: datetime | None
+    positive_reactions: int
+    negative_reactions: int
+    comment_count: int
     fiction_type: FictionTypeRead
     tags: list[TagRead]
 
 
+@lru_cache
+def recommendation_read_model(fields: tuple[str, ...]) -> type[SQLModel]:
+    # Response model of sparse fieldset(?fields=id,title), includes only
+    # chosen fields of RecommendationRead with the same types
+    types = typing.get_type_hints(RecommendationRead)
+    return create_model(f"RecommendationRead[{','.join(fields)}]",
+                        __base__=SQLModel,
+                        **{name: (types[name], ...) for name in fields})
+
+
+class RecommendationSummary(SQLModel):
+    id: int
+    positive_reactions: int
+    negative_reactions: int
+    comment_count: int
+
+
 class RecommendationUpdate(SQLModel):
     title: str | None = Field(max_length=255, default=None)
     short_description: str | None = Field(default=None)
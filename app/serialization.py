@@ -0,0 +1,110 @@
+import json
+from functools import lru_cache
+from typing import AsyncIterator, Callable
+
+from decouple import config
+from fastapi import Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_SINGLETON
+from pydantic.json import pydantic_encoder
+
+from .schemas import RecommendationRead, CommentRead, ReactionRead
+
+
+# List endpoints return ORM objects, which FastAPI validates again against
+# response model and encodes with jsonable_encoder and json. With FAST_JSON_RESPONSES
+# objects are turned into dicts by serializers built once from read schemas
+# and encoded with orjson. Requires package orjson
+FAST_JSON_RESPONSES = config("FAST_JSON_RESPONSES", default=False, cast=bool)
+try:
+    import orjson
+except ImportError:
+    orjson = None
+if FAST_JSON_RESPONSES and orjson is None:
+    raise RuntimeError("Package orjson is required for FAST_JSON_RESPONSES")
+
+# List endpoints stream one JSON object per line, when client accepts this type
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+
+def build_serializer(schema: type[BaseModel],
+                     fields: tuple[str, ...] | None = None) -> Callable[[object], dict]:
+    # Serializer reads fields of the schema from attributes of an object
+    # without validating them, nested schemas get their own serializers.
+    # Values are left to orjson, which encodes datetimes as isoformat does
+    getters = []
+    for name, field in schema.__fields__.items():
+        if fields is not None and name not in fields:
+            continue
+        nested = build_serializer(field.type_) \
+            if isinstance(field.type_, type) and issubclass(field.type_, BaseModel) else None
+        getters.append((name, nested, field.shape != SHAPE_SINGLETON))
+
+    def serialize(obj) -> dict:
+        data = {}
+        for name, nested, many in getters:
+            value = getattr(obj, name)
+            if nested is not None and value is not None:
+                value = [nested(item) for item in value] if many else nested(value)
+            data[name] = value
+        return data
+
+    return serialize
+
+
+@lru_cache
+def recommendation_serializer(fields: tuple[str, ...] | None = None) -> Callable[[object], dict]:
+    return build_serializer(RecommendationRead, fields)
+
+
+serialize_comment = build_serializer(CommentRead)
+serialize_reaction = build_serializer(ReactionRead)
+
+
+def fast_json_response(serializer: Callable[[object], dict], content: list) -> ORJSONResponse:
+    return ORJSONResponse([serializer(item) for item in content])
+
+
+def accepts_ndjson(request: Request) -> bool:
+    # NDJSON is sent only when the client names it(not through */*) with q above 0
+    # and prefers it to JSON: by higher q or, with the same q, by listing it first.
+    # Quality of JSON is taken from its most specific media range
+    ranges = {}
+    for index, item in enumerate(request.headers.get("accept", "").split(",")):
+        media_type, *parameters = item.split(";")
+        q = 1.0
+        for parameter in parameters:
+            name, _, value = parameter.strip().partition("=")
+            if name.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        ranges.setdefault(media_type.strip().lower(), (q, -index))
+    ndjson_quality = ranges.get(NDJSON_MEDIA_TYPE)
+    if ndjson_quality is None or ndjson_quality[0] <= 0:
+        return False
+    json_quality = next((ranges[media_range] for media_range
+                         in ("application/json", "application/*", "*/*")
+                         if media_range in ranges), None)
+    return json_quality is None or ndjson_quality > json_quality
+
+
+def encode_json(data) -> bytes:
+    # orjson is used if it is installed, json otherwise(with the same output)
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, default=pydantic_encoder, separators=(",", ":")).encode()
+
+
+def ndjson_response(serializer: Callable[[object], dict],
+                    partitions: AsyncIterator[list]) -> StreamingResponse:
+    # Every partition of rows is sent as soon as it is fetched, as one chunk of lines.
+    # Session of the request is closed only after the stream ends, because FastAPI
+    # before 0.106 exits dependencies with yield after the response is sent(pinned in Pipfile)
+    async def lines():
+        async for partition in partitions:
+            yield b"".join(encode_json(serializer(item)) + b"\n" for item in partition)
+
+    return StreamingResponse(lines(), media_type=NDJSON_MEDIA_TYPE, headers={"Vary": "Accept"})
@@ -0,0 +1,124 @@
+"""Compare concurrent-request throughput of sync and async database sessions.
+
+Both endpoints are declared with `async def`, the "sync" one runs its query
+through a regular Session (as routers did before) and the "async" one
+through AsyncSession. Database round trip latency is emulated with
+a `latency(seconds)` SQL function, which sleeps in the thread that executes
+the query, so it blocks event loop only when the sync driver is used.
+
+Run from the root directory of the project:
+
+    python -m benchmarks.async_session --requests 200 --latency 0.01
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+from typing import Annotated
+
+import httpx
+from fastapi import Depends, FastAPI
+from sqlalchemy import event, func
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel, Session, create_engine, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.models import FictionType, Recommendation, User
+
+
+def register_latency_function(sync_engine):
+    @event.listens_for(sync_engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.create_function("latency", 1, time.sleep)
+
+
+def seed(engine, recommendations: int):
+    with Session(engine) as session:
+        user = User(username='benchmark', email='benchmark@gmail.com',
+                    hashed_password='not-used')
+        fiction_type = FictionType(name='movie', slug='movie')
+        for i in range(recommendations):
+            session.add(Recommendation(title=f'Recommendation {i}',
+                                       short_description='Short description',
+                                       opinion='Opinion', user=user,
+                                       fiction_type=fiction_type))
+        session.commit()
+
+
+def build_app(database_path: Path, latency: float) -> FastAPI:
+    # SQLite file databases use NullPool, so every request opens
+    # its own connection and pool size does not limit concurrency
+    engine = create_engine(f'sqlite:///{database_path}',
+                           connect_args={"check_same_thread": False})
+    async_engine = create_async_engine(f'sqlite+aiosqlite:///{database_path}')
+    register_latency_function(engine)
+    register_latency_function(async_engine.sync_engine)
+
+    def get_sync_session():
+        with Session(engine) as session:
+            yield session
+
+    async def get_async_session():
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            yield session
+
+    # Uncorrelated subquery is evaluated once per statement, not once per row
+    round_trip = select(func.latency(latency)).scalar_subquery()
+    statement = select(Recommendation).where(round_trip == None).\
+        order_by(Recommendation.id).limit(10)
+
+    app = FastAPI()
+
+    @app.get('/sync')
+    async def sync_path(session: Annotated[Session, Depends(get_sync_session)]):
+        return session.exec(statement).all()
+
+    @app.get('/async')
+    async def async_path(session: Annotated[AsyncSession, Depends(get_async_session)]):
+        return (await session.exec(statement)).all()
+
+    return app
+
+
+async def measure(app: FastAPI, path: str, requests: int, concurrency: int) -> float:
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async with httpx.AsyncClient(app=app, base_url='http://benchmark') as client:
+        async def send():
+            async with semaphore:
+                response = await client.get(path)
+                response.raise_for_status()
+
+        started = time.perf_counter()
+        await asyncio.gather(*(send() for _ in range(requests)))
+        return time.perf_counter() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='emulated database round trip in seconds')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_path = Path(directory) / 'benchmark.db'
+        engine = create_engine(f'sqlite:///{database_path}')
+        SQLModel.metadata.create_all(engine)
+        seed(engine, recommendations=100)
+        engine.dispose()
+
+        app = build_app(database_path, args.latency)
+        print(f'{args.requests} requests, concurrency {args.concurrency}, '
+              f'latency {args.latency * 1000:.1f}ms')
+        for path in ('/sync', '/async'):
+            elapsed = asyncio.run(measure(app, path, args.requests,
+                                          args.concurrency))
+            print(f'{path:>7}: {elapsed:.3f}s, '
+                  f'{args.requests / elapsed:.1f} requests/s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,147 @@
+"""Compare loading strategies of recommendation lists.
+
+Recommendations with 1, 10 and 50 tags are listed with `get_all_recommendations`
+under "selectin" and "joined" strategies. Recommendations are seeded with texts of
+realistic length(`--short-description` and `--opinion` characters). For every run
+number of statements, number of rows and bytes the database returned and mean
+latency of a page are reported. Fiction types are cached after the first page,
+as they are in the API.
+
+Run from the root directory of the project:
+
+    python -m benchmarks.list_loading --recommendations 50 --pages 20
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel, Session, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.cache import lookup_caches
+from app.crud import LIST_LOADING_STRATEGIES, get_all_recommendations
+from app.models import FictionType, Recommendation, Tag, User
+
+
+def text(length: int) -> str:
+    words = 'Amazing piece of art, I recommend watching it to everyone. '
+    return (words * (length // len(words) + 1))[:length]
+
+
+def seed(engine, recommendations: int, tags_per_recommendation: int,
+         short_description_length: int, opinion_length: int):
+    with Session(engine) as session:
+        user = User(username='benchmark', email='benchmark@gmail.com',
+                    hashed_password='not-used')
+        fiction_types = [FictionType(name=name, slug=name)
+                         for name in ('movie', 'book', 'music')]
+        tags = [Tag(name=f'tag-{i}') for i in range(tags_per_recommendation)]
+        for i in range(recommendations):
+            session.add(Recommendation(title=f'Recommendation {i}',
+                                       short_description=text(short_description_length),
+                                       opinion=text(opinion_length), user=user,
+                                       fiction_type=fiction_types[i % 3],
+                                       tags=tags))
+        session.commit()
+
+
+def count_rows(engine):
+    # Rows fetched by the database driver are counted on the cursor,
+    # so rows that ORM deduplicates(joined loading) are counted too.
+    # Bytes are UTF-8 length of text values and 8 bytes of other values
+    counters = {"statements": 0, "rows": 0, "bytes": 0}
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        counters["statements"] += 1
+        rows = cursor.fetchall()
+        counters["rows"] += len(rows)
+        counters["bytes"] += sum(value_size(value) for row in rows for value in row)
+        # Fetched rows are handed back to the result through a buffered cursor
+        context.cursor = BufferedCursor(cursor, rows)
+
+    return counters
+
+
+def value_size(value) -> int:
+    if isinstance(value, str):
+        return len(value.encode())
+    if isinstance(value, bytes):
+        return len(value)
+    return 8
+
+
+class BufferedCursor:
+    def __init__(self, cursor, rows):
+        self._cursor = cursor
+        self._rows = list(rows)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchmany(self, size=None):
+        size = size or len(self._rows)
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def fetchall(self):
+        rows, self._rows = self._rows, []
+        return rows
+
+
+async def measure(database_path: Path, loading: str, limit: int, pages: int):
+    for cache in lookup_caches.values():
+        cache.clear()
+    async_engine = create_async_engine(f'sqlite+aiosqlite:///{database_path}')
+    counters = count_rows(async_engine.sync_engine)
+    started = time.perf_counter()
+    for _ in range(pages):
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            await get_all_recommendations(session=session, limit=limit,
+                                          loading=loading)
+    elapsed = time.perf_counter() - started
+    await async_engine.dispose()
+    return (counters["statements"] / pages, counters["rows"] / pages,
+            counters["bytes"] / pages, elapsed / pages)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--recommendations', type=int, default=50,
+                        help='recommendations on a page')
+    parser.add_argument('--pages', type=int, default=20,
+                        help='pages loaded for every strategy')
+    parser.add_argument('--short-description', type=int, default=200,
+                        help='characters of short description')
+    parser.add_argument('--opinion', type=int, default=2000,
+                        help='characters of opinion')
+    args = parser.parse_args()
+
+    print(f'{args.recommendations} recommendations on a page, '
+          f'mean of {args.pages} pages')
+    for tags_per_recommendation in (1, 10, 50):
+        with tempfile.TemporaryDirectory() as directory:
+            database_path = Path(directory) / 'benchmark.db'
+            engine = create_engine(f'sqlite:///{database_path}')
+            SQLModel.metadata.create_all(engine)
+            seed(engine, args.recommendations, tags_per_recommendation,
+                 args.short_description, args.opinion)
+            engine.dispose()
+            for loading in LIST_LOADING_STRATEGIES:
+                statements, rows, size, latency = asyncio.run(
+                    measure(database_path, loading, args.recommendations, args.pages))
+                print(f'{tags_per_recommendation:>2} tags, {loading:>8}: '
+                      f'{statements:.1f} statements, {rows:.0f} rows, '
+                      f'{size / 1024:.0f}KiB, '
+                      f'{latency * 1000:.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
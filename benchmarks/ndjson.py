@@ -0,0 +1,117 @@
+"""Compare JSON and NDJSON responses of large recommendation lists.
+
+'/recommendations?limit=N' is requested from the application(without HTTP server)
+with `Accept: application/json` and `Accept: application/x-ndjson`. Time to the first
+chunk of the body, time to the whole body and peak memory allocated while the request
+is served(tracemalloc) are reported. The response cache is disabled.
+
+Run from the root directory of the project:
+
+    python -m benchmarks.ndjson --recommendations 10000
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel, Session, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.database import get_session
+from app.main import app
+from app.models import FictionType, Recommendation, Tag, User
+from app.response_cache import response_cache
+
+MEDIA_TYPES = ('application/json', 'application/x-ndjson')
+
+
+def seed(engine, recommendations: int):
+    with Session(engine) as session:
+        user = User(username='benchmark', email='benchmark@gmail.com',
+                    hashed_password='not-used')
+        fiction_types = [FictionType(name=name, slug=name)
+                         for name in ('movie', 'book', 'music')]
+        tags = [Tag(name=f'tag-{i}') for i in range(5)]
+        for i in range(recommendations):
+            session.add(Recommendation(title=f'Recommendation {i}',
+                                       short_description='Short description',
+                                       opinion='Opinion ' * 50, user=user,
+                                       fiction_type=fiction_types[i % 3],
+                                       tags=tags))
+        session.commit()
+
+
+async def request(media_type: str, limit: int) -> tuple[float, float, int]:
+    # Returns seconds to the first chunk of the body, seconds to the whole body, body size
+    scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+             'method': 'GET', 'scheme': 'http', 'path': '/recommendations',
+             'raw_path': b'/recommendations', 'query_string': f'limit={limit}'.encode(),
+             'root_path': '', 'server': ('testserver', 80), 'client': ('127.0.0.1', 1),
+             'headers': [(b'host', b'testserver'), (b'accept', media_type.encode())]}
+    first_chunk = None
+    size = 0
+    request_sent = False
+
+    async def receive():
+        # Streaming responses wait for disconnect of the client, which never comes
+        nonlocal request_sent
+        if request_sent:
+            await asyncio.Event().wait()
+        request_sent = True
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        nonlocal first_chunk, size
+        if message['type'] == 'http.response.body' and message.get('body'):
+            if first_chunk is None:
+                first_chunk = time.perf_counter()
+            size += len(message['body'])
+
+    started = time.perf_counter()
+    await app(scope, receive, send)
+    return first_chunk - started, time.perf_counter() - started, size
+
+
+async def run(database_path: Path, limit: int):
+    async_engine = create_async_engine(f'sqlite+aiosqlite:///{database_path}')
+
+    async def get_benchmark_session():
+        async with AsyncSession(async_engine, expire_on_commit=False) as session:
+            yield session
+
+    app.dependency_overrides[get_session] = get_benchmark_session
+    response_cache.maxbytes = 0
+    # Warm up caches of fiction types and of serializers
+    await request(MEDIA_TYPES[0], 10)
+    for media_type in MEDIA_TYPES:
+        tracemalloc.start()
+        first_chunk, total, size = await request(media_type, limit)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print(f'{media_type:>20}: first chunk {first_chunk * 1000:.1f}ms, '
+              f'whole body {total * 1000:.1f}ms, {size / 1024 / 1024:.1f}MiB, '
+              f'peak memory {peak / 1024 / 1024:.1f}MiB')
+    await async_engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--recommendations', type=int, default=10000,
+                        help='recommendations in the list')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_path = Path(directory) / 'benchmark.db'
+        engine = create_engine(f'sqlite:///{database_path}')
+        SQLModel.metadata.create_all(engine)
+        seed(engine, args.recommendations)
+        engine.dispose()
+        print(f'{args.recommendations} recommendations')
+        asyncio.run(run(database_path, args.recommendations))
+
+
+if __name__ == '__main__':
+    main()
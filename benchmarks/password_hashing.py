@@ -0,0 +1,119 @@
+"""Measure latency of unrelated requests while logins are in flight.
+
+Logins are sent continuously to '/auth/token', while '/' is requested at
+a steady rate and latency of every such request is recorded. bcrypt is run
+either in the event loop (as handlers did before) or in the password
+hashing pool, p50 and p99 of '/' are reported for both. Latency is counted
+from the time a request was due, not from the time it was sent.
+
+Run from the root directory of the project:
+
+    python -m benchmarks.password_hashing --logins 20 --concurrency 4
+"""
+import argparse
+import asyncio
+import statistics
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel, Session, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import auth
+from app.database import get_session
+from app.main import app
+from app.models import User
+from app.routers import users
+
+
+async def run_in_event_loop(function, *args):
+    return function(*args)
+
+
+async def skip_login_rate_limit(username: str, address: str | None):
+    pass
+
+
+async def measure(logins: int, concurrency: int, interval: float) -> list[float]:
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async with httpx.AsyncClient(app=app, base_url='http://benchmark') as client:
+        async def login():
+            async with semaphore:
+                response = await client.post('/auth/token',
+                                             data={'username': 'benchmark',
+                                                   'password': 'benchmark-password'})
+                response.raise_for_status()
+
+        async def probe(logins_done: asyncio.Future):
+            # Requests are due at fixed times and latency is counted from that
+            # time, so time spent waiting for the blocked event loop is included
+            started = time.perf_counter()
+            sent = 0
+            while not logins_done.done():
+                scheduled = started + sent * interval
+                await asyncio.sleep(max(0, scheduled - time.perf_counter()))
+                response = await client.get('/')
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - scheduled)
+                sent += 1
+
+        logins_done = asyncio.gather(*(login() for _ in range(logins)))
+        await asyncio.gather(logins_done, probe(logins_done))
+    return latencies
+
+
+def percentile(values: list[float], percent: int) -> float:
+    return statistics.quantiles(values, n=100)[percent - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--logins', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='logins in flight at the same time')
+    parser.add_argument('--interval', type=float, default=0.005,
+                        help='pause between requests to "/" in seconds')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_path = Path(directory) / 'benchmark.db'
+        engine = create_engine(f'sqlite:///{database_path}')
+        SQLModel.metadata.create_all(engine)
+        with Session(engine) as session:
+            session.add(User(username='benchmark', email='benchmark@gmail.com',
+                             hashed_password=auth.get_password_hash('benchmark-password')))
+            session.commit()
+        engine.dispose()
+        async_engine = create_async_engine(f'sqlite+aiosqlite:///{database_path}')
+
+        async def get_session_override():
+            async with AsyncSession(async_engine, expire_on_commit=False) as session:
+                yield session
+
+        app.dependency_overrides[get_session] = get_session_override
+        print(f'{args.logins} logins, {args.concurrency} in flight, '
+              f'bcrypt rounds {auth.BCRYPT_ROUNDS}, '
+              f'{auth.PASSWORD_HASHING_WORKERS} hashing workers')
+        # Every login is for the same user, so the rate limit would refuse them
+        check_login_rate_limit = users.check_login_rate_limit
+        users.check_login_rate_limit = skip_login_rate_limit
+        pool_run = auth.password_hashing_pool.run
+        for name, run in (('event loop', run_in_event_loop), ('pool', pool_run)):
+            auth.password_hashing_pool.run = run
+            latencies = asyncio.run(measure(args.logins, args.concurrency,
+                                            args.interval))
+            print(f'{name:>10}: {len(latencies)} requests to "/", '
+                  f'p50 {percentile(latencies, 50) * 1000:.1f}ms, '
+                  f'p99 {percentile(latencies, 99) * 1000:.1f}ms')
+        auth.password_hashing_pool.run = pool_run
+        users.check_login_rate_limit = check_login_rate_limit
+        app.dependency_overrides.clear()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""Count bcrypt calls of clients renewing access tokens by login and by refresh.
+
+Every client logs in once and then renews its access token a number of
+times, either with '/auth/token'(password is checked with bcrypt every time)
+or with '/auth/refresh'. Calls of bcrypt and mean time of a renewal are
+measured, bcrypt calls per hour are extrapolated for the given renewal rate.
+
+Run from the root directory of the project:
+
+    python -m benchmarks.refresh_tokens --clients 10 --renewals 10 --renewals-per-hour 12
+"""
+import argparse
+import asyncio
+import tempfile
+import time
+from pathlib import Path
+
+import httpx
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel, Session, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import auth
+from app.database import get_session
+from app.main import app
+from app.models import User
+
+PASSWORD = 'benchmark-password'
+
+
+def count_bcrypt_calls() -> dict:
+    counters = {"bcrypt": 0}
+    verify_and_update = auth.pwd_context.verify_and_update
+
+    def counting_verify_and_update(*args, **kwargs):
+        counters["bcrypt"] += 1
+        return verify_and_update(*args, **kwargs)
+
+    auth.pwd_context.verify_and_update = counting_verify_and_update
+    return counters
+
+
+async def renew_tokens(client: httpx.AsyncClient, username: str, renewals: int,
+                       with_refresh: bool) -> float:
+    form = {'username': username, 'password': PASSWORD}
+    tokens = (await client.post('/auth/token', data=form)).json()
+    started = time.perf_counter()
+    for _ in range(renewals):
+        if with_refresh:
+            response = await client.post('/auth/refresh',
+                                         json={'refresh_token': tokens['refresh_token']})
+        else:
+            response = await client.post('/auth/token', data=form)
+        response.raise_for_status()
+        tokens = response.json()
+    return time.perf_counter() - started
+
+
+async def measure(clients: int, renewals: int, with_refresh: bool) -> float:
+    async with httpx.AsyncClient(app=app, base_url='http://benchmark') as client:
+        elapsed = await asyncio.gather(*(renew_tokens(client, f'benchmark_{i}', renewals,
+                                                      with_refresh)
+                                         for i in range(clients)))
+    return sum(elapsed) / (clients * renewals)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--clients', type=int, default=10)
+    parser.add_argument('--renewals', type=int, default=10,
+                        help='renewals of access token by every client')
+    parser.add_argument('--renewals-per-hour', type=float, default=12,
+                        help='renewal rate of one client used for extrapolation')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        database_path = Path(directory) / 'benchmark.db'
+        engine = create_engine(f'sqlite:///{database_path}')
+        SQLModel.metadata.create_all(engine)
+        hashed_password = auth.get_password_hash(PASSWORD)
+        with Session(engine) as session:
+            for i in range(args.clients):
+                session.add(User(username=f'benchmark_{i}', email=f'benchmark_{i}@gmail.com',
+                                 hashed_password=hashed_password))
+            session.commit()
+        engine.dispose()
+        async_engine = create_async_engine(f'sqlite+aiosqlite:///{database_path}')
+
+        async def get_session_override():
+            async with AsyncSession(async_engine, expire_on_commit=False) as session:
+                yield session
+
+        app.dependency_overrides[get_session] = get_session_override
+        counters = count_bcrypt_calls()
+        print(f'{args.clients} clients, {args.renewals} renewals each, '
+              f'bcrypt rounds {auth.BCRYPT_ROUNDS}')
+        for name, with_refresh in (('login', False), ('refresh', True)):
+            counters["bcrypt"] = 0
+            renewal_time = asyncio.run(measure(args.clients, args.renewals,
+                                               with_refresh))
+            # Initial login of every client is counted too
+            calls_per_renewal = counters["bcrypt"] / \
+                (args.clients * (args.renewals + 1))
+            calls_per_hour = calls_per_renewal * args.renewals_per_hour * args.clients
+            print(f'{name:>7}: {counters["bcrypt"]} bcrypt calls, '
+                  f'{renewal_time * 1000:.1f}ms per renewal, '
+                  f'{calls_per_hour:.0f} bcrypt calls per hour at '
+                  f'{args.renewals_per_hour:g} renewals per client')
+        app.dependency_overrides.clear()
+
+
+if __name__ == '__main__':
+    main()
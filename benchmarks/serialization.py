@@ -0,0 +1,92 @@
+"""Compare serialization time of list responses with and without the fast path.
+
+Pages of recommendations(with fiction type and 5 tags), comments and reactions
+are serialized the way FastAPI does it for `response_model`(validation against
+the read schema, `jsonable_encoder` and json) and with serializers of
+`app.serialization` and orjson. Mean time of a page is reported for every page size.
+
+Run from the root directory of the project:
+
+    python -m benchmarks.serialization --repeat 50
+"""
+import argparse
+import asyncio
+import time
+from datetime import datetime
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from app.models import Comment, FictionType, Reaction, Recommendation, Tag
+from app.schemas import CommentRead, ReactionRead, RecommendationRead
+from app.serialization import fast_json_response, recommendation_serializer, \
+    serialize_comment, serialize_reaction
+
+PAGE_SIZES = (10, 100, 500)
+
+
+def make_recommendations(count: int) -> list[Recommendation]:
+    fiction_type = FictionType(id=1, name='movie', slug='movie')
+    tags = [Tag(id=i, name=f'tag-{i}') for i in range(5)]
+    return [Recommendation(id=i, title=f'Recommendation {i}',
+                           short_description='Short description',
+                           opinion='Opinion ' * 50, user_id=1,
+                           published=datetime.utcnow(), fiction_type_id=1,
+                           fiction_type=fiction_type, tags=tags)
+            for i in range(count)]
+
+
+def make_comments(count: int) -> list[Comment]:
+    return [Comment(id=i, content='Comment ' * 20, user_id=1, recommendation_id=1,
+                    published=datetime.utcnow())
+            for i in range(count)]
+
+
+def make_reactions(count: int) -> list[Reaction]:
+    return [Reaction(id=i, is_positive=i % 2 == 0, user_id=i, recommendation_id=1)
+            for i in range(count)]
+
+
+async def measure(render, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        await render()
+    return (time.perf_counter() - started) / repeat
+
+
+async def run(repeat: int):
+    cases = (('recommendations', RecommendationRead, make_recommendations,
+              recommendation_serializer()),
+             ('comments', CommentRead, make_comments, serialize_comment),
+             ('reactions', ReactionRead, make_reactions, serialize_reaction))
+    for name, schema, make_page, serializer in cases:
+        field = create_response_field(name=f'Response_{name}', type_=list[schema])
+        for page_size in PAGE_SIZES:
+            page = make_page(page_size)
+
+            async def render_default():
+                content = await serialize_response(field=field, response_content=page)
+                return JSONResponse(content).body
+
+            async def render_fast():
+                return fast_json_response(serializer, page).body
+
+            default = await measure(render_default, repeat)
+            fast = await measure(render_fast, repeat)
+            print(f'{name:>15}, {page_size:>3} items: default {default * 1000:.2f}ms, '
+                  f'fast {fast * 1000:.2f}ms, {default / fast:.1f}x')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--repeat', type=int, default=50,
+                        help='serializations of every page')
+    args = parser.parse_args()
+
+    print(f'mean of {args.repeat} serializations of a page')
+    asyncio.run(run(args.repeat))
+
+
+if __name__ == '__main__':
+    main()
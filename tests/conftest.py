@@ -1,18 +1,34 @@
 import pytest
 from fastapi.testclient import TestClient
+from sqlalchemy import event
+from sqlalchemy.dialects.postgresql.base import PGCompiler
+from sqlalchemy.dialects.sqlite.base import SQLiteCompiler
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.pool import NullPool
 from sqlmodel import SQLModel, Session, create_engine
-from sqlmodel.pool import StaticPool
+from sqlmodel.ext.asyncio.session import AsyncSession
 
 from app.main import app
-from app.database import get_session
+from app.database import get_session, enable_sqlite_foreign_keys
 from app.models import User
 from app.auth import get_password_hash
+from app.cache import lookup_caches
+from app.ratelimit import login_rate_limit_backend
+from app.response_cache import response_cache
+
+
+@pytest.fixture(name="database_path")
+def database_path_fixture(tmp_path):
+    # Database is kept in a file, because application works with it through
+    # aiosqlite, while tests prepare and check data through a sync Session
+    return tmp_path / 'test.db'
 
 
 @pytest.fixture(name="session")
-def session_fixture():
-    engine = create_engine('sqlite:///:memory:',
-                           connect_args={"check_same_thread": False}, poolclass=StaticPool)
+def session_fixture(database_path):
+    engine = create_engine(f'sqlite:///{database_path}',
+                           connect_args={"check_same_thread": False})
+    enable_sqlite_foreign_keys(engine)
     SQLModel.metadata.create_all(engine)
     with Session(engine) as session:
         test_user = User(username='test_user',
@@ -21,19 +37,80 @@ def session_fixture():
         session.add(test_user)
         session.commit()
         yield session
+    engine.dispose()
+
+
+@pytest.fixture(name="async_engine")
+def async_engine_fixture(database_path):
+    # TestClient runs every request in its own event loop,
+    # so connections must not be reused between requests
+    async_engine = create_async_engine(f'sqlite+aiosqlite:///{database_path}',
+                                       poolclass=NullPool)
+    enable_sqlite_foreign_keys(async_engine.sync_engine)
+    return async_engine
 
 
 @pytest.fixture(name="client")
-def client_fixture(session: Session):
-    def get_session_override():
-        return session
+def client_fixture(session: Session, async_engine, monkeypatch):
+    async def get_session_override():
+        async with AsyncSession(async_engine, expire_on_commit=False) as async_session:
+            yield async_session
+        # Objects loaded by tests could have been changed by the request
+        session.expire_all()
 
+    # Responses are cached only in tests of the response cache: other tests change
+    # the database directly and count statements of every request
+    monkeypatch.setattr(response_cache, "maxbytes", 0)
+    monkeypatch.setattr(response_cache, "shared", None)
     app.debug = False
     app.dependency_overrides[get_session] = get_session_override
 
     client = TestClient(app)
     yield client
     app.dependency_overrides.clear()
+    # Every test has its own database, so cached ids must not outlive it
+    for cache in lookup_caches.values():
+        cache.clear()
+    login_rate_limit_backend.clear()
+    response_cache.clear()
+
+
+@pytest.fixture(name="statements")
+def statements_fixture(async_engine):
+    # SQL statements executed by application, used to check number of round trips
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(async_engine.sync_engine,
+                 "before_cursor_execute", before_cursor_execute)
+    yield statements
+    event.remove(async_engine.sync_engine,
+                 "before_cursor_execute", before_cursor_execute)
+
+
+@pytest.fixture(name="returning")
+def returning_fixture(async_engine, monkeypatch):
+    # SQLite supports RETURNING since 3.35, but SQLAlchemy 1.4 neither renders
+    # it for SQLite nor reports it, so branches written for PostgreSQL
+    # are run by enabling it with the clause compiled as PostgreSQL does
+    monkeypatch.setattr(async_engine.dialect, "full_returning", True)
+    monkeypatch.setattr(SQLiteCompiler, "returning_clause", PGCompiler.returning_clause)
+
+
+class FakeTimer:
+    # Clock of caches and rate limits, that tests move by setting now
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(name="timer")
+def timer_fixture():
+    return FakeTimer()
 
 
 class AuthActions(object):
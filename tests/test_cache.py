@@ -0,0 +1,76 @@
+from fastapi.testclient import TestClient
+from fastapi import status
+from sqlmodel import Session, select
+
+from app.cache import TTLCache, fiction_type_ids_by_slug, tag_ids_by_name
+from app.models import User, Recommendation, FictionType
+
+from .conftest import AuthActions, FakeTimer
+
+
+def test_ttl_cache_expires_entries(timer: FakeTimer):
+    cache = TTLCache(maxsize=10, ttl=60, timer=timer)
+    cache.set('movie', 1)
+    assert cache.get('movie') == 1
+    timer.now = 61
+    assert cache.get('movie') is None
+    assert len(cache) == 0
+    assert cache.stats() == {'hits': 1, 'misses': 1,
+                             'size': 0, 'maxsize': 10}
+
+
+def test_ttl_cache_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set('movie', 1)
+    cache.set('music', 2)
+    cache.get('movie')
+    cache.set('book', 3)
+    assert cache.get('music') is None
+    assert cache.get('movie') == 1
+    assert cache.get('book') == 3
+    cache.invalidate('book')
+    assert cache.get('book') is None
+
+
+def test_filtered_recommendations_use_cached_fiction_type(client: TestClient, session: Session,
+                                                          statements: list[str]):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    fiction_type = FictionType(name='movie', slug='movie')
+    session.add(Recommendation(title='Interstellar',
+                               short_description='Movie about space',
+                               opinion='My favorite movie',
+                               fiction_type=fiction_type,
+                               user=test_user))
+    session.commit()
+    response = client.get('/recommendations?fiction_type_slug=movie')
+    assert len(response.json()) == 1
+    assert any('FROM fiction_type' in statement for statement in statements)
+    statements.clear()
+    response = client.get('/recommendations?fiction_type_slug=movie')
+    assert len(response.json()) == 1
+    assert response.json()[0]['fiction_type']['slug'] == 'movie'
+    assert not any('FROM fiction_type' in statement for statement in statements)
+    assert fiction_type_ids_by_slug.hits == 1
+
+
+def test_post_recommendation_uses_cached_tags(client: TestClient, auth: AuthActions):
+    token = auth.login_user_for_token()
+    headers = {'Authorization': f'Bearer {token}'}
+    data = {'title': 'Interstellar',
+            'short_description': 'Movie about space',
+            'opinion': 'My favorite movie',
+            'fiction_type': 'movie',
+            'tags': ['sci-fi', 'space']}
+    response = client.post('/recommendations', json=data, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+    first_tags = response.json()['tags']
+    response = client.post('/recommendations', json=data, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+    # New tags are cached only after they were read from database
+    assert tag_ids_by_name.hits == 0
+    response = client.post('/recommendations', json=data, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+    assert tag_ids_by_name.hits == 2
+    assert response.json()['tags'] == first_tags
+    assert response.json()['fiction_type']['name'] == 'movie'
@@ -1,11 +1,15 @@
+import asyncio
+import pytest
 from datetime import timedelta
 from fastapi.testclient import TestClient
 from fastapi import status
 from sqlmodel import Session, select
 from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
 
 from app.models import User, Recommendation, FictionType, Comment
 from app.auth import get_password_hash
+from app.crud import violates_recommendation_foreign_key
 
 from .conftest import AuthActions
 
@@ -57,6 +61,39 @@ def test_get_comments(client: TestClient, session: Session):
     assert response.json()[0]['id'] == comment_1.id
 
 
+def test_get_comments_with_cursor(client: TestClient, session: Session):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    fiction_type = FictionType(name='movie', slug='movie')
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=fiction_type,
+        user=test_user
+    )
+    comments = []
+    for minutes in (0, 15, 15):
+        comment = Comment(content='I agree', user=test_user,
+                          recommendation=recommendation)
+        comment.published = comment.published + timedelta(minutes=minutes)
+        session.add(comment)
+        comments.append(comment)
+    session.commit()
+    comment_ids = [comment.id for comment in comments]
+    response = client.get(
+        f'/recommendations/{recommendation.id}/comments?limit=2')
+    assert [c['id'] for c in response.json()] == comment_ids[:2]
+    response = client.get(response.links['next']['url'])
+    assert [c['id'] for c in response.json()] == comment_ids[2:]
+    response = client.get(
+        f'/recommendations/{recommendation.id}/comments?by_published_date_descending=true&limit=2'
+    )
+    assert [c['id'] for c in response.json()] == \
+        [comment_ids[2], comment_ids[1]]
+    response = client.get(response.links['next']['url'])
+    assert [c['id'] for c in response.json()] == [comment_ids[0]]
+    assert 'next' not in response.links
+
+
 def test_get_comments_for_nonexistent_recommendation(client: TestClient):
     nonexistent_recommendation_id = 89
     response = client.get(
@@ -66,6 +103,76 @@ def test_get_comments_for_nonexistent_recommendation(client: TestClient):
     error_detail = f"Recommendation with id {nonexistent_recommendation_id} was not found"
     assert response.json()['detail'] == error_detail
 
+
+def test_get_comments_and_comment_in_one_statement(client: TestClient, session: Session,
+                                                   statements: list[str]):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=test_user
+    )
+    comment = Comment(content='My comment',
+                      user=test_user, recommendation=recommendation)
+    session.add(comment)
+    session.commit()
+    urls_and_results = (
+        (f'/recommendations/{recommendation.id}/comments', status.HTTP_200_OK),
+        # Empty page still tells that recommendation exists
+        (f'/recommendations/{recommendation.id}/comments?offset=5', status.HTTP_200_OK),
+        (f'/recommendations/{recommendation.id}/comments?by_published_date_descending=true',
+         status.HTTP_200_OK),
+        (f'/recommendations/{recommendation.id}/comments/{comment.id}', status.HTTP_200_OK),
+        (f'/recommendations/{recommendation.id}/comments/87', status.HTTP_404_NOT_FOUND),
+        ('/recommendations/89/comments', status.HTTP_404_NOT_FOUND),
+        ('/recommendations/89/comments/1', status.HTTP_404_NOT_FOUND),
+    )
+    for url, status_code in urls_and_results:
+        statements.clear()
+        response = client.get(url)
+        assert response.status_code == status_code
+        assert len(statements) == 1
+    response = client.get(f'/recommendations/{recommendation.id}/comments?offset=5')
+    assert response.json() == []
+
+
+def test_get_comments_conditionally(client: TestClient, auth: AuthActions, session: Session,
+                                    statements: list[str]):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=test_user
+    )
+    comment = Comment(content='My comment',
+                      user=test_user, recommendation=recommendation)
+    session.add(comment)
+    session.commit()
+    list_url = f'/recommendations/{recommendation.id}/comments'
+    detail_url = f'{list_url}/{comment.id}'
+    for url in (list_url, detail_url):
+        response = client.get(url)
+        etag = response.headers['etag']
+        assert 'last-modified' in response.headers
+        statements.clear()
+        response = client.get(url, headers={'If-None-Match': f'"other", W/{etag}'})
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+        assert len(statements) == 1
+        assert 'content' not in statements[0]
+    list_etag = client.get(list_url).headers['etag']
+    detail_etag = client.get(detail_url).headers['etag']
+    assert list_etag != detail_etag
+    assert client.get(f'{list_url}?limit=1').headers['etag'] != list_etag
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+    client.put(detail_url, json={'content': 'My updated comment'}, headers=headers)
+    for url, etag in ((list_url, list_etag), (detail_url, detail_etag)):
+        response = client.get(url, headers={'If-None-Match': etag})
+        assert response.status_code == status.HTTP_200_OK
+        assert 'My updated comment' in response.text
+        assert response.headers['etag'] != etag
+
 # POST
 
 
@@ -88,6 +195,74 @@ def test_post_comment_for_nonexistent_recommendation(client: TestClient, auth: A
     assert response.json()['detail'] == error_detail
 
 
+def test_post_comment_for_deleted_user(client: TestClient, auth: AuthActions, session: Session):
+    other_user = User(username='other_user', email='other_user@gmail.com',
+                      hashed_password=get_password_hash('34somepassword34'))
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=other_user
+    )
+    session.add(recommendation)
+    session.commit()
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+    session.delete(session.exec(select(User).where(User.username == 'test_user')).one())
+    session.commit()
+    # Foreign key of the user fails, recommendation exists, so it is not 404
+    with pytest.raises(IntegrityError):
+        client.post(f'/recommendations/{recommendation.id}/comments',
+                    json={'content': 'My comment'}, headers=headers)
+
+
+class ForeignKeyViolationError(Exception):
+    # Error of asyncpg, which is the cause of DBAPI error of SQLAlchemy's adapter
+    def __init__(self, constraint_name: str):
+        super().__init__(f'violates foreign key constraint "{constraint_name}"')
+        self.constraint_name = constraint_name
+
+
+@pytest.mark.parametrize(('constraint_name', 'expected'),
+                         (('comment_recommendation_id_fkey', True),
+                          ('comment_user_id_fkey', False)))
+def test_recommendation_foreign_key_is_found_by_constraint_name(constraint_name, expected):
+    orig = Exception(str(ForeignKeyViolationError(constraint_name)))
+    orig.__cause__ = ForeignKeyViolationError(constraint_name)
+    error = IntegrityError('INSERT', {}, orig)
+    # Database is not asked, when it names the constraint
+    assert asyncio.run(violates_recommendation_foreign_key(None, error, Comment, 1)) == expected
+
+
+def test_post_comment_statements(client: TestClient, auth: AuthActions, session: Session,
+                                 statements: list[str]):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=test_user
+    )
+    session.add(recommendation)
+    session.commit()
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+    statements.clear()
+    response = client.post(f'/recommendations/{recommendation.id}/comments',
+                           json={'content': 'My comment'}, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+    comment = session.exec(select(Comment)).first()
+    assert response.json()['id'] == comment.id
+    assert response.json()['published'] == comment.published.isoformat()
+    # Recommendation is checked by the foreign key of the INSERT
+    assert [statement.split()[0] for statement in statements] == ['INSERT', 'UPDATE']
+    session.refresh(recommendation)
+    assert recommendation.comment_count == 1
+    statements.clear()
+    response = client.post('/recommendations/49/comments',
+                           json={'content': 'My comment'}, headers=headers)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    # SQLite does not name the failed foreign key, so recommendation is looked up
+    assert [statement.split()[0] for statement in statements] == ['INSERT', 'SELECT']
+
+
 def test_post_comment_validate_input(client: TestClient, auth: AuthActions, session: Session):
     test_user = session.exec(select(User).where(
         User.username == 'test_user')).first()
@@ -306,7 +481,11 @@ def test_update_comment_with_no_body(client: TestClient, auth: AuthActions, sess
     assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
 
 
-def test_logged_user_updates_comment(client: TestClient, auth: AuthActions, session: Session):
+@pytest.mark.parametrize('with_returning', (False, True))
+def test_logged_user_updates_comment(client: TestClient, auth: AuthActions, session: Session,
+                                     request, with_returning):
+    if with_returning:
+        request.getfixturevalue('returning')
     test_user = session.exec(select(User).where(
         User.username == 'test_user')).first()
     fiction_type = FictionType(name='movie', slug='movie')
@@ -341,6 +520,39 @@ def test_logged_user_updates_comment(client: TestClient, auth: AuthActions, sess
     assert response.json() == expected_data
 
 
+def test_update_comment_statements(client: TestClient, auth: AuthActions, session: Session,
+                                   statements: list[str]):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=test_user
+    )
+    comment = Comment(content='My comment',
+                      user=test_user, recommendation=recommendation)
+    session.add(comment)
+    session.commit()
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+    statements.clear()
+    response = client.put(
+        f'/recommendations/{recommendation.id}/comments/{comment.id}',
+        json={'content': 'My updated comment'}, headers=headers
+    )
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['content'] == 'My updated comment'
+    # Ownership is checked by the UPDATE, SQLite has no RETURNING,
+    # so the row is read by one more SELECT
+    assert [statement.split()[0] for statement in statements] == ['UPDATE', 'SELECT']
+    statements.clear()
+    response = client.put(
+        f'/recommendations/{recommendation.id}/comments/87',
+        json={'content': 'My updated comment'}, headers=headers
+    )
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert [statement.split()[0] for statement in statements] == ['UPDATE', 'SELECT']
+
+
 def test_not_logged_user_updates_comment(client: TestClient):
     response = client.put('/recommendations/67/comments/78')
     assert response.status_code == status.HTTP_401_UNAUTHORIZED
@@ -507,3 +719,57 @@ def test_logged_user_deletes_comment(client: TestClient, auth: AuthActions, sess
     assert response.status_code == status.HTTP_204_NO_CONTENT
     comment = session.get(Comment, comment_id)
     assert comment is None
+
+
+def test_delete_comment_statements(client: TestClient, auth: AuthActions, session: Session,
+                                   statements: list[str]):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=test_user, comment_count=1
+    )
+    comment = Comment(content='My comment',
+                      user=test_user, recommendation=recommendation)
+    session.add(comment)
+    session.commit()
+    url = f'/recommendations/{recommendation.id}/comments/{comment.id}'
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+    statements.clear()
+    response = client.delete(url, headers=headers)
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    # Comment(read first on SQLite, which has no RETURNING) and counter
+    assert [statement.split()[0] for statement in statements] == \
+        ['SELECT', 'DELETE', 'UPDATE']
+    statements.clear()
+    response = client.delete(url, headers=headers)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert [statement.split()[0] for statement in statements] == ['SELECT', 'SELECT']
+
+
+def test_comments_change_recommendation_counter(client: TestClient, auth: AuthActions,
+                                                session: Session):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    fiction_type = FictionType(name='movie', slug='movie')
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=fiction_type,
+        user=test_user
+    )
+    session.add(recommendation)
+    session.commit()
+    token = auth.login_user_for_token()
+    headers = {'Authorization': f'Bearer {token}'}
+    response = client.post(f'/recommendations/{recommendation.id}/comments',
+                           json={'content': 'My comment'}, headers=headers)
+    comment_id = response.json()['id']
+    client.post(f'/recommendations/{recommendation.id}/comments',
+                json={'content': 'My second comment'}, headers=headers)
+    assert recommendation.comment_count == 2
+    response = client.get(f'/recommendations/{recommendation.id}')
+    assert response.json()['comment_count'] == 2
+    client.delete(f'/recommendations/{recommendation.id}/comments/{comment_id}',
+                  headers=headers)
+    assert recommendation.comment_count == 1
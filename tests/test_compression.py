@@ -0,0 +1,79 @@
+from fastapi.testclient import TestClient
+from fastapi import status
+from sqlmodel import Session, select
+
+from app.compression import choose_encoding, decoded_etag, encoded_etag
+from app.models import User, Recommendation, FictionType, Comment
+from app.response_cache import response_cache
+
+
+def test_choose_encoding():
+    assert choose_encoding('gzip, deflate') == 'gzip'
+    assert choose_encoding('deflate;q=1.0, gzip;q=0.5') == 'gzip'
+    assert choose_encoding('gzip;q=0') is None
+    assert choose_encoding('identity') is None
+    assert choose_encoding('') is None
+    assert choose_encoding('*') is not None
+    assert choose_encoding('*, gzip;q=0') != 'gzip'
+
+
+def test_encoded_etag():
+    assert encoded_etag('"abc"', 'gzip') == '"abc-gzip"'
+    assert decoded_etag('"abc-gzip"') == '"abc"'
+    assert decoded_etag('"abc"') == '"abc"'
+
+
+def add_comments(session: Session, count: int) -> Recommendation:
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=test_user
+    )
+    for i in range(count):
+        session.add(Comment(content=f'Comment {i}', user=test_user,
+                            recommendation=recommendation))
+    session.commit()
+    return recommendation
+
+
+def test_large_responses_are_compressed(client: TestClient, session: Session):
+    recommendation = add_comments(session, 20)
+    url = f'/recommendations/{recommendation.id}/comments'
+    plain = client.get(url, headers={'Accept-Encoding': 'identity'})
+    assert 'content-encoding' not in plain.headers
+    assert plain.headers['vary'] == 'Accept, Accept-Encoding'
+    response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['content-encoding'] == 'gzip'
+    assert response.json() == plain.json()
+    assert int(response.headers['content-length']) < len(plain.content)
+    assert response.headers['etag'] == encoded_etag(plain.headers['etag'], 'gzip')
+    response = client.get(url, headers={'Accept-Encoding': 'gzip',
+                                        'If-None-Match': response.headers['etag']})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.headers['etag'] == encoded_etag(plain.headers['etag'], 'gzip')
+    # Small responses are not compressed
+    response = client.get(f'{url}?limit=1', headers={'Accept-Encoding': 'gzip'})
+    assert 'content-encoding' not in response.headers
+
+
+def test_cached_responses_keep_compressed_body(client: TestClient, session: Session,
+                                               monkeypatch):
+    monkeypatch.setattr(response_cache, 'maxbytes', 1024 * 1024)
+    recommendation = add_comments(session, 20)
+    url = f'/recommendations/{recommendation.id}/comments'
+    expected = client.get(url, headers={'Accept-Encoding': 'gzip'})
+    bytes_before = response_cache.bytes
+    for _ in range(2):
+        response = client.get(url, headers={'Accept-Encoding': 'gzip'})
+        assert response.headers['content-encoding'] == 'gzip'
+        assert response.headers['vary'] == 'Accept, Accept-Encoding'
+        assert response.headers['etag'] == expected.headers['etag']
+        assert response.json() == expected.json()
+    # Compressed once and held by the cache
+    assert response_cache.bytes - bytes_before == int(response.headers['content-length'])
+    for _ in range(2):
+        response = client.get(url, headers={'Accept-Encoding': 'identity'})
+        assert 'content-encoding' not in response.headers
+        assert response.headers['vary'] == 'Accept, Accept-Encoding'
@@ -0,0 +1,58 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app.maintenance import repair_recommendation_counters, delete_expired_refresh_tokens
+from app.models import User, Recommendation, FictionType, Comment, Reaction, RefreshToken
+
+
+def test_repair_recommendation_counters(session: Session, async_engine):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    fiction_type = FictionType(name='movie', slug='movie')
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=fiction_type,
+        user=test_user, positive_reactions=5, comment_count=3
+    )
+    consistent_recommendation = Recommendation(
+        title='Whiplash', short_description='Movie about music',
+        opinion='I like it', fiction_type=fiction_type, user=test_user
+    )
+    session.add(Reaction(is_positive=False, user=test_user,
+                         recommendation=recommendation))
+    session.add(Comment(content='I agree', user=test_user,
+                        recommendation=recommendation))
+    session.add(consistent_recommendation)
+    session.commit()
+
+    async def repair():
+        async with AsyncSession(async_engine) as async_session:
+            return await repair_recommendation_counters(async_session)
+
+    assert asyncio.run(repair()) == 1
+    session.refresh(recommendation)
+    assert recommendation.positive_reactions == 0
+    assert recommendation.negative_reactions == 1
+    assert recommendation.comment_count == 1
+    assert asyncio.run(repair()) == 0
+
+
+def test_delete_expired_refresh_tokens(session: Session, async_engine):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    session.add(RefreshToken(token_hash='expired', user_id=test_user.id,
+                             expires=datetime.utcnow() - timedelta(days=1)))
+    session.add(RefreshToken(token_hash='valid', user_id=test_user.id,
+                             expires=datetime.utcnow() + timedelta(days=1)))
+    session.commit()
+
+    async def delete_expired():
+        async with AsyncSession(async_engine) as async_session:
+            return await delete_expired_refresh_tokens(async_session)
+
+    assert asyncio.run(delete_expired()) == 1
+    assert [token.token_hash for token in
+            session.exec(select(RefreshToken)).all()] == ['valid']
@@ -0,0 +1,55 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+from fastapi import status
+
+from app.ratelimit import InMemoryRateLimitBackend, TokenBucketLimiter, \
+    login_attempts_by_username, login_attempts_by_address
+
+from .conftest import FakeTimer
+
+
+def test_token_bucket_allows_burst_and_refills(timer: FakeTimer):
+    limiter = TokenBucketLimiter(InMemoryRateLimitBackend(timer=timer), 'test',
+                                 capacity=3, period_seconds=30)
+    assert [asyncio.run(limiter.take('key')) for _ in range(3)] == [0, 0, 0]
+    assert asyncio.run(limiter.take('key')) == 10
+    assert asyncio.run(limiter.take('other-key')) == 0
+    timer.now = 10
+    assert asyncio.run(limiter.take('key')) == 0
+    assert asyncio.run(limiter.take('key')) == 10
+
+
+def test_in_memory_backend_drops_least_recently_used_buckets(timer: FakeTimer):
+    backend = InMemoryRateLimitBackend(maxsize=2, timer=timer)
+    for key in ('a', 'b', 'a', 'c'):
+        asyncio.run(backend.take(key, 1, 1))
+    assert list(backend._buckets) == ['a', 'c']
+
+
+def login(client: TestClient, username: str = 'test_user', password: str = 'wrong-password'):
+    return client.post('/auth/token',
+                       data={'username': username, 'password': password})
+
+
+def test_login_rate_limit_by_username(client: TestClient, statements: list[str], monkeypatch):
+    monkeypatch.setattr(login_attempts_by_username, 'capacity', 2)
+    assert login(client).status_code == status.HTTP_401_UNAUTHORIZED
+    assert login(client, username='TEST_USER').status_code == status.HTTP_401_UNAUTHORIZED
+    statements.clear()
+    response = login(client, password='34somepassword34')
+    assert response.status_code == status.HTTP_429_TOO_MANY_REQUESTS
+    assert int(response.headers['retry-after']) > 0
+    assert response.json() == {'detail': 'Too many login attempts, try again later'}
+    # Rejected before the user is loaded and the password is checked
+    assert statements == []
+    assert login(client, username='other_user').status_code == \
+        status.HTTP_401_UNAUTHORIZED
+
+
+def test_login_rate_limit_by_address(client: TestClient, monkeypatch):
+    monkeypatch.setattr(login_attempts_by_address, 'capacity', 2)
+    assert login(client, username='user_1').status_code == status.HTTP_401_UNAUTHORIZED
+    assert login(client, username='user_2').status_code == status.HTTP_401_UNAUTHORIZED
+    assert login(client, username='user_3').status_code == \
+        status.HTTP_429_TOO_MANY_REQUESTS
@@ -1,10 +1,13 @@
+import pytest
 from fastapi.testclient import TestClient
 from fastapi import status
 from sqlmodel import Session, select
 from sqlalchemy import and_
+from sqlalchemy.exc import IntegrityError
 
 from app.models import User, Recommendation, FictionType, Reaction
 from app.auth import get_password_hash
+from app.routers import reactions
 
 from .conftest import AuthActions
 
@@ -67,6 +70,31 @@ def test_get_reactions(client: TestClient, session: Session):
     assert response.json()[0]['id'] == reaction_1.id
 
 
+def test_get_reactions_with_cursor(client: TestClient, session: Session):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    fiction_type = FictionType(name='movie', slug='movie')
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=fiction_type,
+        user=test_user
+    )
+    reactions = []
+    for i, is_positive in enumerate((True, False, True)):
+        user = User(username=f'user{i}', email=f'user{i}@gmail.com',
+                    hashed_password='34somepassword34')
+        reaction = Reaction(is_positive=is_positive, user=user,
+                            recommendation=recommendation)
+        session.add(reaction)
+        reactions.append(reaction)
+    session.commit()
+    response = client.get(
+        f'/recommendations/{recommendation.id}/reactions?is_positive=true&limit=1')
+    assert response.json()[0]['id'] == reactions[0].id
+    response = client.get(response.links['next']['url'])
+    assert response.json()[0]['id'] == reactions[2].id
+
+
 def test_get_reactions_for_nonexistent_recommendation(client: TestClient):
     nonexistent_recommendation_id = 89
     response = client.get(
@@ -77,6 +105,38 @@ def test_get_reactions_for_nonexistent_recommendation(client: TestClient):
     error_detail = f"Recommendation with id {nonexistent_recommendation_id} was not found"
     assert response.json()['detail'] == error_detail
 
+def test_get_reactions_and_reaction_in_one_statement(client: TestClient, session: Session,
+                                                     statements: list[str]):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=test_user
+    )
+    reaction = Reaction(is_positive=True, user=test_user,
+                        recommendation=recommendation)
+    session.add(reaction)
+    session.commit()
+    urls_and_results = (
+        (f'/recommendations/{recommendation.id}/reactions', status.HTTP_200_OK),
+        # Empty page still tells that recommendation exists
+        (f'/recommendations/{recommendation.id}/reactions?is_positive=false',
+         status.HTTP_200_OK),
+        (f'/recommendations/{recommendation.id}/reactions/{reaction.id}', status.HTTP_200_OK),
+        (f'/recommendations/{recommendation.id}/reactions/87', status.HTTP_404_NOT_FOUND),
+        ('/recommendations/89/reactions', status.HTTP_404_NOT_FOUND),
+        ('/recommendations/89/reactions/1', status.HTTP_404_NOT_FOUND),
+    )
+    for url, status_code in urls_and_results:
+        statements.clear()
+        response = client.get(url)
+        assert response.status_code == status_code
+        assert len(statements) == 1
+    response = client.get(
+        f'/recommendations/{recommendation.id}/reactions?is_positive=false')
+    assert response.json() == []
+
 # POST
 
 
@@ -182,6 +242,60 @@ def test_logged_user_posts_reaction(client: TestClient, auth: AuthActions, sessi
     assert response.json() == expected_data
 
 
+def test_post_reaction_created_concurrently(client: TestClient, auth: AuthActions, session: Session,
+                                           monkeypatch):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=test_user
+    )
+    session.add(recommendation)
+    session.commit()
+    lookup = reactions.get_user_reaction_and_check_recommendation
+
+    async def lookup_then_react_concurrently(**kwargs):
+        # Other request creates the reaction after this one checked for it
+        result = await lookup(**kwargs)
+        session.add(Reaction(is_positive=True, user_id=test_user.id,
+                             recommendation_id=recommendation.id))
+        session.commit()
+        return result
+
+    monkeypatch.setattr(reactions, 'get_user_reaction_and_check_recommendation',
+                        lookup_then_react_concurrently)
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+    response = client.post(f'/recommendations/{recommendation.id}/reactions',
+                           json={'is_positive': False}, headers=headers)
+    assert response.status_code == status.HTTP_409_CONFLICT
+    assert len(session.exec(select(Reaction)).all()) == 1
+    session.refresh(recommendation)
+    assert recommendation.negative_reactions == 0
+
+
+def test_post_reaction_statements(client: TestClient, auth: AuthActions, session: Session,
+                                  statements: list[str]):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=test_user
+    )
+    session.add(recommendation)
+    session.commit()
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+    statements.clear()
+    response = client.post(f'/recommendations/{recommendation.id}/reactions',
+                           json={'is_positive': True}, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+    assert response.json()['id'] == session.exec(select(Reaction)).first().id
+    # Reaction is not read again after commit
+    assert [statement.split()[0] for statement in statements] == \
+        ['SELECT', 'INSERT', 'UPDATE']
+
+
 def test_user_with_reaction_posts_new_reaction(client: TestClient, auth: AuthActions, session: Session):
     test_user = session.exec(select(User).where(
         User.username == 'test_user')).first()
@@ -214,6 +328,34 @@ def test_user_with_reaction_posts_new_reaction(client: TestClient, auth: AuthAct
 # GET detail
 
 
+def test_get_reactions_conditionally(client: TestClient, session: Session):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=test_user
+    )
+    reaction = Reaction(is_positive=True, user=test_user,
+                        recommendation=recommendation)
+    session.add(reaction)
+    session.commit()
+    list_url = f'/recommendations/{recommendation.id}/reactions'
+    detail_url = f'{list_url}/{reaction.id}'
+    etags = {}
+    for url in (list_url, detail_url):
+        etags[url] = client.get(url).headers['etag']
+        response = client.get(url, headers={'If-None-Match': etags[url]})
+        assert response.status_code == status.HTTP_304_NOT_MODIFIED
+        assert response.headers['etag'] == etags[url]
+    reaction.is_positive = False
+    session.commit()
+    for url in (list_url, detail_url):
+        response = client.get(url, headers={'If-None-Match': etags[url]})
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers['etag'] != etags[url]
+
+
 def test_get_reaction_for_nonexistent_recommendation(client: TestClient):
     nonexistent_recommendation_id = 48
     response = client.get(
@@ -339,7 +481,11 @@ def test_update_reaction_with_no_body(client: TestClient, auth: AuthActions, ses
     assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
 
 
-def test_logged_user_updates_reaction(client: TestClient, auth: AuthActions, session: Session):
+@pytest.mark.parametrize('with_returning', (False, True))
+def test_logged_user_updates_reaction(client: TestClient, auth: AuthActions, session: Session,
+                                      request, with_returning):
+    if with_returning:
+        request.getfixturevalue('returning')
     test_user = session.exec(select(User).where(
         User.username == 'test_user')).first()
     fiction_type = FictionType(name='movie', slug='movie')
@@ -372,6 +518,159 @@ def test_logged_user_updates_reaction(client: TestClient, auth: AuthActions, ses
     assert response.json() == expected_data
 
 
+def test_update_reaction_statements(client: TestClient, auth: AuthActions, session: Session,
+                                    statements: list[str]):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=test_user, positive_reactions=1
+    )
+    reaction = Reaction(is_positive=True, user=test_user,
+                        recommendation=recommendation)
+    session.add(reaction)
+    session.commit()
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+    url = f'/recommendations/{recommendation.id}/reactions/{reaction.id}'
+    statements.clear()
+    response = client.put(url, json={'is_positive': False}, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['is_positive'] == False
+    # Reaction(and its read-back on SQLite) and counters
+    assert [statement.split()[0] for statement in statements] == \
+        ['UPDATE', 'SELECT', 'UPDATE']
+    statements.clear()
+    # Unchanged reaction is not written
+    response = client.put(url, json={'is_positive': False}, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert [statement.split()[0] for statement in statements] == ['UPDATE', 'SELECT']
+    session.refresh(recommendation)
+    assert (recommendation.positive_reactions,
+            recommendation.negative_reactions) == (0, 1)
+
+
+def test_put_my_reaction(client: TestClient, auth: AuthActions, session: Session,
+                         statements: list[str]):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=test_user
+    )
+    session.add(recommendation)
+    session.commit()
+    url = f'/recommendations/{recommendation.id}/reactions/me'
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+
+    def counters():
+        session.refresh(recommendation)
+        return recommendation.positive_reactions, recommendation.negative_reactions
+
+    statements.clear()
+    response = client.put(url, json={'is_positive': True}, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+    reaction_id = response.json()['id']
+    assert response.json() == {'id': reaction_id, 'is_positive': True,
+                               'user_id': test_user.id,
+                               'recommendation_id': recommendation.id}
+    # One write of the reaction(xmax is PostgreSQL only, so it is read first)
+    # and counters of recommendation
+    assert [statement.split()[0] for statement in statements] == \
+        ['SELECT', 'INSERT', 'UPDATE']
+    assert counters() == (1, 0)
+    # Same reaction again does not change anything
+    response = client.put(url, json={'is_positive': True}, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['id'] == reaction_id
+    assert counters() == (1, 0)
+    response = client.put(url, json={'is_positive': False}, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['id'] == reaction_id
+    assert response.json()['is_positive'] == False
+    assert counters() == (0, 1)
+    assert len(session.exec(select(Reaction)).all()) == 1
+
+
+def test_put_my_reaction_with_returning(client: TestClient, auth: AuthActions, session: Session,
+                                        statements: list[str], returning):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=test_user
+    )
+    session.add(recommendation)
+    session.commit()
+    url = f'/recommendations/{recommendation.id}/reactions/me'
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+    statements.clear()
+    response = client.put(url, json={'is_positive': True}, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+    # xmax is only known to PostgreSQL, other databases with RETURNING
+    # read the reaction before the write
+    assert [statement.split()[0] for statement in statements] == \
+        ['SELECT', 'INSERT', 'UPDATE']
+    assert not any('xmax' in statement for statement in statements)
+    response = client.put(url, json={'is_positive': False}, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['is_positive'] == False
+
+
+def test_put_my_reaction_for_deleted_user(client: TestClient, auth: AuthActions, session: Session):
+    other_user = User(username='other_user', email='other_user@gmail.com',
+                      hashed_password=get_password_hash('34somepassword34'))
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=other_user
+    )
+    session.add(recommendation)
+    session.commit()
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+    session.delete(session.exec(select(User).where(User.username == 'test_user')).one())
+    session.commit()
+    # Foreign key of the user fails, recommendation exists, so it is not 404
+    with pytest.raises(IntegrityError):
+        client.put(f'/recommendations/{recommendation.id}/reactions/me',
+                   json={'is_positive': True}, headers=headers)
+
+
+def test_put_my_reaction_toggles_off(client: TestClient, auth: AuthActions, session: Session):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=test_user
+    )
+    session.add(recommendation)
+    session.commit()
+    url = f'/recommendations/{recommendation.id}/reactions/me?toggle=true'
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+    response = client.put(url, json={'is_positive': True}, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+    response = client.put(url, json={'is_positive': True}, headers=headers)
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    assert session.exec(select(Reaction)).all() == []
+    session.refresh(recommendation)
+    assert (recommendation.positive_reactions,
+            recommendation.negative_reactions) == (0, 0)
+
+
+def test_put_my_reaction_for_nonexistent_recommendation(client: TestClient, auth: AuthActions):
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+    response = client.put('/recommendations/56/reactions/me',
+                          json={'is_positive': True}, headers=headers)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert response.json()['detail'] == "Recommendation with id 56 was not found"
+    response = client.put('/recommendations/56/reactions/me',
+                          json={'is_positive': True})
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
 def test_not_logged_user_updates_comment(client: TestClient):
     response = client.put('/recommendations/94/reactions/75')
     assert response.status_code == status.HTTP_401_UNAUTHORIZED
@@ -547,3 +846,68 @@ def test_logged_user_deletes_reaction(client: TestClient, auth: AuthActions, ses
     assert response.status_code == status.HTTP_204_NO_CONTENT
     reaction_by_user_for_recommendation = session.get(Reaction, reaction_id)
     assert reaction_by_user_for_recommendation is None
+
+
+def test_delete_reaction_statements(client: TestClient, auth: AuthActions, session: Session,
+                                    statements: list[str]):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    new_user = User(username='new_user', email='new_user@gmail.com',
+                    hashed_password=get_password_hash('34somepassword34'))
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=test_user, negative_reactions=1
+    )
+    reaction = Reaction(is_positive=False, user=new_user,
+                        recommendation=recommendation)
+    session.add(reaction)
+    session.commit()
+    url = f'/recommendations/{recommendation.id}/reactions/{reaction.id}'
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+    statements.clear()
+    response = client.delete(url, headers=headers)
+    assert response.status_code == status.HTTP_403_FORBIDDEN
+    # Nothing was deleted, so the reason is looked up
+    assert [statement.split()[0] for statement in statements] == ['SELECT', 'SELECT']
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token(username="new_user")}'}
+    statements.clear()
+    response = client.delete(url, headers=headers)
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    assert [statement.split()[0] for statement in statements] == \
+        ['SELECT', 'DELETE', 'UPDATE']
+    session.refresh(recommendation)
+    assert (recommendation.positive_reactions,
+            recommendation.negative_reactions) == (0, 0)
+
+
+def test_reactions_change_recommendation_counters(client: TestClient, auth: AuthActions,
+                                                  session: Session):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    fiction_type = FictionType(name='movie', slug='movie')
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=fiction_type,
+        user=test_user
+    )
+    session.add(recommendation)
+    session.commit()
+    token = auth.login_user_for_token()
+    headers = {'Authorization': f'Bearer {token}'}
+    response = client.post(f'/recommendations/{recommendation.id}/reactions',
+                           json={'is_positive': True}, headers=headers)
+    reaction_id = response.json()['id']
+    assert (recommendation.positive_reactions,
+            recommendation.negative_reactions) == (1, 0)
+    client.put(f'/recommendations/{recommendation.id}/reactions/{reaction_id}',
+               json={'is_positive': False}, headers=headers)
+    assert (recommendation.positive_reactions,
+            recommendation.negative_reactions) == (0, 1)
+    client.delete(f'/recommendations/{recommendation.id}/reactions/{reaction_id}',
+                  headers=headers)
+    assert (recommendation.positive_reactions,
+            recommendation.negative_reactions) == (0, 0)
+    response = client.get(f'/recommendations/{recommendation.id}')
+    assert response.json()['positive_reactions'] == 0
+    assert response.json()['negative_reactions'] == 0
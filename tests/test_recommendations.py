@@ -4,7 +4,7 @@ from fastapi import status
 from sqlmodel import Session, select
 
 
-from app.models import User, Recommendation, FictionType, Tag
+from app.models import User, Recommendation, FictionType, Tag, Comment, Reaction, RecommendationTagLink
 from app.auth import get_password_hash
 
 
@@ -69,6 +69,149 @@ def test_get_recommendations(client: TestClient, session: Session):
     assert response.status_code == status.HTTP_200_OK
     assert response.json()[-1]['title'] == recommendation_3.title
 
+
+@pytest.mark.parametrize('loading', ('selectin', 'joined'))
+def test_get_recommendations_with_loading_strategy(client: TestClient, session: Session,
+                                                   monkeypatch, loading):
+    monkeypatch.setattr('app.crud.RECOMMENDATION_LIST_LOADING', loading)
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    fiction_type_1 = FictionType(name='movie', slug='movie')
+    fiction_type_2 = FictionType(name='music', slug='music')
+    tags = [Tag(name='space'), Tag(name='drama'), Tag(name='rock')]
+    session.add(Recommendation(title='Interstellar',
+                               short_description='Movie about space',
+                               opinion='My favorite movie',
+                               fiction_type=fiction_type_1,
+                               tags=tags[:2],
+                               user=test_user))
+    session.add(Recommendation(title='One',
+                               short_description='Song by Metallica',
+                               opinion='I love this song',
+                               fiction_type=fiction_type_2,
+                               tags=tags[2:],
+                               user=test_user))
+    session.commit()
+    for _ in range(2):
+        response = client.get('/recommendations')
+        assert response.status_code == status.HTTP_200_OK
+        assert [(r['fiction_type']['name'], sorted(t['name'] for t in r['tags']))
+                for r in response.json()] == [('movie', ['drama', 'space']),
+                                              ('music', ['rock'])]
+
+
+def test_get_recommendations_with_cursor(client: TestClient, session: Session):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    fiction_type = FictionType(name='movie', slug='movie')
+    for title in ('Pulp Fiction', 'Interstellar', 'Whiplash'):
+        session.add(Recommendation(title=title,
+                                   short_description='Movie',
+                                   opinion='I like it',
+                                   fiction_type=fiction_type,
+                                   user=test_user))
+    session.commit()
+    response = client.get('/recommendations?limit=2')
+    assert response.status_code == status.HTTP_200_OK
+    assert [r['title'] for r in response.json()] == ['Pulp Fiction', 'Interstellar']
+    assert 'next' in response.links
+    response = client.get(response.links['next']['url'])
+    assert response.status_code == status.HTTP_200_OK
+    assert [r['title'] for r in response.json()] == ['Whiplash']
+    assert 'next' not in response.links
+    response = client.get(
+        f'/recommendations?fiction_type_slug={fiction_type.slug}&limit=2')
+    response = client.get(response.links['next']['url'])
+    assert [r['title'] for r in response.json()] == ['Whiplash']
+
+
+def test_get_recommendations_with_invalid_cursor(client: TestClient):
+    response = client.get('/recommendations?after=not-a-cursor')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json() == {'detail': 'Invalid cursor'}
+
+
+@pytest.mark.parametrize('loading', ('selectin', 'joined'))
+def test_get_recommendations_with_fields(client: TestClient, session: Session,
+                                         statements: list[str], monkeypatch, loading):
+    monkeypatch.setattr('app.crud.RECOMMENDATION_LIST_LOADING', loading)
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    fiction_type = FictionType(name='movie', slug='movie')
+    for title in ('Pulp Fiction', 'Interstellar', 'Whiplash'):
+        session.add(Recommendation(title=title,
+                                   short_description='Movie',
+                                   opinion='I like it',
+                                   fiction_type=fiction_type,
+                                   tags=[Tag(name=title.lower().replace(' ', '-'))],
+                                   user=test_user))
+    session.commit()
+    response = client.get('/recommendations?fields=title&limit=2')
+    assert response.status_code == status.HTTP_200_OK
+    assert [r['title'] for r in response.json()] == ['Pulp Fiction', 'Interstellar']
+    assert all(r.keys() == {'id', 'title'} for r in response.json())
+    assert len(statements) == 1
+    assert 'opinion' not in statements[0]
+    assert 'short_description' not in statements[0]
+    response = client.get(response.links['next']['url'])
+    assert [r['title'] for r in response.json()] == ['Whiplash']
+    response = client.get('/recommendations?fields=title, tags,fiction_type')
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()[0] == {'id': 1,
+                                  'title': 'Pulp Fiction',
+                                  'fiction_type': {'name': 'movie',
+                                                   'slug': 'movie',
+                                                   'id': fiction_type.id},
+                                  'tags': [{'name': 'pulp-fiction', 'id': 1}]}
+
+
+def test_get_recommendations_with_unknown_fields(client: TestClient):
+    response = client.get('/recommendations?fields=title,password,email')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json() == {'detail': 'Unknown fields: email, password'}
+    response = client.get('/recommendations/1?fields=secret')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+
+# GET summary
+
+
+def test_get_recommendations_summary(client: TestClient, session: Session):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    fiction_type = FictionType(name='movie', slug='movie')
+    recommendation_1 = Recommendation(title='Pulp Fiction',
+                                      short_description='Cool crime film',
+                                      opinion='I like it',
+                                      fiction_type=fiction_type,
+                                      user=test_user,
+                                      positive_reactions=3,
+                                      negative_reactions=1,
+                                      comment_count=2)
+    recommendation_2 = Recommendation(title='Interstellar',
+                                      short_description='Movie about space',
+                                      opinion='My favorite movie',
+                                      fiction_type=fiction_type,
+                                      user=test_user)
+    session.add(recommendation_1)
+    session.add(recommendation_2)
+    session.commit()
+    response = client.get(
+        f'/recommendations/summary?ids={recommendation_2.id}&ids=789&ids={recommendation_1.id}')
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == [
+        {'id': recommendation_2.id, 'positive_reactions': 0,
+         'negative_reactions': 0, 'comment_count': 0},
+        {'id': recommendation_1.id, 'positive_reactions': 3,
+         'negative_reactions': 1, 'comment_count': 2}
+    ]
+
+
+def test_get_recommendations_summary_with_too_many_ids(client: TestClient):
+    ids = '&'.join(f'ids={i}' for i in range(1, 302))
+    response = client.get(f'/recommendations/summary?{ids}')
+    assert response.status_code == status.HTTP_400_BAD_REQUEST
+    assert response.json() == {'detail': 'No more than 300 ids can be requested'}
+
 # POST
 
 
@@ -141,6 +284,9 @@ def test_post_recommendation(client: TestClient, auth: AuthActions, session: Ses
                      'user_id': test_user.id,
                      'published': recommendation_published_date_for_json,
                      'updated': None,
+                     'positive_reactions': 0,
+                     'negative_reactions': 0,
+                     'comment_count': 0,
                      'fiction_type': {
                          'name': fiction_type.name,
                          'slug': fiction_type.slug,
@@ -156,6 +302,51 @@ def test_post_recommendation(client: TestClient, auth: AuthActions, session: Ses
     assert response.json() == expected_data
 
 
+def test_post_recommendation_with_existing_and_duplicate_tags(client: TestClient, auth: AuthActions,
+                                                               session: Session):
+    existing_tag = Tag(name='space')
+    session.add(existing_tag)
+    session.commit()
+    token = auth.login_user_for_token()
+    headers = {'Authorization': f'Bearer {token}'}
+    response = client.post('/recommendations', json={
+        'title': 'Interstellar',
+        'short_description': 'Movie about space',
+        'opinion': 'My favorite movie',
+        'fiction_type': 'movie',
+        'tags': ['Space', 'sci fi', ' space ', 'sci-fi']}, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+    new_tag = session.exec(select(Tag).where(Tag.name == 'sci-fi')).first()
+    assert new_tag is not None
+    assert response.json()['tags'] == [
+        {'name': existing_tag.name, 'id': existing_tag.id},
+        {'name': new_tag.name, 'id': new_tag.id}
+    ]
+    assert len(session.exec(select(Tag)).all()) == 2
+
+
+def test_post_recommendation_with_new_tags_returned_by_insert(client: TestClient, auth: AuthActions,
+                                                              session: Session, returning):
+    existing_tag = Tag(name='space')
+    session.add(existing_tag)
+    session.commit()
+    token = auth.login_user_for_token()
+    headers = {'Authorization': f'Bearer {token}'}
+    response = client.post('/recommendations', json={
+        'title': 'Interstellar',
+        'short_description': 'Movie about space',
+        'opinion': 'My favorite movie',
+        'fiction_type': 'movie',
+        'tags': ['space', 'sci-fi', 'wormholes']}, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+    new_tags = [session.exec(select(Tag).where(Tag.name == name)).first()
+                for name in ('sci-fi', 'wormholes')]
+    assert response.json()['tags'] == [
+        {'name': existing_tag.name, 'id': existing_tag.id},
+        *({'name': tag.name, 'id': tag.id} for tag in new_tags)
+    ]
+
+
 def test_post_recommendation_for_not_logged_user(client: TestClient):
     response = client.post('/recommendations')
     assert response.status_code == status.HTTP_401_UNAUTHORIZED
@@ -187,6 +378,9 @@ def test_get_recommendation(client: TestClient, session: Session):
                      'user_id': test_user.id,
                      'published': recommendation_published_date_for_json,
                      'updated': None,
+                     'positive_reactions': 0,
+                     'negative_reactions': 0,
+                     'comment_count': 0,
                      'fiction_type': {
                          'name': fiction_type.name,
                          'slug': fiction_type.slug,
@@ -197,6 +391,80 @@ def test_get_recommendation(client: TestClient, session: Session):
     assert response.json() == expected_data
 
 
+def test_get_recommendation_with_fields(client: TestClient, session: Session,
+                                        statements: list[str]):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(title='Interstellar',
+                                    short_description='Movie about space',
+                                    opinion='My favorite movie',
+                                    user=test_user,
+                                    fiction_type=FictionType(name='movie', slug='movie'),
+                                    tags=[Tag(name='space')])
+    session.add(recommendation)
+    session.commit()
+    response = client.get(
+        f'/recommendations/{recommendation.id}?fields=title,comment_count')
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {'id': recommendation.id,
+                               'title': 'Interstellar',
+                               'comment_count': 0}
+    assert len(statements) == 1
+    assert 'opinion' not in statements[0]
+    assert 'JOIN' not in statements[0]
+    response = client.get(f'/recommendations/{789}?fields=title')
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_get_recommendation_conditionally(client: TestClient, auth: AuthActions,
+                                         session: Session, statements: list[str]):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(title='Interstellar',
+                                    short_description='Movie about space',
+                                    opinion='My favorite movie',
+                                    user=test_user,
+                                    fiction_type=FictionType(name='movie', slug='movie'),
+                                    tags=[Tag(name='space')])
+    session.add(recommendation)
+    session.commit()
+    url = f'/recommendations/{recommendation.id}'
+    response = client.get(url)
+    assert response.status_code == status.HTTP_200_OK
+    etag = response.headers['etag']
+    assert etag.startswith('"') and 'last-modified' in response.headers
+    expected_data = response.json()
+    statements.clear()
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert response.headers['etag'] == etag
+    assert response.content == b''
+    # Only validator columns are read
+    assert len(statements) == 1
+    assert 'opinion' not in statements[0] and 'JOIN' not in statements[0]
+    # Sparse fieldset is another representation
+    response = client.get(f'{url}?fields=title', headers={'If-None-Match': etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.headers['etag'] != etag
+    # Counters are part of the representation
+    session.add(Comment(content='My comment', user_id=test_user.id,
+                        recommendation_id=recommendation.id))
+    recommendation.comment_count = 1
+    session.commit()
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json() == {**expected_data, 'comment_count': 1}
+    etag = response.headers['etag']
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+    client.patch(url, json={'tags': ['drama']}, headers=headers)
+    response = client.get(url, headers={'If-None-Match': etag})
+    assert response.status_code == status.HTTP_200_OK
+    assert [tag['name'] for tag in response.json()['tags']] == ['drama']
+    assert response.json()['opinion'] == 'My favorite movie'
+    response = client.get('/recommendations/789', headers={'If-None-Match': etag})
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
 def test_get_nonexistent_recommendation(client: TestClient):
     response = client.get(f'/recommendations/{789}')
     assert response.status_code == status.HTTP_404_NOT_FOUND
@@ -259,6 +527,78 @@ def test_update_recommendation_with_no_body(client: TestClient, auth: AuthAction
     assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
 
 
+def test_update_recommendation_statements(client: TestClient, auth: AuthActions,
+                                          session: Session, statements: list[str]):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(title='Interstellar',
+                                    short_description='Movie about space',
+                                    opinion='My favorite movie',
+                                    user=test_user,
+                                    fiction_type=FictionType(name='movie', slug='movie'),
+                                    tags=[Tag(name='space')])
+    session.add(recommendation)
+    session.commit()
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+    statements.clear()
+    response = client.patch(f'/recommendations/{recommendation.id}',
+                            json={'title': 'Whiplash'}, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['title'] == 'Whiplash'
+    assert response.json()['tags'] == [{'name': 'space', 'id': 1}]
+    assert response.json()['fiction_type']['name'] == 'movie'
+    # UPDATE(and its read-back on SQLite), tags and fiction type of response
+    assert [statement.split()[0] for statement in statements] == \
+        ['UPDATE', 'SELECT', 'SELECT', 'SELECT']
+    statements.clear()
+    response = client.patch(f'/recommendations/{recommendation.id}',
+                            json={'title': 'Whiplash'}, headers=headers)
+    # Fiction type is cached now
+    assert len(statements) == 3
+    statements.clear()
+    response = client.patch('/recommendations/789',
+                            json={'title': 'Whiplash'}, headers=headers)
+    assert response.status_code == status.HTTP_404_NOT_FOUND
+    assert [statement.split()[0] for statement in statements] == ['UPDATE', 'SELECT']
+
+
+def test_update_recommendation_tags_changes_only_difference(client: TestClient, auth: AuthActions,
+                                                            session: Session, statements: list[str]):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    tag_names = [f'tag-{i}' for i in range(20)]
+    recommendation = Recommendation(title='Interstellar',
+                                    short_description='Movie about space',
+                                    opinion='My favorite movie',
+                                    user=test_user,
+                                    fiction_type=FictionType(name='movie', slug='movie'),
+                                    tags=[Tag(name=name) for name in tag_names])
+    session.add(recommendation)
+    session.commit()
+    recommendation_id = recommendation.id
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+    new_tag_names = tag_names[1:] + ['tag-new']
+    statements.clear()
+    response = client.patch(f'/recommendations/{recommendation_id}',
+                            json={'tags': new_tag_names}, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert [tag['name'] for tag in response.json()['tags']] == new_tag_names
+    deletes = [statement for statement in statements if statement.startswith('DELETE')]
+    inserts = [statement for statement in statements
+               if statement.startswith('INSERT INTO tagged_recommendations')]
+    assert len(deletes) == 1 and len(inserts) == 1
+    links = session.exec(select(RecommendationTagLink).
+                         where(RecommendationTagLink.recommendation_id == recommendation_id)).all()
+    linked_names = {session.get(Tag, link.tag_id).name for link in links}
+    assert linked_names == set(new_tag_names)
+    # Same tags again: links are only read
+    statements.clear()
+    response = client.patch(f'/recommendations/{recommendation_id}',
+                            json={'tags': new_tag_names}, headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert not any(statement.startswith(('DELETE', 'INSERT')) for statement in statements)
+
+
 def test_not_logged_user_updates_recommendation(client: TestClient):
     response = client.patch('/recommendations/78')
     assert response.status_code == status.HTTP_401_UNAUTHORIZED
@@ -303,7 +643,11 @@ def test_logged_user_without_permission_updates_recommendation(client: TestClien
     assert response.json()['detail'] == error_detail
 
 
-def test_logged_user_updates_recommendation(client: TestClient, auth: AuthActions, session: Session):
+@pytest.mark.parametrize('with_returning', (False, True))
+def test_logged_user_updates_recommendation(client: TestClient, auth: AuthActions, session: Session,
+                                            request, with_returning):
+    if with_returning:
+        request.getfixturevalue('returning')
     test_user = session.exec(select(User).where(
         User.username == 'test_user')).first()
     fiction_type = FictionType(name='movie', slug='movie')
@@ -334,6 +678,9 @@ def test_logged_user_updates_recommendation(client: TestClient, auth: AuthAction
                      'user_id': test_user.id,
                      'published': recommendation_published_date_for_json,
                      'updated': recommendation_updated_date_for_json,
+                     'positive_reactions': 0,
+                     'negative_reactions': 0,
+                     'comment_count': 0,
                      'fiction_type': {
                          'name': fiction_type.name,
                          'slug': fiction_type.slug,
@@ -411,3 +758,38 @@ def test_logged_user_deletes_recommendation(client: TestClient, auth: AuthAction
     assert response.status_code == status.HTTP_204_NO_CONTENT
     recommendation = session.get(Recommendation, recommendation_id)
     assert recommendation is None
+
+
+def test_deleting_recommendation_cascades_in_database(client: TestClient, auth: AuthActions,
+                                                      session: Session, statements: list[str]):
+    test_user = session.exec(select(User).
+                             where(User.username == 'test_user')).first()
+    recommendation = Recommendation(title='Interstellar',
+                                    short_description='Movie about space',
+                                    opinion='My favorite movie',
+                                    user=test_user,
+                                    fiction_type=FictionType(name='movie', slug='movie'),
+                                    tags=[Tag(name='space'), Tag(name='drama')])
+    session.add(recommendation)
+    session.commit()
+    recommendation_id = recommendation.id
+    for i in range(10):
+        session.add(Comment(content=f'Comment {i}', user_id=test_user.id,
+                            recommendation_id=recommendation_id))
+    session.add(Reaction(is_positive=True, user_id=test_user.id,
+                         recommendation_id=recommendation_id))
+    session.commit()
+    token = auth.login_user_for_token()
+    statements.clear()
+    response = client.delete(f'/recommendations/{recommendation_id}',
+                             headers={'Authorization': f'Bearer {token}'})
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    deletes = [statement for statement in statements
+               if statement.startswith('DELETE')]
+    assert deletes == ['DELETE FROM recommendation WHERE recommendation.id = ?']
+    assert not any('FROM comment' in statement or 'FROM reaction' in statement
+                   for statement in statements)
+    assert session.exec(select(Comment)).all() == []
+    assert session.exec(select(Reaction)).all() == []
+    assert session.exec(select(RecommendationTagLink)).all() == []
+    assert len(session.exec(select(Tag)).all()) == 2
@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from fastapi import status
+from sqlmodel import Session, select
+
+from app.models import User, Recommendation, FictionType
+from app.response_cache import CachedResponse, InMemorySharedCacheBackend, ResponseCache, \
+    response_cache
+
+from .conftest import AuthActions, FakeTimer
+
+
+def cached(body: bytes) -> CachedResponse:
+    return CachedResponse(body, {'content-type': 'application/json'})
+
+
+def test_response_cache_evicts_least_recently_used_bytes():
+    size = cached(b'x' * 100).size
+    cache = ResponseCache(maxbytes=size * 2, ttl=60)
+    for key in ('a', 'b'):
+        asyncio.run(cache.set(key, cached(b'x' * 100)))
+    asyncio.run(cache.get('a'))
+    asyncio.run(cache.set('c', cached(b'x' * 100)))
+    assert asyncio.run(cache.get('b')) is None
+    assert asyncio.run(cache.get('a')).body == b'x' * 100
+    assert cache.bytes == size * 2
+    # Response larger than the whole cache is not stored
+    asyncio.run(cache.set('d', cached(b'x' * 1000)))
+    assert asyncio.run(cache.get('d')) is None
+    assert cache.stats() == {'local_hits': 2, 'shared_hits': 0, 'misses': 2,
+                             'hit_ratio': 0.5, 'bytes': size * 2,
+                             'maxbytes': size * 2, 'entries': 2}
+
+
+def test_response_cache_reads_through_shared_backend(timer: FakeTimer):
+    shared = InMemorySharedCacheBackend(timer=timer)
+    # Two processes share the backend
+    first = ResponseCache(maxbytes=1000, ttl=60, shared=shared, timer=timer)
+    second = ResponseCache(maxbytes=1000, ttl=60, shared=shared, timer=timer)
+    asyncio.run(first.set('a', cached(b'[]')))
+    assert asyncio.run(second.get('a')).body == b'[]'
+    assert asyncio.run(second.get('a')).body == b'[]'
+    assert (second.shared_hits, second.local_hits) == (1, 1)
+    asyncio.run(second.invalidate('comments:1'))
+    assert asyncio.run(first.generation('comments:1')) == 1
+    timer.now = 61
+    assert asyncio.run(second.get('a')) is None
+
+
+@pytest.fixture(name="cache")
+def cache_fixture(client: TestClient, monkeypatch):
+    monkeypatch.setattr(response_cache, "maxbytes", 1024 * 1024)
+    return response_cache
+
+
+def test_public_responses_are_cached_until_write(client: TestClient, auth: AuthActions,
+                                                 session: Session, statements: list[str],
+                                                 cache: ResponseCache):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=test_user
+    )
+    session.add(recommendation)
+    session.commit()
+    urls = ('/recommendations?limit=5&offset=1', f'/recommendations/{recommendation.id}',
+            f'/recommendations/{recommendation.id}/comments',
+            f'/recommendations/{recommendation.id}/reactions')
+    responses = {url: client.get(url) for url in urls}
+    statements.clear()
+    for url in urls:
+        response = client.get(url)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.content == responses[url].content
+        assert response.headers.get('etag') == responses[url].headers.get('etag')
+    # Query parameters are normalized
+    client.get('/recommendations?offset=1&limit=5')
+    assert statements == []
+    response = client.get(f'/recommendations/{recommendation.id}',
+                          headers={'If-None-Match': responses[urls[1]].headers['etag']})
+    assert response.status_code == status.HTTP_304_NOT_MODIFIED
+    assert statements == []
+    stats = client.get('/cache/stats').json()['responses']
+    assert stats['hit_ratio'] > 0.5 and stats['bytes'] > 0
+
+    headers = {'Authorization': f'Bearer {auth.login_user_for_token()}'}
+    response = client.post(f'/recommendations/{recommendation.id}/comments',
+                           json={'content': 'My comment'}, headers=headers)
+    assert response.status_code == status.HTTP_201_CREATED
+    # Comments and counters of recommendation are read again, reactions are not
+    statements.clear()
+    assert client.get(urls[1]).json()['comment_count'] == 1
+    assert client.get(urls[2]).json()[0]['content'] == 'My comment'
+    assert len(statements) == 2
+    statements.clear()
+    client.get(urls[3])
+    assert statements == []
+
+
+def test_encoded_query_values_do_not_share_cache_key(client: TestClient, session: Session,
+                                                     cache: ResponseCache):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    session.add(Recommendation(
+        title='Interstellar', short_description='Movie about space',
+        opinion='My favorite movie', fiction_type=FictionType(name='movie', slug='movie'),
+        user=test_user
+    ))
+    session.commit()
+    # Value of fiction_type_slug contains "&" and "=", it is an unknown fiction type
+    response = client.get('/recommendations?fiction_type_slug=movie%26limit%3D1')
+    assert response.json() == []
+    response = client.get('/recommendations?fiction_type_slug=movie&limit=1')
+    assert len(response.json()) == 1
+
+
+def test_non_decimal_digits_in_path_are_validated(client: TestClient, cache: ResponseCache):
+    # "²" is a digit, but not a number
+    response = client.get('/recommendations/²')
+    assert response.status_code == status.HTTP_422_UNPROCESSABLE_ENTITY
@@ -0,0 +1,160 @@
+import asyncio
+import json
+
+import pytest
+from fastapi import Request, status
+from fastapi.testclient import TestClient
+from sqlmodel import Session, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from app import crud
+from app.crud import stream_partitions
+from app.models import User, Recommendation, FictionType, Tag, Comment, Reaction
+from app.response_cache import response_cache
+from app.routers import recommendations, comments, reactions
+from app.serialization import accepts_ndjson
+
+
+@pytest.fixture(name="fast_json")
+def fast_json_fixture(monkeypatch):
+    def enable():
+        for router_module in (recommendations, comments, reactions):
+            monkeypatch.setattr(router_module, 'FAST_JSON_RESPONSES', True)
+    return enable
+
+
+def test_fast_json_responses_match_response_models(client: TestClient, session: Session,
+                                                   fast_json):
+    # orjson is an optional dependency of FAST_JSON_RESPONSES
+    pytest.importorskip("orjson")
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    recommendation = Recommendation(title='Interstellar',
+                                    short_description='Movie about space',
+                                    opinion='My favorite movie',
+                                    user=test_user,
+                                    fiction_type=FictionType(name='movie', slug='movie'),
+                                    tags=[Tag(name='space'), Tag(name='drama')])
+    session.add(recommendation)
+    session.add(Comment(content='My comment', user=test_user,
+                        recommendation=recommendation))
+    session.add(Reaction(is_positive=True, user=test_user,
+                         recommendation=recommendation))
+    session.commit()
+    urls = ('/recommendations', '/recommendations?limit=1',
+            '/recommendations?fields=title,tags',
+            '/recommendations?fiction_type_slug=movie',
+            f'/recommendations/{recommendation.id}/comments?limit=1',
+            f'/recommendations/{recommendation.id}/reactions')
+    expected = {url: client.get(url) for url in urls}
+    fast_json()
+    for url in urls:
+        response = client.get(url)
+        assert response.json() == expected[url].json()
+        assert response.json() != []
+        for header in ('link', 'etag', 'last-modified'):
+            assert response.headers.get(header) == expected[url].headers.get(header)
+
+
+def add_recommendations(session: Session, count: int) -> list[Recommendation]:
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    fiction_type = FictionType(name='movie', slug='movie')
+    tags = [Tag(name='space'), Tag(name='drama')]
+    added = [Recommendation(title=f'Recommendation {i}', short_description='Movie',
+                            opinion='My favorite movie', user=test_user,
+                            fiction_type=fiction_type, tags=tags[:i % 3])
+             for i in range(count)]
+    for recommendation in added:
+        session.add(Comment(content='My comment', user=test_user,
+                            recommendation=recommendation))
+        session.add(Reaction(is_positive=True, user=test_user,
+                             recommendation=recommendation))
+    session.commit()
+    return added
+
+
+def ndjson_lines(response) -> list:
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_ndjson_responses_match_json_lists(client: TestClient, session: Session,
+                                           monkeypatch):
+    # Partitions are smaller than results, so rows come from several fetches
+    monkeypatch.setattr(crud, 'STREAM_YIELD_PER', 2)
+    added = add_recommendations(session, 5)
+    recommendation_id = added[0].id
+    for comment_recommendation in added[1:]:
+        session.add(Comment(content='Other comment', user=comment_recommendation.user,
+                            recommendation=added[0]))
+    session.commit()
+    urls = ('/recommendations', '/recommendations?limit=3',
+            '/recommendations?fields=title,tags',
+            '/recommendations?fiction_type_slug=movie&offset=1',
+            '/recommendations?fiction_type_slug=unknown',
+            f'/recommendations/{recommendation_id}/comments',
+            f'/recommendations/{recommendation_id}/comments?by_published_date_descending=true',
+            f'/recommendations/{recommendation_id}/reactions?is_positive=true')
+    for url in urls:
+        expected = client.get(url)
+        response = client.get(url, headers={'Accept': 'application/x-ndjson'})
+        assert response.status_code == status.HTTP_200_OK
+        assert response.headers['content-type'] == 'application/x-ndjson'
+        assert 'Accept' in response.headers['vary']
+        assert 'link' not in response.headers
+        assert ndjson_lines(response) == expected.json()
+
+
+@pytest.mark.parametrize(('accept', 'expected'),
+                         (('application/x-ndjson', True),
+                          ('application/x-ndjson, */*;q=0.1', True),
+                          ('application/x-ndjson, application/json', True),
+                          ('application/json;q=0.5, application/x-ndjson', True),
+                          ('application/json, application/x-ndjson', False),
+                          ('application/json, application/x-ndjson;q=0', False),
+                          ('application/x-ndjson;q=0.5, application/*', False),
+                          ('*/*', False),
+                          ('', False)))
+def test_accepts_ndjson(accept, expected):
+    request = Request({'type': 'http', 'headers': [(b'accept', accept.encode())]})
+    assert accepts_ndjson(request) == expected
+
+
+def test_ndjson_refused_by_q_gets_json(client: TestClient, session: Session):
+    add_recommendations(session, 2)
+    response = client.get('/recommendations',
+                          headers={'Accept': 'application/json, application/x-ndjson;q=0'})
+    assert response.headers['content-type'] == 'application/json'
+    assert len(response.json()) == 2
+
+
+def test_ndjson_response_for_unknown_recommendation(client: TestClient):
+    for url in ('/recommendations/1/comments', '/recommendations/1/reactions'):
+        response = client.get(url, headers={'Accept': 'application/x-ndjson'})
+        assert response.status_code == status.HTTP_404_NOT_FOUND
+
+
+def test_ndjson_responses_are_not_cached(client: TestClient, session: Session,
+                                         monkeypatch):
+    monkeypatch.setattr(response_cache, 'maxbytes', 1024 * 1024)
+    add_recommendations(session, 2)
+    expected = client.get('/recommendations').json()
+    response = client.get('/recommendations', headers={'Accept': 'application/x-ndjson'})
+    assert ndjson_lines(response) == expected
+    assert client.get('/recommendations').json() == expected
+    assert response_cache.stats()['entries'] == 1
+
+
+def test_stream_partitions_expunges_consumed_rows(session: Session, async_engine):
+    add_recommendations(session, 5)
+
+    async def stream() -> list[tuple[int, int]]:
+        # (rows of the partition, objects held by the session)
+        partitions = []
+        async with AsyncSession(async_engine) as async_session:
+            async for partition in stream_partitions(async_session, select(Comment),
+                                                     yield_per=2):
+                partitions.append((len(partition), len(async_session.identity_map)))
+        return partitions
+
+    assert asyncio.run(stream()) == [(2, 2), (2, 2), (1, 1)]
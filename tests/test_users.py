@@ -1,10 +1,19 @@
 import pytest
+from fastapi import HTTPException
 from fastapi.testclient import TestClient
+from sqlalchemy.exc import IntegrityError
 from fastapi import status
 from sqlmodel import Session, select
 
-from app.models import User
-from app.auth import get_password_hash
+from datetime import timedelta
+from passlib.hash import bcrypt
+
+from app.cache import users_by_id
+from app.models import User, RefreshToken
+from app.auth import get_password_hash, create_access_token, decode_access_token, pwd_context,\
+    password_hashing_pool, BCRYPT_ROUNDS
+
+from app.routers.users import duplicate_user_exception
 
 from .conftest import AuthActions
 
@@ -63,6 +72,57 @@ def test_register_with_duplicate_values(client: TestClient, username, email, pas
     assert response.json() == {'detail': detail}
 
 
+class UniqueViolationError(Exception):
+    # Error of asyncpg, which is the cause of DBAPI error of SQLAlchemy's adapter
+    def __init__(self, message: str, constraint_name: str):
+        super().__init__(message)
+        self.constraint_name = constraint_name
+
+
+@pytest.mark.parametrize(('constraint_name', 'detail'),
+                         (('ix_user_email', 'Duplicate email'),
+                          ('ix_user_username', 'Duplicate username')))
+def test_duplicate_user_exception_uses_constraint_name(constraint_name, detail):
+    # Message of PostgreSQL contains submitted values, which can look like other field
+    message = ('duplicate key value violates unique constraint "{0}"\n'
+               'DETAIL:  Key (email)=(username@example.com) already exists.')
+    orig = Exception(message.format(constraint_name))
+    orig.__cause__ = UniqueViolationError(message.format(constraint_name), constraint_name)
+    exception = duplicate_user_exception(IntegrityError('INSERT', {}, orig))
+    assert isinstance(exception, HTTPException)
+    assert exception.detail == detail
+
+
+def test_register_with_duplicate_email_looking_like_username(client: TestClient):
+    data = {'username': 'new_user', 'email': 'username@example.com',
+            'password': '34somepassword34'}
+    assert client.post('/auth/register', json=data).status_code == status.HTTP_201_CREATED
+    response = client.post('/auth/register', json={**data, 'username': 'new_user_2'})
+    assert response.status_code == status.HTTP_409_CONFLICT
+    assert response.json() == {'detail': 'Duplicate email'}
+
+
+def test_register_in_one_statement(client: TestClient, session: Session,
+                                   statements: list[str]):
+    response = client.post('/auth/register',
+                           json={'username': 'new_user',
+                                 'email': 'new_email@gmail.com',
+                                 'password': '34somepassword34'})
+    assert response.status_code == status.HTTP_201_CREATED
+    assert [statement.split()[0] for statement in statements] == ['INSERT']
+    new_user = session.exec(select(User).where(
+        User.username == 'new_user')).first()
+    assert response.json()['id'] == new_user.id
+    statements.clear()
+    response = client.post('/auth/register',
+                           json={'username': 'new_user_2',
+                                 'email': 'new_email@gmail.com',
+                                 'password': '34somepassword34'})
+    assert response.status_code == status.HTTP_409_CONFLICT
+    assert response.json() == {'detail': 'Duplicate email'}
+    assert [statement.split()[0] for statement in statements] == ['INSERT']
+
+
 def test_login_with_invalid_data(client: TestClient):
     response = client.post('/auth/token',
                            data={'username': 'no_one',
@@ -89,6 +149,108 @@ def test_login(client: TestClient, session: Session):
     assert response.json()["token_type"] == "bearer"
 
 
+def login_for_tokens(client: TestClient) -> dict:
+    response = client.post('/auth/token',
+                           data={'username': 'test_user',
+                                 'password': '34somepassword34'})
+    assert response.status_code == status.HTTP_200_OK
+    return response.json()
+
+
+def test_refresh_access_token(client: TestClient, session: Session,
+                              statements: list[str], monkeypatch):
+    tokens = login_for_tokens(client)
+    monkeypatch.setattr(pwd_context, 'verify_and_update', None)
+    statements.clear()
+    response = client.post('/auth/refresh',
+                           json={'refresh_token': tokens['refresh_token']})
+    assert response.status_code == status.HTTP_200_OK
+    new_tokens = response.json()
+    assert new_tokens['token_type'] == 'bearer'
+    assert new_tokens['refresh_token'] != tokens['refresh_token']
+    # Lookup, rotation and new token, password is not checked
+    assert [statement.split()[0] for statement in statements] == \
+        ['SELECT', 'UPDATE', 'INSERT']
+    response = client.get('/auth/users/me', headers={
+        'Authorization': f"Bearer {new_tokens['access_token']}"})
+    assert response.json()['username'] == 'test_user'
+
+
+def test_refresh_token_is_rotated(client: TestClient):
+    tokens = login_for_tokens(client)
+    new_tokens = client.post('/auth/refresh',
+                             json={'refresh_token': tokens['refresh_token']}).json()
+    # Reusing rotated token revokes all tokens of the user
+    response = client.post('/auth/refresh',
+                           json={'refresh_token': tokens['refresh_token']})
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+    assert response.json() == {'detail': 'Invalid refresh token'}
+    response = client.post('/auth/refresh',
+                           json={'refresh_token': new_tokens['refresh_token']})
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_refresh_with_forged_token(client: TestClient, statements: list[str]):
+    tokens = login_for_tokens(client)
+    secret, _, signature = tokens['refresh_token'].rpartition('.')
+    statements.clear()
+    for refresh_token in (f'{secret}x.{signature}', 'not-a-token', 'abc.é', ''):
+        response = client.post('/auth/refresh',
+                               json={'refresh_token': refresh_token})
+        assert response.status_code == status.HTTP_401_UNAUTHORIZED
+    assert statements == []
+
+
+def test_refresh_with_expired_token(client: TestClient, session: Session):
+    tokens = login_for_tokens(client)
+    refresh_token = session.exec(select(RefreshToken)).one()
+    refresh_token.expires = refresh_token.expires - timedelta(days=365)
+    session.add(refresh_token)
+    session.commit()
+    response = client.post('/auth/refresh',
+                           json={'refresh_token': tokens['refresh_token']})
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+
+
+def test_revoke_refresh_token(client: TestClient):
+    tokens = login_for_tokens(client)
+    response = client.post('/auth/revoke',
+                           json={'refresh_token': tokens['refresh_token']})
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    response = client.post('/auth/refresh',
+                           json={'refresh_token': tokens['refresh_token']})
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+    for refresh_token in ('not-a-token', 'abc.é'):
+        response = client.post('/auth/revoke',
+                               json={'refresh_token': refresh_token})
+        assert response.status_code == status.HTTP_204_NO_CONTENT
+
+
+def test_login_rehashes_password_with_other_cost_factor(client: TestClient, session: Session):
+    new_user = User(username='new_user',
+                    email='new_email@gmail.com',
+                    hashed_password=bcrypt.using(rounds=4).hash('34somepassword34'))
+    session.add(new_user)
+    session.commit()
+    response = client.post('/auth/token',
+                           data={'username': 'new_user',
+                                 'password': '34somepassword34'})
+    assert response.status_code == status.HTTP_200_OK
+    session.refresh(new_user)
+    assert new_user.hashed_password.startswith(f'$2b${BCRYPT_ROUNDS:02}$')
+    assert pwd_context.verify('34somepassword34', new_user.hashed_password)
+
+
+def test_login_when_password_hashing_is_overloaded(client: TestClient, monkeypatch):
+    monkeypatch.setattr(password_hashing_pool, 'pending',
+                        password_hashing_pool.max_pending)
+    response = client.post('/auth/token',
+                           data={'username': 'test_user',
+                                 'password': '34somepassword34'})
+    assert response.status_code == status.HTTP_503_SERVICE_UNAVAILABLE
+    assert response.headers['retry-after'] == '1'
+
+
 def test_read_users_me(client: TestClient, auth: AuthActions, session: Session):
     token = auth.login_user_for_token()
     headers = {'Authorization': f'Bearer {token}'}
@@ -102,6 +264,58 @@ def test_read_users_me(client: TestClient, auth: AuthActions, session: Session):
     assert response.json() == expected_data
 
 
+def test_current_user_is_cached(client: TestClient, auth: AuthActions,
+                                statements: list[str]):
+    token = auth.login_user_for_token()
+    headers = {'Authorization': f'Bearer {token}'}
+    statements.clear()
+    for _ in range(3):
+        response = client.get('/auth/users/me', headers=headers)
+        assert response.status_code == status.HTTP_200_OK
+        assert response.json()['username'] == 'test_user'
+    assert len([statement for statement in statements
+                if 'FROM user' in statement]) == 1
+
+
+def test_token_carries_user_id(client: TestClient, auth: AuthActions, session: Session,
+                               statements: list[str]):
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    token = auth.login_user_for_token()
+    assert decode_access_token(token).user_id == test_user.id
+    headers = {'Authorization': f'Bearer {token}'}
+    response = client.post('/recommendations', headers=headers,
+                           json={'title': 'Interstellar',
+                                 'short_description': 'Movie about space',
+                                 'opinion': 'My favorite movie',
+                                 'fiction_type': 'movie',
+                                 'tags': ['space']})
+    assert response.status_code == status.HTTP_201_CREATED
+    assert response.json()['user_id'] == test_user.id
+    statements.clear()
+    response = client.delete(f"/recommendations/{response.json()['id']}",
+                             headers=headers)
+    assert response.status_code == status.HTTP_204_NO_CONTENT
+    assert not any('FROM user' in statement for statement in statements)
+
+
+def test_token_without_user_id(client: TestClient, session: Session):
+    # Tokens issued before user id was added to them are still accepted
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    token = create_access_token(data={'sub': 'test_user'},
+                                expires_delta=timedelta(minutes=5))
+    headers = {'Authorization': f'Bearer {token}'}
+    response = client.post('/recommendations', headers=headers,
+                           json={'title': 'Interstellar',
+                                 'short_description': 'Movie about space',
+                                 'opinion': 'My favorite movie',
+                                 'fiction_type': 'movie',
+                                 'tags': ['space']})
+    assert response.status_code == status.HTTP_201_CREATED
+    assert response.json()['user_id'] == test_user.id
+
+
 def test_read_users_me_for_not_logged_user(client: TestClient):
     response = client.get('/auth/users/me')
     assert response.status_code == status.HTTP_401_UNAUTHORIZED
@@ -155,6 +369,33 @@ def test_update_user_with_duplicate_email(client: TestClient, auth: AuthActions,
     assert response.json()['detail'] == 'Duplicate email'
 
 
+def test_update_user_in_one_statement(client: TestClient, auth: AuthActions,
+                                      session: Session, statements: list[str]):
+    new_user = User(username='new_user',
+                    email='new_email@gmail.com',
+                    hashed_password=get_password_hash('34somepassword34'))
+    session.add(new_user)
+    session.commit()
+    token = auth.login_user_for_token()
+    headers = {'Authorization': f'Bearer {token}'}
+    client.get('/auth/users/me', headers=headers)
+    statements.clear()
+    response = client.patch('/auth/users/me', json={'email': 'test_user_1@gmail.com'},
+                            headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    assert response.json()['email'] == 'test_user_1@gmail.com'
+    assert [statement.split()[0] for statement in statements] == ['UPDATE']
+    statements.clear()
+    response = client.patch('/auth/users/me', json={'username': 'new_user'},
+                            headers=headers)
+    assert response.status_code == status.HTTP_409_CONFLICT
+    assert response.json() == {'detail': 'Duplicate username'}
+    # Cached user was dropped by the previous update
+    assert [statement.split()[0] for statement in statements] == ['SELECT', 'UPDATE']
+    response = client.get('/auth/users/me', headers=headers)
+    assert response.json()['username'] == 'test_user'
+
+
 def test_update_user_with_no_data(client: TestClient, auth: AuthActions):
     token = auth.login_user_for_token()
     headers = {'Authorization': f'Bearer {token}'}
@@ -189,6 +430,51 @@ def test_update_user_username(client: TestClient, auth: AuthActions, session: Se
     assert response.json() == expected_data
 
 
+def test_update_user_username_invalidates_cached_user(client: TestClient, auth: AuthActions):
+    token = auth.login_user_for_token()
+    headers = {'Authorization': f'Bearer {token}'}
+    assert client.get('/auth/users/me', headers=headers).status_code == \
+        status.HTTP_200_OK
+    response = client.patch('/auth/users/me',
+                            json={'username': 'test_user_1'},
+                            headers=headers)
+    assert response.status_code == status.HTTP_200_OK
+    # Subject of the old token is the old username
+    response = client.get('/auth/users/me', headers=headers)
+    assert response.status_code == status.HTTP_401_UNAUTHORIZED
+    token = auth.login_user_for_token(username='test_user_1')
+    response = client.get('/auth/users/me',
+                          headers={'Authorization': f'Bearer {token}'})
+    assert response.json()['username'] == 'test_user_1'
+
+
+def test_cached_user_is_not_used_for_reused_username(client: TestClient, auth: AuthActions,
+                                                   session: Session):
+    token = auth.login_user_for_token()
+    assert client.get('/auth/users/me',
+                      headers={'Authorization': f'Bearer {token}'}).status_code == \
+        status.HTTP_200_OK
+    test_user = session.exec(select(User).where(
+        User.username == 'test_user')).first()
+    assert 'hashed_password' not in users_by_id.get(test_user.id)
+    # User is renamed by another process, so cached user of this process is stale,
+    # and its old username is taken by a new user
+    test_user.username = 'test_user_1'
+    session.add(test_user)
+    session.add(User(username='test_user', email='new_user@gmail.com',
+                     hashed_password=get_password_hash('34somepassword34')))
+    session.commit()
+    new_token = auth.login_user_for_token()
+    response = client.get('/auth/users/me',
+                          headers={'Authorization': f'Bearer {new_token}'})
+    assert response.json()['email'] == 'new_user@gmail.com'
+    response = client.patch('/auth/users/me', json={'email': 'new_user_1@gmail.com'},
+                            headers={'Authorization': f'Bearer {new_token}'})
+    assert response.json()['email'] == 'new_user_1@gmail.com'
+    session.refresh(test_user)
+    assert test_user.email == 'test_user@gmail.com'
+
+
 def test_update_user_email(client: TestClient, auth: AuthActions, session: Session):
     token = auth.login_user_for_token()
     headers = {'Authorization': f'Bearer {token}'}